@@ -0,0 +1,101 @@
+"""Throughput of anonymizing a synthetic tree of detector frames.
+
+Writes --files files of --file-size random bytes across --folders folders,
+then anonymizes the tree into a new destination with:
+
+- serial_md5_64k: the previous anonymize_copy, md5 over 64KB reads and a copy
+  of every file, one file at a time
+- md5, blake2b and sha256: anonymize_copies in this process
+- blake2b_pool: anonymize_copies across --processes processes
+- blake2b_pool_rerun: the same again into the filled destination, where every
+  file is hashed and none is copied
+
+and prints files and megabytes per second for each as JSON. Numbers depend on
+whether the tree is in the page cache, which it is right after being written.
+
+    python -m benchmarks.anonymize --files 20000 --file-size 65536
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from tagging.util.files import _dest_folder, anonymize_tree, walk_files
+
+
+def write_tree(root, files: int, file_size: int, folders: int, seed: int):
+    rng = random.Random(seed)
+    for i in range(files):
+        folder = os.path.join(root, f"run{i % folders:04d}")
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, f"frame{i:07d}.tiff"), "wb") as frame:
+            frame.write(rng.randbytes(file_size))
+
+
+def serial_md5_64k(src_root, dest_root):
+    # anonymize_copy as it was, for comparison
+    for src_file_path in walk_files(src_root):
+        hasher = hashlib.md5()
+        with open(src_file_path, 'rb') as afile:
+            buf = afile.read(65536)
+            while len(buf) > 0:
+                hasher.update(buf)
+                buf = afile.read(65536)
+        dest_folder = _dest_folder(src_file_path, src_root, dest_root)
+        os.makedirs(dest_folder, exist_ok=True)
+        dest_file = os.path.join(dest_folder, hasher.hexdigest()) + os.path.splitext(src_file_path)[1]
+        shutil.copyfile(src_file_path, dest_file)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=5000)
+    parser.add_argument("--file-size", type=int, default=256 * 1024, help="bytes per file")
+    parser.add_argument("--folders", type=int, default=50)
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dir", default=None, help="where to write the trees, a temporary directory by default")
+    args = parser.parse_args(args)
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as work_dir:
+        src_root = os.path.join(work_dir, "src")
+        write_tree(src_root, args.files, args.file_size, args.folders, args.seed)
+
+        def serial(hash_algorithm):
+            return lambda dest: list(anonymize_tree(src_root, dest, hash_algorithm=hash_algorithm, processes=1))
+
+        def pool(dest):
+            return list(anonymize_tree(src_root, dest, processes=args.processes))
+
+        runs = [
+            ("serial_md5_64k", "serial", lambda dest: serial_md5_64k(src_root, dest)),
+            ("md5", "serial", serial("md5")),
+            ("blake2b", "serial", serial("blake2b")),
+            ("sha256", "serial", serial("sha256")),
+            ("blake2b_pool", "pool", pool),
+            ("blake2b_pool_rerun", "pool", pool),
+        ]
+        results = []
+        for name, mode, run in runs:
+            dest_root = os.path.join(work_dir, "blake2b_pool" if name.endswith("_rerun") else name)
+            start = time.perf_counter()
+            run(dest_root)
+            seconds = time.perf_counter() - start
+            results.append({
+                "operation": name,
+                "mode": mode,
+                "processes": args.processes if mode == "pool" else 1,
+                "count": args.files,
+                "seconds": round(seconds, 4),
+                "files_per_sec": round(args.files / seconds, 1),
+                "mb_per_sec": round(args.files * args.file_size / seconds / 2 ** 20, 1),
+            })
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
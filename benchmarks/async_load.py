@@ -0,0 +1,95 @@
+"""Load benchmark for the database calls behind the REST handlers.
+
+Compares blocking TagService calls dispatched to the worker threadpool, which is
+how Starlette ran the former ``def`` handlers, against AsyncTagService coroutines
+awaited on the event loop, which is how the ``async def`` handlers run now.
+mongomock answers instantly, so the tagging event collection is wrapped in a
+stand-in that adds a fixed round-trip latency to every lookup.
+
+    python -m benchmarks.async_load --requests 2000 --latency 0.01
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import time
+
+import anyio
+import mongomock
+from mongomock_motor import AsyncMongoMockClient
+
+from tagging.model import TaggingEvent
+from tagging.tag_service import AsyncTagService, TagService
+
+
+class LatentCollection():
+    """Delays find_one of the wrapped collection by a simulated round trip"""
+
+    def __init__(self, collection, latency):
+        self._collection = collection
+        self._latency = latency
+
+    def find_one(self, *args, **kwargs):
+        time.sleep(self._latency)
+        return self._collection.find_one(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+
+class AsyncLatentCollection(LatentCollection):
+
+    async def find_one(self, *args, **kwargs):
+        await asyncio.sleep(self._latency)
+        return await self._collection.find_one(*args, **kwargs)
+
+
+async def run_threadpool_handlers(tag_svc, uids):
+    # to_thread shares anyio's default 40 thread limiter with starlette's def handlers
+    async with anyio.create_task_group() as tg:
+        for uid in uids:
+            tg.start_soon(anyio.to_thread.run_sync, tag_svc.retrieve_tagging_event, uid)
+
+
+async def run_async_handlers(tag_svc, uids):
+    async with anyio.create_task_group() as tg:
+        for uid in uids:
+            tg.start_soon(tag_svc.retrieve_tagging_event, uid)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000, help="concurrent requests per mode")
+    parser.add_argument("--latency", type=float, default=0.01, help="simulated round trip in seconds")
+    args = parser.parse_args(args)
+
+    client = mongomock.MongoClient()
+    tag_svc = TagService(client)
+    tag_svc.create_indexes()
+    async_tag_svc = AsyncTagService(AsyncMongoMockClient(mock_mongo_client=client))
+    event = tag_svc.create_tagging_event(TaggingEvent(tagger_id="bench", run_time=datetime.datetime.now()))
+    tag_svc._collection_tagging_event = LatentCollection(
+        tag_svc._collection_tagging_event, args.latency)
+    async_tag_svc._collection_tagging_event = AsyncLatentCollection(
+        async_tag_svc._collection_tagging_event, args.latency)
+    uids = [event.uid] * args.requests
+
+    results = []
+    for mode, handlers, svc in (("threadpool", run_threadpool_handlers, tag_svc),
+                                ("async", run_async_handlers, async_tag_svc)):
+        start = time.perf_counter()
+        anyio.run(handlers, svc, uids)
+        seconds = time.perf_counter() - start
+        results.append({
+            "operation": "retrieve_tagging_event",
+            "mode": mode,
+            "requests": args.requests,
+            "latency_s": args.latency,
+            "seconds": round(seconds, 4),
+            "ops_per_sec": round(args.requests / seconds, 1),
+        })
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Generators of benchmark data, shaped like the fixtures in tagging/test/data.py.
+
+Everything is produced lazily from a seeded random.Random, so the same arguments
+give the same documents and millions of datasets can be streamed into
+TagService.ingest_datasets without being held in memory.
+"""
+import datetime
+import random
+from typing import Iterator
+
+# tag names of the test fixtures, then numbered labels up to the vocabulary size
+FIXTURE_TAG_NAMES = ["rods", "peaks", "reflection", "rings", "arcs", "label"]
+
+
+def tag_vocabulary(size: int = 50):
+    return (FIXTURE_TAG_NAMES + [f"label{i}" for i in range(size)])[:size]
+
+
+def generate_tags(rng: random.Random, count: int, tag_names) -> Iterator[dict]:
+    for _ in range(count):
+        yield {
+            "name": rng.choice(tag_names),
+            "confidence": round(rng.random(), 4),
+            "locator": {
+                "spec": "test_locator",
+                "path": [rng.randrange(2048), rng.randrange(2048)]
+            }
+        }
+
+
+def generate_datasets(count: int,
+                      tags_per_dataset: int = 3,
+                      vocabulary_size: int = 50,
+                      projects: int = 10,
+                      seed: int = 0,
+                      start: int = 0) -> Iterator[dict]:
+    """Yields count dataset dicts with unique uris. A tenth of them have no tags, like
+    no_tag_dataset, and the rest have up to tags_per_dataset tags drawn from a
+    vocabulary of vocabulary_size names."""
+    rng = random.Random(seed)
+    tag_names = tag_vocabulary(vocabulary_size)
+    for i in range(start, start + count):
+        dataset = {
+            "type": "file",
+            "uri": f"benchmark/images/{i:09d}.tiff",
+            "project": f"project{i % projects}",
+        }
+        if rng.random() >= 0.1:
+            tag_count = rng.randint(1, tags_per_dataset) if tags_per_dataset else 0
+            dataset["tags"] = list(generate_tags(rng, tag_count, tag_names))
+        yield dataset
+
+
+def generate_tagging_events(count: int, seed: int = 0) -> Iterator[dict]:
+    rng = random.Random(seed)
+    for i in range(count):
+        yield {
+            "tagger_id": f"tagger{i % 5}",
+            "run_time": datetime.datetime(2021, 1, 1) + datetime.timedelta(seconds=i),
+            "accuracy": round(rng.random(), 4)
+        }
@@ -0,0 +1,235 @@
+"""Throughput and latency of the TagService, REST and GraphQL hot paths.
+
+Loads --datasets generated datasets and --events tagging events (see
+benchmarks/data.py), then times --ops sequential calls of each operation and
+prints one JSON result per operation with ops/s, p50 and p99 latency and the
+peak memory allocated by the operation. Memory is traced with tracemalloc over a
+separate run of --memory-ops calls, so tracing does not slow the timed calls,
+and the peak is that of the operation alone rather than of the process. With
+mongomock, stored documents are allocations of the process too. Runs against
+mongomock unless --mongo-uri points at a mongod, in which case the benchmark
+database is dropped first.
+
+REST and GraphQL requests go through the ASGI app in process, over httpx, against
+an AsyncTagService on the same database, so they include routing, validation and
+serialization but no network.
+
+    python -m benchmarks.hot_paths --datasets 100000 --ops 1000
+    python -m benchmarks.hot_paths --mongo-uri mongodb://localhost:27017 --datasets 1000000
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+import tracemalloc
+
+import httpx
+import mongomock
+
+from tagging.api import API_URL_PREFIX, GRAPHQL_URL, app, set_tag_service
+from tagging.graphql import set_gql_tag_service
+from tagging.model import Dataset, Tag, TaggingEvent, TagPatchRequest
+from tagging.tag_service import INGEST_CHUNK_SIZE, AsyncTagService, TagService
+
+from .data import generate_datasets, generate_tagging_events, tag_vocabulary
+
+BENCHMARK_DB_NAME = "splash_ml_benchmark"
+
+GRAPHQL_DATASETS_QUERY = """
+    query datasets($tags: [String]) {
+        datasets(tags: $tags, limit: 10) { uid uri tags { name confidence } }
+    }
+"""
+
+
+def traced_peak_mb(run):
+    """Peak memory allocated while run runs, above what was allocated when it started"""
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        run()
+        return round((tracemalloc.get_traced_memory()[1] - baseline) / 2 ** 20, 3)
+    finally:
+        tracemalloc.stop()
+
+
+async def atraced_peak_mb(run):
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        await run()
+        return round((tracemalloc.get_traced_memory()[1] - baseline) / 2 ** 20, 3)
+    finally:
+        tracemalloc.stop()
+
+
+def summarize(operation, mode, latencies, backend, peak_mb):
+    seconds = sum(latencies)
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "operation": operation,
+        "mode": mode,
+        "backend": backend,
+        "count": len(latencies),
+        "seconds": round(seconds, 4),
+        "ops_per_sec": round(len(latencies) / seconds, 1),
+        "p50_ms": round(percentiles[49] * 1000, 3),
+        "p99_ms": round(percentiles[98] * 1000, 3),
+        "peak_alloc_mb": peak_mb,
+    }
+
+
+def measure(call, ops):
+    latencies = []
+    for i in range(ops):
+        start = time.perf_counter()
+        call(i)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def ameasure(call, ops):
+    latencies = []
+    for i in range(ops):
+        start = time.perf_counter()
+        await call(i)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def service_benchmarks(tag_svc: TagService, event_uids, args, backend):
+    rng = random.Random(args.seed)
+    tag_names = tag_vocabulary(args.vocabulary_size)
+    dataset_uids = [dataset.uid for dataset in tag_svc.find_datasets(limit=args.ops)]
+    # enough new datasets for the timed and the traced calls
+    new_datasets = [Dataset.parse_obj(dataset) for dataset in generate_datasets(
+        args.ops + args.memory_ops, args.tags_per_dataset, args.vocabulary_size, seed=args.seed + 1,
+        start=args.datasets)]
+
+    def create_dataset(i):
+        list(tag_svc.create_datasets([new_datasets[i]]))
+
+    def find_datasets(i):
+        list(tag_svc.find_datasets(tags=[rng.choice(tag_names)], limit=10))
+
+    def retrieve_dataset(i):
+        tag_svc.retrieve_dataset(rng.choice(dataset_uids))
+
+    def retrieve_tagging_event(i):
+        tag_svc.retrieve_tagging_event(rng.choice(event_uids))
+
+    def modify_tags(i):
+        req = TagPatchRequest(add_tags=[Tag(name=rng.choice(tag_names), confidence=rng.random())],
+                              remove_tags=["not a tag uid"])
+        tag_svc.modify_tags(req, rng.choice(dataset_uids))
+
+    results = []
+    for operation in (create_dataset, find_datasets, retrieve_dataset, retrieve_tagging_event, modify_tags):
+        latencies = measure(operation, args.ops)
+        peak_mb = traced_peak_mb(lambda: measure(lambda i: operation(args.ops + i), args.memory_ops))
+        results.append(summarize(operation.__name__, "service", latencies, backend, peak_mb))
+    return results
+
+
+async def http_benchmarks(async_tag_svc: AsyncTagService, args, backend):
+    rng = random.Random(args.seed)
+    tag_names = tag_vocabulary(args.vocabulary_size)
+    set_tag_service(async_tag_svc)
+    set_gql_tag_service(async_tag_svc)
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark") as client:
+        async def search_datasets(i):
+            response = await client.post(API_URL_PREFIX + "/datasets/search",
+                                         json={"tags": [rng.choice(tag_names)]})
+            response.raise_for_status()
+
+        async def get_datasets(i):
+            response = await client.get(API_URL_PREFIX + "/datasets",
+                                        params={"tags": [rng.choice(tag_names)], "page[cursor]": ""})
+            response.raise_for_status()
+
+        async def graphql_datasets(i):
+            response = await client.post(GRAPHQL_URL, json={"query": GRAPHQL_DATASETS_QUERY,
+                                                            "variables": {"tags": [rng.choice(tag_names)]}})
+            response.raise_for_status()
+            assert "errors" not in response.json(), response.text
+
+        results = []
+        for operation, mode in ((search_datasets, "rest"), (get_datasets, "rest"), (graphql_datasets, "graphql")):
+            latencies = await ameasure(operation, args.ops)
+            peak_mb = await atraced_peak_mb(lambda: ameasure(operation, args.memory_ops))
+            results.append(summarize(operation.__name__, mode, latencies, backend, peak_mb))
+        return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--datasets", type=int, default=10000, help="datasets loaded before timing")
+    parser.add_argument("--tags-per-dataset", type=int, default=3, help="most tags per generated dataset")
+    parser.add_argument("--vocabulary-size", type=int, default=50, help="distinct tag names")
+    parser.add_argument("--events", type=int, default=1000, help="tagging events loaded before timing")
+    parser.add_argument("--ops", type=int, default=500, help="timed calls per operation")
+    parser.add_argument("--memory-ops", type=int, default=50, help="calls per operation traced for memory")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mongo-uri", default=None, help="mongod to run against instead of mongomock")
+    args = parser.parse_args(args)
+
+    if args.mongo_uri:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        from pymongo import MongoClient
+        client = MongoClient(args.mongo_uri)
+        client.drop_database(BENCHMARK_DB_NAME)
+        backend = "mongod"
+
+        def async_client():
+            return AsyncIOMotorClient(args.mongo_uri)
+    else:
+        from mongomock_motor import AsyncMongoMockClient
+        client = mongomock.MongoClient()
+        backend = "mongomock"
+
+        def async_client():
+            return AsyncMongoMockClient(mock_mongo_client=client)
+
+    def ingest(tag_svc, count):
+        for _ in tag_svc.ingest_datasets(generate_datasets(count, args.tags_per_dataset, args.vocabulary_size,
+                                                           seed=args.seed)):
+            pass
+
+    tag_svc = TagService(client, db_name=BENCHMARK_DB_NAME)
+    tag_svc.create_indexes()
+    start = time.perf_counter()
+    ingest(tag_svc, args.datasets)
+    load_seconds = time.perf_counter() - start
+    # traced on a scratch database over a few chunks, the ingest holds one at a time whatever the count
+    memory_db_name = BENCHMARK_DB_NAME + "_memory"
+    memory_count = min(args.datasets, 5 * INGEST_CHUNK_SIZE)
+    memory_tag_svc = TagService(client, db_name=memory_db_name)
+    memory_tag_svc.create_indexes()
+    peak_mb = traced_peak_mb(lambda: ingest(memory_tag_svc, memory_count))
+    client.drop_database(memory_db_name)
+    results = [{
+        "operation": "ingest_datasets",
+        "mode": "service",
+        "backend": backend,
+        "count": args.datasets,
+        "seconds": round(load_seconds, 4),
+        "ops_per_sec": round(args.datasets / load_seconds, 1),
+        "peak_alloc_mb": peak_mb,
+    }]
+    event_uids = [tag_svc.create_tagging_event(TaggingEvent.parse_obj(event)).uid
+                  for event in generate_tagging_events(args.events, seed=args.seed)]
+    results += service_benchmarks(tag_svc, event_uids, args, backend)
+
+    async def run_http_benchmarks():
+        # the motor client is created on the loop it is used from
+        return await http_benchmarks(AsyncTagService(async_client(), db_name=BENCHMARK_DB_NAME), args, backend)
+
+    results += asyncio.run(run_http_benchmarks())
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""CPU time to turn a page of stored datasets into a json response.
+
+Compares the two ways the dataset search routes build their response once the
+documents are read:
+
+- validated: Dataset.parse_obj per document, then FastAPI validates the page
+  again against response_model=List[Dataset] and encodes it, which is what
+  the routes do with SPLASH_VALIDATE_READS set
+- fast: the documents written as they are with orjson, which is what they
+  do by default
+
+Both run as routes of an in process app over httpx, without a database, so the
+difference is the parsing and serialization alone. Reports the median process
+CPU time per page.
+
+    python -m benchmarks.serialization --page-sizes 100 1000 --tags-per-dataset 3 20
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from typing import List
+
+import httpx
+from fastapi import FastAPI
+
+from tagging.api import FastJSONResponse
+from tagging.model import Dataset
+
+from .data import generate_datasets
+
+
+def stored_page(page_size: int, tags_per_dataset: int, seed: int) -> List[dict]:
+    # documents as create_datasets stores them, unset tag fields included
+    return [Dataset.parse_obj(doc).dict() for doc in generate_datasets(page_size, tags_per_dataset, seed=seed)]
+
+
+def page_app(docs: List[dict]) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/validated", response_model=List[Dataset], response_model_exclude_unset=True)
+    async def validated():
+        return [Dataset.parse_obj(doc) for doc in docs]
+
+    @app.get("/fast")
+    async def fast():
+        return FastJSONResponse(docs)
+
+    return app
+
+
+async def cpu_per_page(app: FastAPI, path: str, pages: int) -> List[float]:
+    times = []
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark") as client:
+        for _ in range(pages):
+            start = time.process_time()
+            response = await client.get(path)
+            response.raise_for_status()
+            times.append(time.process_time() - start)
+    return times
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--page-sizes", type=int, nargs="+", default=[100, 1000], help="datasets per page")
+    parser.add_argument("--tags-per-dataset", type=int, nargs="+", default=[3, 20], help="most tags per dataset")
+    parser.add_argument("--pages", type=int, default=20, help="pages timed per mode")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(args)
+
+    results = []
+    for page_size in args.page_sizes:
+        for tags_per_dataset in args.tags_per_dataset:
+            app = page_app(stored_page(page_size, tags_per_dataset, args.seed))
+            medians = {}
+            for mode in ("validated", "fast"):
+                times = asyncio.run(cpu_per_page(app, "/" + mode, args.pages))
+                medians[mode] = statistics.median(times)
+                results.append({
+                    "operation": "dataset_page",
+                    "mode": mode,
+                    "page_size": page_size,
+                    "tags_per_dataset": tags_per_dataset,
+                    "pages": args.pages,
+                    "cpu_ms_per_page": round(medians[mode] * 1000, 3),
+                })
+            results[-1]["speedup"] = round(medians["validated"] / medians["fast"], 2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""pytest-benchmark suite for modify_tags on datasets with large tag arrays, such as
+the per-region tags written by segmentation models. Every round adds one tag and
+removes a tenth of the tags, plus one uid that is not in the dataset.
+
+    pytest benchmarks --benchmark-only
+
+The tests under tagging/ are the default test path, so these only run when asked for.
+"""
+import mongomock
+import pytest
+
+from tagging.model import Dataset, Tag, TagPatchRequest
+from tagging.tag_service import TagService, _reconcile_removed_tags
+
+TAG_COUNTS = [10, 1000, 10000]
+
+
+@pytest.fixture(scope="module")
+def tag_svc():
+    tag_svc = TagService(mongomock.MongoClient())
+    tag_svc.create_indexes()
+    return tag_svc
+
+
+def tagged_dataset(tag_count):
+    return Dataset(uri=f"benchmark/{tag_count}", type="file",
+                   tags=[Tag(name=f"region{i % 20}", confidence=i / tag_count) for i in range(tag_count)])
+
+
+def patch_request(dataset):
+    remove_tags = [tag.uid for tag in dataset.tags[::10]] + ["not a tag uid"]
+    return TagPatchRequest(add_tags=[Tag(name="added")], remove_tags=remove_tags)
+
+
+@pytest.mark.parametrize("tag_count", TAG_COUNTS)
+def test_modify_tags(benchmark, tag_svc, tag_count):
+    def setup():
+        dataset = next(tag_svc.create_datasets([tagged_dataset(tag_count)]))
+        return (patch_request(dataset), dataset.uid), {}
+
+    added_tags_uid, removed_tags_uid = benchmark.pedantic(tag_svc.modify_tags, setup=setup, rounds=5)
+    assert len(added_tags_uid) == 1
+    assert removed_tags_uid.count('-1') == 1
+
+
+@pytest.mark.parametrize("tag_count", TAG_COUNTS)
+def test_reconcile_removed_tags(benchmark, tag_svc, tag_count):
+    # the part of modify_tags that runs in the service, without the database round trip
+    dataset = next(tag_svc.create_datasets([tagged_dataset(tag_count)]))
+    before = {'uid': dataset.uid, 'tags': [{'uid': tag.uid} for tag in dataset.tags]}
+    tags2remove = patch_request(dataset).remove_tags
+
+    removed_tags_uid = benchmark(_reconcile_removed_tags, before, tags2remove)
+    assert removed_tags_uid.count('-1') == 1
@@ -0,0 +1,40 @@
+"""Microbenchmark of the uid generators in tagging.uids.
+
+Reports uids per second for each generator, and the share of consecutive uids
+that arrive in sorted order, which is what decides whether inserts into the
+unique uid and tags.uid indexes land on the same B-tree page or a random one.
+
+    python -m benchmarks.uids --count 1000000
+"""
+import argparse
+import json
+import time
+
+from tagging.uids import UID_GENERATORS, make_uid_generator
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=1000000, help="uids generated per generator")
+    args = parser.parse_args(args)
+
+    results = []
+    for name in UID_GENERATORS:
+        new_uid = make_uid_generator(name)
+        start = time.perf_counter()
+        uids = [new_uid() for _ in range(args.count)]
+        seconds = time.perf_counter() - start
+        in_order = sum(1 for previous, uid in zip(uids, uids[1:]) if previous < uid)
+        results.append({
+            "operation": "uid_generation",
+            "mode": name,
+            "count": args.count,
+            "seconds": round(seconds, 4),
+            "ops_per_sec": round(args.count / seconds, 1),
+            "in_order_fraction": round(in_order / max(len(uids) - 1, 1), 4),
+        })
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
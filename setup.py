@@ -43,12 +43,14 @@ setup(
         "webservice": requirements_webservice,
         "examples": requirements_example
     },
-    packages=find_packages(exclude=['contrib', 'docs', 'tests']),
+    packages=find_packages(exclude=['contrib', 'docs', 'tests', 'benchmarks', 'benchmarks.*']),
     python_requires='>=3.7',
     install_requires=requirements,
     entry_points={
         'console_scripts': [
             'splash=server:main',
+            'splash-ml-indexes=tagging.indexes:main',
+            'splash-ml-training-set=tagging.training_sets:main',
         ],
     },
 )
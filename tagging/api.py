@@ -1,30 +1,59 @@
 import logging
-from typing import List, Optional
+from typing import Dict, List, Optional
 from ariadne.asgi import GraphQL
+import orjson
 
-from fastapi import FastAPI, Query as FastQuery, HTTPException
+from fastapi import FastAPI, Query as FastQuery, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from starlette.config import Config
 
-from .graphql import schema, set_gql_tag_service
+from .graphql import MAX_QUERY_COST, MAX_QUERY_DEPTH, get_context, schema, set_gql_tag_service, validation_rules
+from .indexes import DEFAULT_TEXT_INDEX_FIELDS, index_manifest, parse_text_index_fields
+from .metrics import METRICS_MEDIA_TYPE, MongoCommandListener, TimingMiddleware, render_metrics
+from .persisted_queries import PersistedQueries, PersistedQueryHandler
 
 
 from .model import (
     Dataset,
+    DatasetField,
+    DatasetIngestResult,
+    DatasetSplit,
+    DatasetTagPatchRequest,
+    IngestMode,
     SearchDatasetsRequest,
+    SplitDatasetsRequest,
     Tag,
+    TagCount,
+    TagOccurrence,
     TagSource,
     TaggingEvent,
     TagPatchRequest
 )
 
-from .tag_service import TagService
+from .tag_service import (
+    AsyncTagService,
+    CACHE_TTL,
+    INGEST_CHUNK_SIZE,
+    MAX_DOCUMENT_SIZE,
+    InvalidCursor,
+    InvalidFields,
+    TagOccurrencesDisabled,
+    encode_cursor
+)
+from .uids import make_uid_generator
 
 logger = logging.getLogger('splash_ml')
 
 
 DEFAULT_PAGE_SIZE = 20
 GRAPHQL_URL = "/splash_ml/graphql"
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+# most uids in one batch get
+BATCH_GET_LIMIT = 1000
+# longest line of an ndjson ingest, a longer dataset could not be stored anyway
+MAX_NDJSON_LINE_SIZE = MAX_DOCUMENT_SIZE
 
 
 def init_logging():
@@ -41,6 +70,22 @@ config = Config(".env")
 MONGO_DB_URI = config("MONGO_DB_URI", cast=str, default="mongodb://localhost:27017/tagging")
 SPLASH_DB_NAME = config("SPLASH_DB_NAME", cast=str, default="splash")
 SPLASH_LOG_LEVEL = config("SPLASH_LOG_LEVEL", cast=str, default="INFO")
+SPLASH_INGEST_CHUNK_SIZE = config("SPLASH_INGEST_CHUNK_SIZE", cast=int, default=INGEST_CHUNK_SIZE)
+SPLASH_UID_GENERATOR = config("SPLASH_UID_GENERATOR", cast=str, default="uuid4")
+SPLASH_CACHE_SIZE = config("SPLASH_CACHE_SIZE", cast=int, default=0)
+SPLASH_CACHE_TTL = config("SPLASH_CACHE_TTL", cast=float, default=CACHE_TTL)
+SPLASH_METRICS = config("SPLASH_METRICS", cast=bool, default=False)
+SPLASH_SLOW_QUERY_MS = config("SPLASH_SLOW_QUERY_MS", cast=float, default=None)
+SPLASH_TAG_OCCURRENCES = config("SPLASH_TAG_OCCURRENCES", cast=bool, default=False)
+SPLASH_BUILD_INDEXES = config("SPLASH_BUILD_INDEXES", cast=bool, default=True)
+SPLASH_TEXT_INDEX_FIELDS = config("SPLASH_TEXT_INDEX_FIELDS", cast=parse_text_index_fields,
+                                  default=",".join(DEFAULT_TEXT_INDEX_FIELDS))
+SPLASH_UNIQUE_URIS = config("SPLASH_UNIQUE_URIS", cast=bool, default=False)
+SPLASH_VALIDATE_READS = config("SPLASH_VALIDATE_READS", cast=bool, default=False)
+SPLASH_GRAPHQL_MAX_COST = config("SPLASH_GRAPHQL_MAX_COST", cast=int, default=MAX_QUERY_COST)
+SPLASH_GRAPHQL_MAX_DEPTH = config("SPLASH_GRAPHQL_MAX_DEPTH", cast=int, default=MAX_QUERY_DEPTH)
+SPLASH_GRAPHQL_PERSISTED_QUERIES = config("SPLASH_GRAPHQL_PERSISTED_QUERIES", cast=str, default=None)
+SPLASH_GRAPHQL_PERSISTED_ONLY = config("SPLASH_GRAPHQL_PERSISTED_ONLY", cast=bool, default=False)
 
 API_URL_PREFIX = "/api/v0"
 
@@ -51,22 +96,63 @@ app = FastAPI(
     docs_url="/api/splash_ml/docs",
     redoc_url="/api/splash_ml/redoc")
 
+if SPLASH_METRICS:
+    app.add_middleware(TimingMiddleware)
+
 
 @app.on_event("startup")
 async def startup_event():
-    from pymongo import MongoClient
+    from motor.motor_asyncio import AsyncIOMotorClient
     logger.debug('!!!!!!!!!starting server')
-    db = MongoClient(MONGO_DB_URI)
-    set_tag_service(TagService(db))
+    db = AsyncIOMotorClient(MONGO_DB_URI, event_listeners=[MongoCommandListener()] if SPLASH_METRICS else [])
+    set_tag_service(AsyncTagService(db,
+                                    uid_generator=make_uid_generator(SPLASH_UID_GENERATOR),
+                                    cache_size=SPLASH_CACHE_SIZE,
+                                    cache_ttl=SPLASH_CACHE_TTL,
+                                    instrument=SPLASH_METRICS,
+                                    slow_query_ms=SPLASH_SLOW_QUERY_MS,
+                                    indexes=index_manifest(SPLASH_TEXT_INDEX_FIELDS, SPLASH_UNIQUE_URIS),
+                                    tag_occurrences=SPLASH_TAG_OCCURRENCES))
+    if SPLASH_BUILD_INDEXES:
+        await tag_svc.create_indexes()
+    elif not await tag_svc.indexes_current():
+        logger.warning('indexes do not match the manifest, build them with python -m tagging.indexes')
     set_gql_tag_service(tag_svc)
 
 
-def set_tag_service(new_tag_svc: TagService):
+def set_tag_service(new_tag_svc: AsyncTagService):
     global tag_svc
     tag_svc = new_tag_svc
 
 
-app.add_route(GRAPHQL_URL, GraphQL(schema=schema, debug=True))
+persisted_queries = PersistedQueries(only_persisted=SPLASH_GRAPHQL_PERSISTED_ONLY)
+if SPLASH_GRAPHQL_PERSISTED_QUERIES:
+    persisted_queries.load(SPLASH_GRAPHQL_PERSISTED_QUERIES)
+
+graphql_app = GraphQL(schema=schema,
+                      context_value=get_context,
+                      validation_rules=validation_rules(SPLASH_GRAPHQL_MAX_COST, SPLASH_GRAPHQL_MAX_DEPTH),
+                      query_validator=persisted_queries.validate,
+                      http_handler=PersistedQueryHandler(persisted_queries),
+                      debug=True)
+app.add_route(GRAPHQL_URL, graphql_app)
+
+
+@app.get('/metrics', include_in_schema=False)
+async def metrics():
+    """ Request latencies, MongoDB command durations, model parse times and cache counts in the
+    Prometheus text format. Timings are only recorded when SPLASH_METRICS is set.
+    """
+    return Response(render_metrics(tag_svc.cache_stats()), media_type=METRICS_MEDIA_TYPE)
+
+
+@app.get(API_URL_PREFIX + '/admin/slow_queries', tags=['admin'], response_model=List[dict])
+async def get_slow_queries():
+    """ Dataset searches that took at least SPLASH_SLOW_QUERY_MS milliseconds, most recent last
+    Returns:
+        List[dict]: query shape, duration and winning plan summary of each slow query
+    """
+    return tag_svc.slow_queries()
 
 
 class CreateResponseModel(BaseModel):
@@ -78,17 +164,154 @@ class CreateTagPatchResponse(BaseModel):
     removed_tags_uid: Optional[List[str]] = None
 
 
+class DatasetTagPatchResponse(CreateTagPatchResponse):
+    dataset_uid: str
+
+
+class DatasetGetResponse(BaseModel):
+    uid: str
+    found: bool
+    dataset: Optional[Dataset] = None
+
+
+class EventGetResponse(BaseModel):
+    uid: str
+    found: bool
+    event: Optional[TaggingEvent] = None
+
+
+def check_batch_size(uids: List[str]):
+    if len(uids) > BATCH_GET_LIMIT:
+        raise HTTPException(400, detail=f"at most {BATCH_GET_LIMIT} uids can be requested at once")
+
+
+class IngestResponseModel(BaseModel):
+    created: int = 0  # created or, when upserting, created or updated
+    errors: List[DatasetIngestResult] = []
+
+
+async def paginate(response: Response, items, limit: int, cursor: Optional[str]):
+    """ Collects a page of results. In cursor mode, also sets the cursor of the next page
+    in the response headers. A full page always gets a next cursor, the page after
+    the last one comes back empty and without it.
+    """
+    try:
+        items = [item async for item in items]
+    except (InvalidCursor, InvalidFields) as e:
+        raise HTTPException(400, detail=str(e))
+    if cursor is not None and limit and len(items) == limit:
+        last = items[-1]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(last['uid'] if isinstance(last, dict) else last.uid)
+    return items
+
+
 @app.post(API_URL_PREFIX + '/datasets', tags=['datasets'], response_model=List[CreateResponseModel])
-def add_datasets(datasets: List[Dataset]):
+async def add_datasets(datasets: List[Dataset]):
     new_datasets = tag_svc.create_datasets(datasets)
-    return [CreateResponseModel(uid=new_dataset.uid) for new_dataset in new_datasets]
+    return [CreateResponseModel(uid=new_dataset.uid) async for new_dataset in new_datasets]
+
+
+async def ndjson_records(stream, max_line_size: int):
+    """ Lines of the stream. Only the bytes of each new chunk are scanned for the end of a
+    line, and a line longer than max_line_size is skipped and yields a ValueError instead,
+    which ingest_datasets reports as the error of that dataset
+    """
+    buffer = bytearray()
+    # the rest of a line that is too long is dropped
+    oversized = False
+    async for chunk in stream:
+        start = 0
+        end = chunk.find(b"\n")
+        while end >= 0:
+            if not oversized:
+                if len(buffer) + end - start > max_line_size:
+                    yield ValueError(f"the line is more than {max_line_size} bytes")
+                else:
+                    buffer += chunk[start:end]
+                    if buffer.strip():
+                        yield bytes(buffer)
+            oversized = False
+            buffer.clear()
+            start = end + 1
+            end = chunk.find(b"\n", start)
+        if oversized:
+            continue
+        if len(buffer) + len(chunk) - start > max_line_size:
+            yield ValueError(f"the line is more than {max_line_size} bytes")
+            oversized = True
+            buffer.clear()
+        else:
+            buffer += chunk[start:]
+    if buffer.strip():
+        yield bytes(buffer)
+
+
+def slim(datasets, fields):
+    """ Keeps fields that were not requested from being filled with Dataset defaults
+    when validated against the route's response model
+    """
+    if not fields:
+        return datasets
+    return [dataset.dict(exclude_unset=True) for dataset in datasets]
+
 
+class FastJSONResponse(Response):
+    """ Json rendered by orjson, for content that is already made of json types """
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+
+async def dataset_page(response: Response, datasets, limit: int, cursor: Optional[str], fields):
+    """ A page of datasets. Unless SPLASH_VALIDATE_READS is set, the datasets are the documents
+    as stored and are written with orjson, skipping both the models and the response model,
+    which would validate every dataset and tag a second time. Documents only hold the fields
+    that were set, so the json is the same as with response_model_exclude_unset
+    """
+    page = await paginate(response, datasets, limit, cursor)
+    if SPLASH_VALIDATE_READS:
+        return slim(page, fields)
+    # headers of the injected response only apply to content that FastAPI serializes
+    headers = {name: value for name, value in response.headers.items() if name == NEXT_CURSOR_HEADER.lower()}
+    return FastJSONResponse(page, headers=headers)
+
+
+@app.post(API_URL_PREFIX + '/datasets/ingest', tags=['datasets'], response_model=IngestResponseModel)
+async def ingest_datasets(
+    request: Request,
+    chunk_size: Optional[int] = FastQuery(SPLASH_INGEST_CHUNK_SIZE, gt=0),
+    mode: IngestMode = FastQuery(IngestMode.insert)
+) -> IngestResponseModel:
+    """ Creates datasets from a newline delimited json body, one dataset per line. The body is
+    read, validated and inserted in chunks as it arrives, so loads of any size run in bounded memory.
+    Invalid and duplicate datasets are reported by line and do not stop the load.
+    Args:
+        chunk_size (Optional[int], optional): datasets validated and inserted per round trip
+        mode (IngestMode, optional): insert, or merge or replace to update the dataset with the same
+            project and uri, so that a load can be sent again. Defaults to insert.
 
-@app.post(API_URL_PREFIX + '/datasets/search', tags=['datasets'], response_model=List[Dataset])
-def search_datasets(
+    Returns:
+        IngestResponseModel: number of created datasets and the errors of those not created
+    """
+    response = IngestResponseModel()
+    records = ndjson_records(request.stream(), MAX_NDJSON_LINE_SIZE)
+    async for result in tag_svc.ingest_datasets(records, chunk_size, mode):
+        if result.error is None:
+            response.created += 1
+        else:
+            response.errors.append(result)
+    return response
+
+
+@app.post(API_URL_PREFIX + '/datasets/search', tags=['datasets'], response_model=List[Dataset],
+          response_model_exclude_unset=True)
+async def search_datasets(
     search: SearchDatasetsRequest,
+    response: Response,
     offset: Optional[int] = FastQuery(0, alias="page[offset]"),
-    limit: Optional[int] = FastQuery(DEFAULT_PAGE_SIZE, alias="page[limit]")
+    limit: Optional[int] = FastQuery(DEFAULT_PAGE_SIZE, alias="page[limit]"),
+    cursor: Optional[str] = FastQuery(None, alias="page[cursor]")
 ) -> List[Dataset]:
     """ Searches datasets based on query parameters. Provides pagine through skip and limit
     Args:
@@ -96,24 +319,124 @@ def search_datasets(
         tags(Optional[List[str]], optional): list of tags to search for. Defaults to none.
         project (Optional[str], optional): find dataset based on project id
         event_id (Optional[str], optional): find dataset based on event id
+        min_confidence, max_confidence (Optional[float], optional): inclusive confidence range of a tag,
+            with one of the names in tags if given
+        untagged (Optional[bool], optional): only datasets without tags, or with tags when false
         skip (Optional[int], optional): [description]. Defaults to 0.
         limit (Optional[int], optional): [description]. Defaults to 10.
+        cursor (Optional[str], optional): page cursor, empty for the first page. The next
+            cursor is returned in the X-Next-Cursor header. Overrides offset.
+        fields (Optional[List[DatasetField]], optional): dataset fields to return, with uid. Defaults to all.
+
+    Returns:
+        List[Dataset]: [Datasets corresponding to search parameters, with only the requested fields]
+    """
+    datasets = tag_svc.find_datasets(offset=offset, limit=limit, uris=search.uris, tags=search.tags,
+                                     project=search.project, event_id=search.event_id,
+                                     min_confidence=search.min_confidence, max_confidence=search.max_confidence,
+                                     untagged=search.untagged, cursor=cursor, fields=search.fields,
+                                     raw=not SPLASH_VALIDATE_READS)
+    return await dataset_page(response, datasets, limit, cursor, search.fields)
+
+
+async def ndjson_lines(items):
+    async for item in items:
+        if SPLASH_VALIDATE_READS:
+            yield item.json(exclude_unset=True) + "\n"
+        else:
+            yield orjson.dumps(item) + b"\n"
+
+
+@app.post(API_URL_PREFIX + '/datasets/export', tags=['datasets'], response_class=StreamingResponse)
+async def export_datasets(search: SearchDatasetsRequest):
+    """ Streams every dataset matching the search as newline delimited json, one dataset per line.
+    Documents are written as they are read from a single database cursor, so this is the route
+    to use for pulling whole training sets rather than paging through /datasets/search.
+    Args:
+        search (SearchDatasetsRequest): same filters as /datasets/search
 
     Returns:
-        List[Dataset]: [Full object datasets corresponding to search parameters]
+        StreamingResponse: application/x-ndjson stream of datasets
     """
-    return tag_svc.find_datasets(offset=offset, limit=limit, uris=search.uris, tags=search.tags,
-                                 project=search.project, event_id=search.event_id)
+    datasets = tag_svc.find_datasets(offset=0, limit=0, uris=search.uris, tags=search.tags,
+                                     project=search.project, event_id=search.event_id,
+                                     min_confidence=search.min_confidence, max_confidence=search.max_confidence,
+                                     untagged=search.untagged, fields=search.fields,
+                                     raw=not SPLASH_VALIDATE_READS)
+    return StreamingResponse(ndjson_lines(datasets), media_type=NDJSON_MEDIA_TYPE)
+
+
+@app.post(API_URL_PREFIX + '/datasets/splits', tags=['datasets'], response_model=DatasetSplit)
+async def split_datasets(req: SplitDatasetsRequest) -> DatasetSplit:
+    """ Assigns the datasets matching the filters to splits by a hash of their uid, and stores the
+    assignment so that training runs fetch it from /datasets/splits/{uid} instead of computing it again.
+    Args:
+        req (SplitDatasetsRequest): ratios of the splits, and the filters of /datasets/search
 
+    Returns:
+        DatasetSplit: uid of the split and its number of datasets per split and tag
+    """
+    try:
+        return await tag_svc.split_datasets(req.ratios, tags=req.tags, project=req.project, event_id=req.event_id,
+                                            min_confidence=req.min_confidence, max_confidence=req.max_confidence)
+    except ValueError as e:
+        raise HTTPException(400, detail=str(e))
 
-@app.get(API_URL_PREFIX + '/datasets', tags=['datasets'], response_model=List[Dataset])
-def get_datasets(
+
+@app.post(API_URL_PREFIX + '/datasets/get', tags=['datasets'], response_model=List[DatasetGetResponse],
+          response_model_exclude_unset=True)
+async def get_datasets_by_uid(uids: List[str]) -> List[DatasetGetResponse]:
+    """ Gets many datasets by uid with one database query
+    Args:
+        uids (List[str]): uids of the datasets, at most BATCH_GET_LIMIT
+
+    Returns:
+        List[DatasetGetResponse]: one per uid in request order, with found false and no dataset
+            where none has the uid
+    """
+    check_batch_size(uids)
+    datasets = await tag_svc.retrieve_datasets(uids, raw=not SPLASH_VALIDATE_READS)
+    if SPLASH_VALIDATE_READS:
+        return [DatasetGetResponse(uid=uid, found=True, dataset=dataset) if dataset is not None
+                else DatasetGetResponse(uid=uid, found=False)
+                for uid, dataset in zip(uids, datasets)]
+    # stored documents, written as in dataset_page
+    return FastJSONResponse([{'uid': uid, 'found': True, 'dataset': dataset} if dataset is not None
+                             else {'uid': uid, 'found': False}
+                             for uid, dataset in zip(uids, datasets)])
+
+
+@app.get(API_URL_PREFIX + '/datasets/splits/{uid}', tags=['datasets'], response_model=Dict[str, List[str]])
+async def get_split(uid: str, name: Optional[str] = FastQuery(None)) -> Dict[str, List[str]]:
+    """ Dataset uids of a stored split
+    Args:
+        uid (str): uid of the split
+        name (Optional[str], optional): only the datasets of this split. Defaults to all splits.
+
+    Returns:
+        Dict[str, List[str]]: dataset uids per split name
+    """
+    split = await tag_svc.retrieve_split(uid, name)
+    if not split:
+        raise HTTPException(404, detail=f"split {uid} not found")
+    return split
+
+
+@app.get(API_URL_PREFIX + '/datasets', tags=['datasets'], response_model=List[Dataset],
+         response_model_exclude_unset=True)
+async def get_datasets(
+    response: Response,
     uris: Optional[List[str]] = FastQuery(None),
     tags: Optional[List[str]] = FastQuery(None),
     project: Optional[str] = FastQuery(None),
     event_id: Optional[str] = FastQuery(None),
+    min_confidence: Optional[float] = FastQuery(None),
+    max_confidence: Optional[float] = FastQuery(None),
+    untagged: Optional[bool] = FastQuery(None),
     offset: Optional[int] = FastQuery(0, alias="page[offset]"),
-    limit: Optional[int] = FastQuery(DEFAULT_PAGE_SIZE, alias="page[limit]")
+    limit: Optional[int] = FastQuery(DEFAULT_PAGE_SIZE, alias="page[limit]"),
+    cursor: Optional[str] = FastQuery(None, alias="page[cursor]"),
+    fields: Optional[List[DatasetField]] = FastQuery(None)
 ) -> List[Dataset]:
     """ Searches datasets based on query parameters. Provides pagine through skip and limit
     Args:
@@ -121,72 +444,174 @@ def get_datasets(
         tags(Optional[List[str]], optional): list of tags to search for. Defaults to none.
         project (Optional[str], optional): find dataset based on project id
         event_id (Optional[str], optional): find dataset based on event id
+        min_confidence, max_confidence (Optional[float], optional): inclusive confidence range of a tag,
+            with one of the names in tags if given
+        untagged (Optional[bool], optional): only datasets without tags, or with tags when false
         skip (Optional[int], optional): [description]. Defaults to 0.
         limit (Optional[int], optional): [description]. Defaults to 10.
+        cursor (Optional[str], optional): page cursor, empty for the first page. The next
+            cursor is returned in the X-Next-Cursor header. Overrides offset.
+        fields (Optional[List[DatasetField]], optional): dataset fields to return, with uid. Defaults to all.
 
     Returns:
-        List[Dataset]: [Full object datasets corresponding to search parameters]
+        List[Dataset]: [Datasets corresponding to search parameters, with only the requested fields]
     """
-    return tag_svc.find_datasets(offset=offset, limit=limit, uris=uris, tags=tags, project=project,
-                                 event_id=event_id)
+    datasets = tag_svc.find_datasets(offset=offset, limit=limit, uris=uris, tags=tags, project=project,
+                                     event_id=event_id, min_confidence=min_confidence,
+                                     max_confidence=max_confidence, untagged=untagged, cursor=cursor,
+                                     fields=fields, raw=not SPLASH_VALIDATE_READS)
+    return await dataset_page(response, datasets, limit, cursor, fields)
 
 
 @app.patch(API_URL_PREFIX + '/datasets/{uid}/tags',
            tags=['datasets', 'tags'],
            response_model=CreateTagPatchResponse)
-def modify_tags(uid: str, req: TagPatchRequest):
-    added_tags_uid, removed_tags_uid = tag_svc.modify_tags(req, uid)
+async def modify_tags(uid: str, req: TagPatchRequest):
+    added_tags_uid, removed_tags_uid = await tag_svc.modify_tags(req, uid)
     return CreateTagPatchResponse(added_tags_uid=added_tags_uid, removed_tags_uid=removed_tags_uid)
 
 
+@app.patch(API_URL_PREFIX + '/datasets/tags',
+           tags=['datasets', 'tags'],
+           response_model=List[DatasetTagPatchResponse])
+async def modify_tags_bulk(reqs: List[DatasetTagPatchRequest]):
+    """ Adds and removes tags on many datasets in one request.
+    Args:
+        reqs (List[DatasetTagPatchRequest]): tags to add and tag uids to remove, per dataset
+
+    Returns:
+        List[DatasetTagPatchResponse]: added and removed tag uids per request, in request order.
+            Both lists are null for datasets that do not exist.
+    """
+    return [DatasetTagPatchResponse(dataset_uid=dataset_uid,
+                                    added_tags_uid=added_tags_uid,
+                                    removed_tags_uid=removed_tags_uid)
+            for dataset_uid, added_tags_uid, removed_tags_uid in await tag_svc.modify_tags_bulk(reqs)]
+
+
 @app.patch(API_URL_PREFIX + '/datasets/{uid}/metadata',
            tags=['datasets', 'metadata'],
            response_model=CreateResponseModel)
-def add_tags(uid: str, tags: List[Tag]):
+async def add_tags(uid: str, tags: List[Tag]):
     raise HTTPException(405, detail="support for patching metadata is future")
     # new_asset = tag_svc.add_metadata(tags, uid)
     # return CreateResponseModel(uid=new_asset.uid)
 
 
+@app.get(API_URL_PREFIX + '/tags/counts', tags=['tags'], response_model=List[TagCount])
+async def count_tags(
+    names: Optional[List[str]] = FastQuery(None),
+    project: Optional[str] = FastQuery(None),
+    event_id: Optional[str] = FastQuery(None),
+    by_event: bool = FastQuery(False),
+    by_project: bool = FastQuery(False),
+    confidence_bins: Optional[int] = FastQuery(None, ge=1, le=100)
+) -> List[TagCount]:
+    """ Counts tags per name, computed on the database server in one pass
+    Args:
+        names (Optional[List[str]], optional): tag names to count. Defaults to all.
+        project (Optional[str], optional): count only tags of datasets in this project
+        event_id (Optional[str], optional): count only tags created by this event
+        by_event (bool, optional): also count per event. Defaults to False.
+        by_project (bool, optional): also count per project. Defaults to False.
+        confidence_bins (Optional[int], optional): number of confidence histogram bins over [0, 1]
+
+    Returns:
+        List[TagCount]: counts sorted by tag name
+    """
+    return await tag_svc.count_tags(names=names, project=project, event_id=event_id, by_event=by_event,
+                                    by_project=by_project, confidence_bins=confidence_bins)
+
+
+@app.get(API_URL_PREFIX + '/tags/occurrences', tags=['tags'], response_model=List[TagOccurrence])
+async def find_tag_occurrences(
+    names: Optional[List[str]] = FastQuery(None),
+    event_id: Optional[str] = FastQuery(None),
+    min_confidence: Optional[float] = FastQuery(None),
+    max_confidence: Optional[float] = FastQuery(None),
+    offset: Optional[int] = FastQuery(0, alias="page[offset]"),
+    limit: Optional[int] = FastQuery(DEFAULT_PAGE_SIZE, alias="page[limit]")
+) -> List[TagOccurrence]:
+    """ Searches single tags, with the uid of the dataset each one is on. Needs SPLASH_TAG_OCCURRENCES
+    Args:
+        names (Optional[List[str]], optional): tag names. Defaults to all.
+        event_id (Optional[str], optional): event that created the tags
+        min_confidence, max_confidence (Optional[float], optional): inclusive confidence range
+        offset (Optional[int], optional): Defaults to 0.
+        limit (Optional[int], optional): Defaults to 10.
+
+    Returns:
+        List[TagOccurrence]: a page of matching tags
+    """
+    try:
+        return [occurrence async for occurrence in tag_svc.find_tag_occurrences(
+            names=names, event_id=event_id, min_confidence=min_confidence, max_confidence=max_confidence,
+            offset=offset, limit=limit)]
+    except TagOccurrencesDisabled as e:
+        raise HTTPException(404, detail=str(e))
+
+
 @app.post(API_URL_PREFIX + '/tagsources', tags=['tag sources'], response_model=CreateResponseModel)
-def add_tag_source(asset: TagSource):
-    new_tagger = tag_svc.create_tag_source(asset)
+async def add_tag_source(asset: TagSource):
+    new_tagger = await tag_svc.create_tag_source(asset)
     return CreateResponseModel(uid=new_tagger.uid)
 
 
 @app.get(API_URL_PREFIX + '/tagsources', tags=['tag sources'], response_model=List[TagSource])
-def get_tag_sources():
-    tag_sources = tag_svc.find_tag_sources()
+async def get_tag_sources():
+    tag_sources = [tag_source async for tag_source in tag_svc.find_tag_sources()]
     return tag_sources
 
 
 @app.post(API_URL_PREFIX + '/events', tags=['events'], response_model=CreateResponseModel)
-def add_event(event: TaggingEvent):
-    new_event = tag_svc.create_tagging_event(event)
+async def add_event(event: TaggingEvent):
+    new_event = await tag_svc.create_tagging_event(event)
     return CreateResponseModel(uid=new_event.uid)
 
 
+@app.post(API_URL_PREFIX + '/events/get', tags=['events'], response_model=List[EventGetResponse],
+          response_model_exclude_unset=True)
+async def get_events_by_uid(uids: List[str]) -> List[EventGetResponse]:
+    """ Gets many tagging events by uid with at most one database query
+    Args:
+        uids (List[str]): uids of the events, at most BATCH_GET_LIMIT
+
+    Returns:
+        List[EventGetResponse]: one per uid in request order, with found false and no event
+            where none has the uid
+    """
+    check_batch_size(uids)
+    events = await tag_svc.retrieve_tagging_events(uids)
+    return [EventGetResponse(uid=uid, found=True, event=event) if event is not None
+            else EventGetResponse(uid=uid, found=False)
+            for uid, event in zip(uids, events)]
+
+
 @app.get(API_URL_PREFIX + '/events/{uid}', tags=['events'], response_model=TaggingEvent)
-def get_event(uid):
-    event = tag_svc.retrieve_tagging_event(uid)
+async def get_event(uid):
+    event = await tag_svc.retrieve_tagging_event(uid)
     return event
 
 
 @app.get(API_URL_PREFIX + '/events', tags=['events'], response_model=List[TaggingEvent])
-def get_events(tagger_id: Optional[str] = None,
-               offset: Optional[int] = FastQuery(0, alias="page[offset]"),
-               limit: Optional[int] = FastQuery(DEFAULT_PAGE_SIZE, alias="page[limit]")):
+async def get_events(response: Response,
+                     tagger_id: Optional[str] = None,
+                     offset: Optional[int] = FastQuery(0, alias="page[offset]"),
+                     limit: Optional[int] = FastQuery(DEFAULT_PAGE_SIZE, alias="page[limit]"),
+                     cursor: Optional[str] = FastQuery(None, alias="page[cursor]")):
     """ Searches tagging events based on query parameters. Provides pagine through skip and limit
     Args:
         tagger_id (Optional[str] optional): find tagging events based on tagger id. Defaults to None.
         skip (Optional[int], optional): [description]. Defaults to 0.
         limit (Optional[int], optional): [description]. Defaults to 10.
+        cursor (Optional[str], optional): page cursor, empty for the first page. The next
+            cursor is returned in the X-Next-Cursor header. Overrides offset.
 
     Returns:
         List[TaggingEvent]: [Full object tagging event corresponding to search parameters]
     """
-    events = tag_svc.find_tagging_event(tagger_id, offset, limit)
-    return events
+    events = tag_svc.find_tagging_event(tagger_id, offset, limit, cursor)
+    return await paginate(response, events, limit, cursor)
 
 
 if __name__ == '__main__':
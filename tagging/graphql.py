@@ -1,11 +1,19 @@
+import asyncio
+
 from ariadne import ObjectType, QueryType, gql, make_executable_schema
+from ariadne.validation import cost_validator
+from graphql import (FieldNode, FragmentDefinitionNode, FragmentSpreadNode, GraphQLError, GraphQLResolveInfo,
+                     InlineFragmentNode, OperationDefinitionNode, value_from_ast_untyped)
+from graphql.validation import ValidationRule
 
-from .tag_service import TagService
+from .model import DatasetField
+from .tag_service import AsyncTagService
 
 type_defs = gql("""
 
     type Query {
-        datasets(uris: [String], tags: [String], limit: Int, skip: Int): [Dataset]!
+        datasets(uris: [String], tags: [String], minConfidence: Float, maxConfidence: Float,
+                 untagged: Boolean, limit: Int = 10, skip: Int = 0): [Dataset]!
     }
 
 
@@ -21,16 +29,23 @@ type_defs = gql("""
         name: String!
         locator: String
         confidence: Float
+        event_id: String
+        event: TaggingEvent
     }
 
     type TagSource{
         " The entity that created a Tag "
+        uid: String
         type: String!
         name: String
 
     }
 
     type TaggingEvent {
+        uid: String
+        tagger_id: String
+        run_time: String
+        accuracy: Float
         tagger: TagSource
     }
 
@@ -47,17 +62,183 @@ type_defs = gql("""
 
 query = QueryType()
 
+MAX_QUERY_COST = 1000
+MAX_QUERY_DEPTH = 10
+
+# cost of the fields that load objects. A field costs its complexity times the limits
+# of the lists it is nested in, so datasets(limit: 100) { tags { event } } costs 300
+COST_MAP = {
+    "Query": {"datasets": {"complexity": 1, "multipliers": ["limit"]}},
+    "Dataset": {"tags": {"complexity": 1}},
+    "Tag": {"event": {"complexity": 1}},
+    "TaggingEvent": {"tagger": {"complexity": 1}},
+}
+
 
-def set_gql_tag_service(new_tag_svc: TagService):
+def set_gql_tag_service(new_tag_svc: AsyncTagService):
     global tag_svc
     tag_svc = new_tag_svc
 
 
+class DataLoader():
+    """Collects the keys loaded while resolving one level of a query and fetches them
+    with a single call of batch_load, which takes a list of keys and returns their
+    values in the same order. Values are kept for the rest of the request.
+    """
+
+    def __init__(self, batch_load):
+        self._batch_load = batch_load
+        self._futures = {}
+        self._queue = []
+
+    def load(self, key) -> asyncio.Future:
+        future = self._futures.get(key)
+        if future is None:
+            future = self._futures[key] = asyncio.get_running_loop().create_future()
+            self._queue.append(key)
+            if len(self._queue) == 1:
+                # resolvers of sibling fields all run before the loop gets to this
+                asyncio.get_running_loop().call_soon(lambda: asyncio.ensure_future(self._dispatch()))
+        return future
+
+    async def _dispatch(self):
+        keys, self._queue = self._queue, []
+        try:
+            values = await self._batch_load(keys)
+        except Exception as e:
+            for key in keys:
+                self._futures[key].set_exception(e)
+            return
+        for key, value in zip(keys, values):
+            self._futures[key].set_result(value)
+
+
+def get_context(request, data=None) -> dict:
+    # a new set of loaders for every request, so nothing is cached across requests
+    return {
+        "request": request,
+        "tagging_events": DataLoader(tag_svc.retrieve_tagging_events),
+        "tag_sources": DataLoader(tag_svc.retrieve_tag_sources),
+    }
+
+
+def selected_fields(info: GraphQLResolveInfo) -> set:
+    """Names of the fields selected on the object the resolver returns, through fragments"""
+    names = set()
+    pending = [field_node.selection_set for field_node in info.field_nodes]
+    while pending:
+        selection_set = pending.pop()
+        if selection_set is None:
+            continue
+        for selection in selection_set.selections:
+            if isinstance(selection, FieldNode):
+                names.add(selection.name.value)
+            elif isinstance(selection, InlineFragmentNode):
+                pending.append(selection.selection_set)
+            elif isinstance(selection, FragmentSpreadNode):
+                pending.append(info.fragments[selection.name.value].selection_set)
+    return names
+
+
+def dataset_projection(info: GraphQLResolveInfo):
+    # Dataset fields to read, so that tag arrays are only loaded when tags are asked for
+    dataset_fields = {field.value for field in DatasetField}
+    return sorted(dataset_fields & selected_fields(info))
+
+
+def _selection_depth(selection_set, fragments, visited) -> int:
+    depth = 0
+    for selection in selection_set.selections if selection_set else ():
+        if isinstance(selection, FieldNode):
+            # introspection fields do not reach the database
+            if not selection.name.value.startswith("__"):
+                depth = max(depth, 1 + _selection_depth(selection.selection_set, fragments, visited))
+        elif isinstance(selection, InlineFragmentNode):
+            depth = max(depth, _selection_depth(selection.selection_set, fragments, visited))
+        elif isinstance(selection, FragmentSpreadNode) and selection.name.value not in visited:
+            fragment = fragments.get(selection.name.value)
+            if fragment is not None:
+                depth = max(depth, _selection_depth(fragment.selection_set, fragments,
+                                                    visited | {selection.name.value}))
+    return depth
+
+
+def depth_limit_validator(max_depth: int):
+    """Validation rule that refuses operations whose fields are nested more than max_depth deep"""
+    class DepthLimitValidator(ValidationRule):
+        def enter_operation_definition(self, node, *_):
+            fragments = {fragment.name.value: fragment for fragment in self.context.document.definitions
+                         if isinstance(fragment, FragmentDefinitionNode)}
+            depth = _selection_depth(node.selection_set, fragments, frozenset())
+            if depth > max_depth:
+                self.report_error(GraphQLError(
+                    f"The query has a depth of {depth}, more than the maximum of {max_depth}", node))
+
+    return DepthLimitValidator
+
+
+def with_variable_defaults(document, variables, operation_name=None) -> dict:
+    """The variables of the request, with the defaults the operation declares for those
+    it does not give, which cost_validator would otherwise not see"""
+    variables = dict(variables or {})
+    for definition in document.definitions:
+        if not isinstance(definition, OperationDefinitionNode):
+            continue
+        if operation_name is not None and (definition.name is None or definition.name.value != operation_name):
+            continue
+        for variable in definition.variable_definitions or ():
+            name = variable.variable.name.value
+            if variable.default_value is not None and variables.get(name) is None:
+                variables[name] = value_from_ast_untyped(variable.default_value)
+    return variables
+
+
+def validation_rules(max_cost: int = MAX_QUERY_COST, max_depth: int = MAX_QUERY_DEPTH):
+    """validation_rules for ariadne that limit the cost and depth of every operation. The
+    cost depends on the variables of the request, so the rules are made per request"""
+    depth_limit = depth_limit_validator(max_depth)
+
+    def rules(context, document, data):
+        data = data if isinstance(data, dict) else {}
+        variables = with_variable_defaults(document, data.get("variables"), data.get("operationName"))
+        return [cost_validator(max_cost, variables=variables, cost_map=COST_MAP), depth_limit]
+
+    return rules
+
+
 @query.field("datasets")
-def resolve_datasets(self, *_, tags=None, uris=None, limit=10, skip=0):
-    datasets = list(tag_svc.find_datasets(tags=tags, uris=uris, offset=skip, limit=limit))
+async def resolve_datasets(self, info, tags=None, uris=None, minConfidence=None, maxConfidence=None, untagged=None,
+                           limit=10, skip=0):
+    if limit < 1:
+        # a limit of 0 reads every dataset, whatever the cost analysis made of it
+        raise GraphQLError("limit must be at least 1")
+    datasets = tag_svc.find_datasets(tags=tags, uris=uris, min_confidence=minConfidence,
+                                     max_confidence=maxConfidence, untagged=untagged, offset=skip, limit=limit,
+                                     fields=dataset_projection(info))
+    datasets = [dataset async for dataset in datasets]
     return datasets
 
 
+tag = ObjectType("Tag")
+tagging_event = ObjectType("TaggingEvent")
+
+
+@tag.field("event")
+def resolve_event(tag, info):
+    if tag.event_id is None:
+        return None
+    return info.context["tagging_events"].load(tag.event_id)
+
+
+@tagging_event.field("tagger")
+def resolve_tagger(event, info):
+    return info.context["tag_sources"].load(event.tagger_id)
+
+
+@tagging_event.field("run_time")
+def resolve_run_time(event, info):
+    return event.run_time.isoformat()
+
+
 dataset = ObjectType("Dataset")
-schema = make_executable_schema(type_defs, query)
+schema = make_executable_schema(type_defs, query, tag, tagging_event)
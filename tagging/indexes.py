@@ -0,0 +1,161 @@
+"""The indexes the services rely on, as a manifest whose version is stored in the database.
+
+Services check the stored version when they start and only build indexes when the
+manifest changed, so restarting a worker costs one find_one instead of a
+create_index per index. Indexes can also be built ahead of a deployment with
+
+    python -m tagging.indexes --mongo-uri mongodb://localhost:27017 --db-name tagging
+
+which is the same as the splash-ml-indexes console script.
+"""
+import argparse
+import datetime
+import hashlib
+import json
+from typing import Iterable, List, Sequence, Tuple
+
+MANIFEST_COLLECTION = 'index_manifest'
+MANIFEST_ID = 'indexes'
+
+# fields of the data_set text index. The wildcard indexes every string in a
+# dataset, tag locators included, and so costs on every tag written
+DEFAULT_TEXT_INDEX_FIELDS = ('$**',)
+
+# collection, keys and options of every index the services rely on, besides the text index
+_INDEXES = [
+    ('tag_source', [('type', 1)], {}),
+    ('tag_source', [('name', 1)], {}),
+    ('tag_source', [('uid', 1)], {'unique': True}),
+    ('tag_source', [('model_info.label_index', 1)], {}),
+    ('tagging_event', [('tagger_id', 1)], {}),
+    ('tagging_event', [('uid', 1)], {'unique': True}),
+    ('data_set', [('tags.name', 1)], {}),
+    ('data_set', [('tags.name', 1), ('tags.confidence', 1)], {}),
+    ('data_set', [('tags.uid', 1)], {'unique': True, 'sparse': True}),
+    ('data_set', [('tags.confidence', 1)], {}),
+    ('data_set', [('uid', 1)], {'unique': True}),
+    # unique with unique_uris, for upserting ingestion
+    ('data_set', [('project', 1), ('uri', 1)], {}),
+    # holds every field of a tag occurrence, so searches on it are covered
+    ('tag_occurrence', [('name', 1), ('event_id', 1), ('confidence', 1), ('dataset_uid', 1), ('_id', 1)], {}),
+    ('dataset_collection', [('split_uid', 1), ('name', 1)], {}),
+]
+
+
+def index_manifest(text_index_fields: Sequence[str] = DEFAULT_TEXT_INDEX_FIELDS,
+                   unique_uris: bool = False) -> List[Tuple[str, list, dict]]:
+    """The indexes to build, with a data_set text index over text_index_fields, or none if it is empty.
+    With unique_uris, no two datasets of a project can have the same uri, which existing
+    duplicates have to be removed for"""
+    manifest = list(_INDEXES)
+    if unique_uris:
+        uri_index = ('data_set', [('project', 1), ('uri', 1)], {})
+        manifest[manifest.index(uri_index)] = ('data_set', [('project', 1), ('uri', 1)], {'unique': True})
+    if text_index_fields:
+        # first of the data_set indexes, wherever they are in the list
+        position = next(i for i, (collection, _, _) in enumerate(manifest) if collection == 'data_set')
+        manifest.insert(position, ('data_set', [(field, 'text') for field in text_index_fields], {}))
+    return manifest
+
+
+def _stale_unique_indexes(manifest, collection: str, indexes: Iterable[dict]) -> List[str]:
+    # an index cannot be rebuilt with other options, so one that gained or lost uniqueness has to go first
+    unique = {tuple(map(tuple, keys)): bool(options.get('unique')) for name, keys, options in manifest
+              if name == collection}
+    return [index['name'] for index in indexes
+            if unique.get(tuple(index['key'].items()), bool(index.get('unique'))) != bool(index.get('unique'))]
+
+
+def manifest_version(manifest: List[Tuple[str, list, dict]]) -> str:
+    return hashlib.sha1(json.dumps(manifest).encode()).hexdigest()
+
+
+def parse_text_index_fields(value: str) -> Tuple[str, ...]:
+    """Comma separated field names, as given in SPLASH_TEXT_INDEX_FIELDS or on the command line"""
+    return tuple(field.strip() for field in value.split(',') if field.strip())
+
+
+def _text_fields(index: dict) -> set:
+    if 'weights' in index:
+        return set(index['weights'])
+    return {field for field, kind in index['key'].items() if kind == 'text'}
+
+
+def _is_text_index(index: dict) -> bool:
+    return '_fts' in index['key'] or 'text' in index['key'].values()
+
+
+def _stale_text_indexes(manifest, collection: str, indexes: Iterable[dict]) -> List[str]:
+    # a collection has at most one text index, so one over other fields has to go first
+    wanted = [{field for field, _ in keys} for name, keys, _ in manifest
+              if name == collection and any(kind == 'text' for _, kind in keys)]
+    return [index['name'] for index in indexes if _is_text_index(index) and _text_fields(index) not in wanted]
+
+
+def _manifest_doc(manifest) -> dict:
+    return {'_id': MANIFEST_ID, 'version': manifest_version(manifest), 'indexes': manifest,
+            'built_at': datetime.datetime.utcnow()}
+
+
+def indexes_current(db, manifest) -> bool:
+    doc = db[MANIFEST_COLLECTION].find_one({'_id': MANIFEST_ID}, {'version': 1})
+    return doc is not None and doc.get('version') == manifest_version(manifest)
+
+
+def ensure_indexes(db, manifest, force: bool = False) -> bool:
+    """Builds the indexes of the manifest unless the database already has its version.
+    Returns whether indexes were built"""
+    if not force and indexes_current(db, manifest):
+        return False
+    for collection in {name for name, _, _ in manifest}:
+        indexes = list(db[collection].list_indexes())
+        for index_name in _stale_text_indexes(manifest, collection, indexes) + \
+                _stale_unique_indexes(manifest, collection, indexes):
+            db[collection].drop_index(index_name)
+    for collection, keys, options in manifest:
+        db[collection].create_index(keys, background=True, **options)
+    db[MANIFEST_COLLECTION].replace_one({'_id': MANIFEST_ID}, _manifest_doc(manifest), upsert=True)
+    return True
+
+
+async def aindexes_current(db, manifest) -> bool:
+    doc = await db[MANIFEST_COLLECTION].find_one({'_id': MANIFEST_ID}, {'version': 1})
+    return doc is not None and doc.get('version') == manifest_version(manifest)
+
+
+async def aensure_indexes(db, manifest, force: bool = False) -> bool:
+    """ensure_indexes for a motor database"""
+    if not force and await aindexes_current(db, manifest):
+        return False
+    for collection in {name for name, _, _ in manifest}:
+        indexes = await db[collection].list_indexes().to_list(None)
+        for index_name in _stale_text_indexes(manifest, collection, indexes) + \
+                _stale_unique_indexes(manifest, collection, indexes):
+            await db[collection].drop_index(index_name)
+    for collection, keys, options in manifest:
+        await db[collection].create_index(keys, background=True, **options)
+    await db[MANIFEST_COLLECTION].replace_one({'_id': MANIFEST_ID}, _manifest_doc(manifest), upsert=True)
+    return True
+
+
+def main(args=None):
+    from pymongo import MongoClient
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017/tagging")
+    parser.add_argument("--db-name", default="tagging", help="database of the service, SPLASH_DB_NAME")
+    parser.add_argument("--text-index-fields", type=parse_text_index_fields,
+                        default=DEFAULT_TEXT_INDEX_FIELDS,
+                        help="comma separated data_set fields of the text index, empty for none")
+    parser.add_argument("--unique-uris", action="store_true",
+                        help="no two datasets of a project with the same uri, SPLASH_UNIQUE_URIS")
+    parser.add_argument("--force", action="store_true", help="build even if the manifest version is current")
+    args = parser.parse_args(args)
+
+    manifest = index_manifest(args.text_index_fields, args.unique_uris)
+    built = ensure_indexes(MongoClient(args.mongo_uri)[args.db_name], manifest, force=args.force)
+    print(json.dumps({"version": manifest_version(manifest), "built": built, "indexes": len(manifest)}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""In-process metrics rendered in the Prometheus text exposition format.
+
+Three sources feed them, each switched on separately: TimingMiddleware times
+every HTTP request by route, MongoCommandListener times every command pymongo
+or motor sends by collection, and services built with instrument=True time
+the parsing of documents into models.
+"""
+import threading
+import time
+from typing import Dict, Iterable, List, Tuple
+
+from pymongo import monitoring
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_MEDIA_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labelnames: Iterable[str], label_values: Iterable[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, label_values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter():
+    """A monotonically increasing value per combination of label values"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, *label_values: str):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.labelnames, label_values)} {value}")
+        return lines
+
+
+class Histogram():
+    """Observations counted into cumulative buckets per combination of label values"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        # per label values: count per bucket, then sum and count of all observations
+        self._series: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, (bucket_counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative += bucket_count
+                    labels = _labels(self.labelnames, label_values, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _labels(self.labelnames, label_values, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = _labels(self.labelnames, label_values)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "splash_ml_http_request_duration_seconds", "Time to respond to an HTTP request, by route template",
+    ("method", "route", "status"))
+MONGO_COMMAND_SECONDS = Histogram(
+    "splash_ml_mongo_command_duration_seconds", "Duration of MongoDB commands reported by the driver",
+    ("command", "collection"))
+MONGO_COMMAND_DOCUMENTS = Counter(
+    "splash_ml_mongo_command_documents_total", "Documents returned or written by MongoDB commands",
+    ("command", "collection"))
+MONGO_COMMAND_FAILURES = Counter(
+    "splash_ml_mongo_command_failures_total", "MongoDB commands that failed", ("command", "collection"))
+MODEL_PARSE_SECONDS = Histogram(
+    "splash_ml_model_parse_duration_seconds", "Time to parse a database document into a model", ("model",))
+
+REGISTRY = [HTTP_REQUEST_SECONDS, MONGO_COMMAND_SECONDS, MONGO_COMMAND_DOCUMENTS, MONGO_COMMAND_FAILURES,
+            MODEL_PARSE_SECONDS]
+
+
+def render_metrics(cache_stats: dict = None) -> str:
+    """All registered metrics, then the hit and miss counts of the service caches if given"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    for stat in ("hits", "misses", "size"):
+        if not cache_stats:
+            break
+        name = f"splash_ml_cache_{stat}"
+        lines.append(f"# TYPE {name} {'gauge' if stat == 'size' else 'counter'}")
+        for cache, stats in sorted(cache_stats.items()):
+            lines.append(f'{name}{{cache="{cache}"}} {stats[stat]}')
+    return "\n".join(lines) + "\n"
+
+
+def timed_parse(model, data: dict):
+    start = time.perf_counter()
+    try:
+        return model.parse_obj(data)
+    finally:
+        MODEL_PARSE_SECONDS.observe(time.perf_counter() - start, model.__name__)
+
+
+def _route_path(scope) -> str:
+    # the template of the matched route, so that path parameters do not become labels
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    app = scope.get("app")
+    for route in getattr(app, "routes", ()):
+        match, _ = route.matches(scope)
+        if match.name == "FULL":
+            return getattr(route, "path", "")
+    return "unmatched"
+
+
+class TimingMiddleware():
+    """ASGI middleware that observes the latency of every HTTP request into HTTP_REQUEST_SECONDS.
+    Streamed responses are timed until their last chunk is sent."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = ["500"]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = str(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            seconds = time.perf_counter() - start
+            HTTP_REQUEST_SECONDS.observe(seconds, scope["method"], _route_path(scope), status[0])
+
+
+def _reply_documents(reply) -> int:
+    cursor = reply.get("cursor")
+    if isinstance(cursor, dict):
+        return len(cursor.get("firstBatch", cursor.get("nextBatch", ())))
+    if "n" in reply:
+        return reply["n"]
+    if "value" in reply:
+        return int(reply["value"] is not None)
+    return 0
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Records the duration and document count of every command into MONGO_COMMAND_SECONDS and
+    MONGO_COMMAND_DOCUMENTS. Pass it to the client with event_listeners=[MongoCommandListener()]."""
+
+    def __init__(self):
+        self._collections = {}
+
+    def started(self, event):
+        collection = event.command.get("collection" if event.command_name == "getMore" else event.command_name)
+        # request ids are only unique per connection
+        self._collections[(event.connection_id, event.request_id)] = collection \
+            if isinstance(collection, str) else ""
+
+    def succeeded(self, event):
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        MONGO_COMMAND_SECONDS.observe(event.duration_micros / 1e6, event.command_name, collection)
+        MONGO_COMMAND_DOCUMENTS.inc(_reply_documents(event.reply), event.command_name, collection)
+
+    def failed(self, event):
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        MONGO_COMMAND_SECONDS.observe(event.duration_micros / 1e6, event.command_name, collection)
+        MONGO_COMMAND_FAILURES.inc(1, event.command_name, collection)
@@ -57,7 +57,10 @@ class DatasetType(str, Enum):
 
 class DatasetCollection(Persistable):
     assets: List[str]
-    models: Dict[str, int]  # model and the quality of that model when run against a model
+    models: Dict[str, int] = {}  # model and the quality of that model when run against a model
+    name: Optional[str] = Field(description="name of the split, for the collections of a split", default=None)
+    split_uid: Optional[str] = Field(description="uid of the split, shared by all of its collections",
+                                     default=None)
 
 
 class Dataset(BaseModel, extra='forbid'):
@@ -69,13 +72,99 @@ class Dataset(BaseModel, extra='forbid'):
     tags: Optional[List[Tag]] = None
 
 
+class DatasetField(str, Enum):
+    uid = "uid"
+    schema_version = "schema_version"
+    project = "project"
+    type = "type"
+    uri = "uri"
+    tags = "tags"
+
+
+class PartialDataset(BaseModel, extra='forbid'):
+    """Dataset with only the fields that a search asked for, the others stay unset"""
+    uid: Optional[str] = None
+    schema_version: Optional[str] = None
+    project: Optional[str] = None
+    type: Optional[DatasetType] = None
+    uri: Optional[str] = None
+    tags: Optional[List[Tag]] = None
+
+
 class SearchDatasetsRequest(BaseModel):
     uris: Optional[List[str]] = None
     tags: Optional[List[str]] = None
     project: Optional[str] = None
     event_id: Optional[str] = None
+    min_confidence: Optional[float] = Field(description="lowest confidence of a matching tag, inclusive",
+                                            default=None)
+    max_confidence: Optional[float] = Field(description="highest confidence of a matching tag, inclusive",
+                                            default=None)
+    untagged: Optional[bool] = Field(description="true for datasets without tags only, false for tagged "
+                                                 "datasets only",
+                                     default=None)
+    fields: Optional[List[DatasetField]] = Field(description="dataset fields to return, all of them if not set. "
+                                                             "uid is always returned",
+                                                 default=None)
+
+
+class SplitDatasetsRequest(BaseModel):
+    ratios: Dict[str, float] = Field(description="share of the datasets of each tag that goes to each split, "
+                                                 "relative to their sum",
+                                     default={"train": 0.8, "validation": 0.1, "test": 0.1})
+    tags: Optional[List[str]] = None
+    project: Optional[str] = None
+    event_id: Optional[str] = None
+    min_confidence: Optional[float] = Field(description="lowest confidence of a matching tag, inclusive",
+                                            default=None)
+    max_confidence: Optional[float] = Field(description="highest confidence of a matching tag, inclusive",
+                                            default=None)
+
+
+class DatasetSplit(BaseModel):
+    uid: str = Field(description="uid of the split, shared by the DatasetCollection records holding it")
+    counts: Dict[str, Dict[str, int]] = Field(description="number of datasets per split and stratum, the "
+                                                          "matching tag of highest confidence. Datasets "
+                                                          "without one are counted under an empty name")
+
+
+class IngestMode(str, Enum):
+    insert = "insert"  # a new dataset for every item
+    merge = "merge"  # upsert on project and uri, replacing the tags with the name and event of a new tag
+    replace = "replace"  # upsert on project and uri, replacing all tags
+
+
+class DatasetIngestResult(BaseModel):
+    index: int = Field(description="position of the dataset in the ingested stream")
+    uid: Optional[str] = Field(description="uid of the created dataset", default=None)
+    error: Optional[str] = Field(description="why the dataset was not created", default=None)
+
+
+class TagCount(BaseModel):
+    name: str = Field(description="name of the tag")
+    event_id: Optional[str] = Field(description="event of the counted tags, when counted per event",
+                                    default=None)
+    project: Optional[str] = Field(description="project of the counted tags, when counted per project",
+                                   default=None)
+    count: int = Field(description="number of tags with this name")
+    confidence_histogram: Optional[List[int]] = Field(description="number of tags per equal width confidence "
+                                                                  "bin over [0, 1], when requested. Tags "
+                                                                  "without a confidence in [0, 1] are left out",
+                                                      default=None)
+
+
+class TagOccurrence(BaseModel):
+    uid: str = Field(description="uid of the tag")
+    dataset_uid: str = Field(description="uid of the dataset the tag is on")
+    name: str
+    confidence: Optional[float] = None
+    event_id: Optional[str] = None
 
 
 class TagPatchRequest(BaseModel):
     add_tags: Optional[List[Tag]] = None
     remove_tags: Optional[List[str]] = None
+
+
+class DatasetTagPatchRequest(TagPatchRequest):
+    dataset_uid: str
@@ -0,0 +1,113 @@
+"""GraphQL queries registered ahead of time and addressed by the sha256 of their text.
+
+A client sends the hash in the extensions of the request, as Apollo clients do,
+
+    {"extensions": {"persistedQuery": {"version": 1, "sha256Hash": "<hash>"}}, "variables": {...}}
+
+and the server executes the registered query without parsing it, and without
+running the validation rules of the GraphQL specification after its first
+request. Rules that depend on variables, like the cost limit, still run every time.
+"""
+import hashlib
+import json
+import threading
+from typing import Dict, Iterable, Optional
+
+from ariadne.asgi.handlers import GraphQLHTTPHandler
+from graphql import DocumentNode, GraphQLSchema, parse, specified_rules, validate
+
+PERSISTED_QUERY_NOT_FOUND = "PersistedQueryNotFound"
+PERSISTED_QUERY_REQUIRED = "PersistedQueryRequired"
+
+
+def query_hash(query: str) -> str:
+    return hashlib.sha256(query.encode()).hexdigest()
+
+
+class PersistedQueries():
+    """Registered queries by hash, parsed once. With only_persisted set, other queries are refused."""
+
+    def __init__(self, queries: Iterable[str] = (), only_persisted: bool = False):
+        self.only_persisted = only_persisted
+        self._queries: Dict[str, str] = {}
+        self._documents: Dict[str, DocumentNode] = {}
+        # ids of the registered documents, and of those that passed the rules of the specification
+        self._registered = set()
+        self._validated = set()
+        self._lock = threading.Lock()
+        for query in queries:
+            self.register(query)
+
+    def __len__(self):
+        return len(self._queries)
+
+    def register(self, query: str) -> str:
+        """Parses and stores query, returns its hash"""
+        key = query_hash(query)
+        document = parse(query)
+        with self._lock:
+            self._queries[key] = query
+            self._documents[key] = document
+            self._registered.add(id(document))
+        return key
+
+    def load(self, path: str):
+        """Registers the queries of a json file that maps the hash of each query to its text"""
+        with open(path) as file:
+            queries = json.load(file)
+        for key, query in queries.items():
+            if query_hash(query) != key:
+                raise ValueError(f"{path}: {key} is not the sha256 of its query")
+            self.register(query)
+
+    def get(self, key: str) -> Optional[str]:
+        return self._queries.get(key)
+
+    def document(self, key: str) -> Optional[DocumentNode]:
+        return self._documents.get(key)
+
+    def validate(self, schema: GraphQLSchema, document: DocumentNode, rules=None, **kwargs):
+        """Query validator for ariadne that runs only the custom rules on registered
+        documents that were already found valid"""
+        rules = specified_rules if rules is None else rules
+        if id(document) in self._validated:
+            rules = [rule for rule in rules if rule not in specified_rules]
+            return validate(schema, document, rules=rules, **kwargs) if rules else []
+        errors = validate(schema, document, rules=rules, **kwargs)
+        if not errors and id(document) in self._registered:
+            with self._lock:
+                self._validated.add(id(document))
+        return errors
+
+
+def _requested_hash(data: dict) -> Optional[str]:
+    extensions = data.get("extensions")
+    persisted_query = extensions.get("persistedQuery") if isinstance(extensions, dict) else None
+    if isinstance(persisted_query, dict):
+        return persisted_query.get("sha256Hash")
+    return None
+
+
+class PersistedQueryHandler(GraphQLHTTPHandler):
+    """HTTP handler that executes registered queries from their hash, or from their text"""
+
+    def __init__(self, persisted_queries: PersistedQueries, **kwargs):
+        super().__init__(**kwargs)
+        self.persisted_queries = persisted_queries
+
+    async def execute_graphql_query(self, request, data, *, context_value=None, query_document=None):
+        if not isinstance(data, dict) or query_document is not None:
+            return await super().execute_graphql_query(request, data, context_value=context_value,
+                                                       query_document=query_document)
+        key = _requested_hash(data)
+        if key is None and isinstance(data.get("query"), str):
+            key = query_hash(data["query"])
+        query = None if key is None else self.persisted_queries.get(key)
+        if query is None:
+            if key is not None and not data.get("query"):
+                return False, {"errors": [{"message": PERSISTED_QUERY_NOT_FOUND}]}
+            if self.persisted_queries.only_persisted:
+                return False, {"errors": [{"message": PERSISTED_QUERY_REQUIRED}]}
+            return await super().execute_graphql_query(request, data, context_value=context_value)
+        return await super().execute_graphql_query(request, {**data, "query": query}, context_value=context_value,
+                                                   query_document=self.persisted_queries.document(key))
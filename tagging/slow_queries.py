@@ -0,0 +1,90 @@
+"""A bounded log of queries that took longer than a threshold, with the plan MongoDB chose for them.
+
+Queries are recorded by shape, with every value replaced by "?", so the log says
+which combination of filters was slow without holding the searched values. The plan
+is asked for afterwards, off the request path, with queryPlanner verbosity, which
+plans the query without running it again.
+"""
+import datetime
+import logging
+import threading
+from collections import deque
+from typing import List
+
+logger = logging.getLogger('splash_ml')
+
+SLOW_QUERY_LOG_SIZE = 100
+
+
+def query_shape(query):
+    """The query with its field names and operators kept and its values replaced by "?" """
+    if isinstance(query, dict):
+        return {key: query_shape(value) for key, value in query.items()}
+    if isinstance(query, list) and any(isinstance(value, dict) for value in query):
+        # subqueries of $and, $or and $nor
+        return [query_shape(value) for value in query]
+    return "?"
+
+
+def _stages(plan: dict) -> List[dict]:
+    stages = []
+    while plan:
+        stages.append(plan)
+        plan = plan.get("inputStage") or (plan.get("inputStages") or [None])[0]
+    return stages
+
+
+def plan_summary(explain: dict) -> dict:
+    """Stages of the winning plan, outermost first, and the index it used if any"""
+    winning_plan = explain.get("queryPlanner", {}).get("winningPlan", {})
+    # newer servers nest the plan of the classic engine under queryPlan
+    winning_plan = winning_plan.get("queryPlan", winning_plan)
+    stages = _stages(winning_plan)
+    return {
+        "stage": " <- ".join(stage.get("stage", "") for stage in stages),
+        "index": next((stage["indexName"] for stage in stages if "indexName" in stage), None),
+    }
+
+
+def explain_command(collection_name: str, find: dict) -> dict:
+    # executionStats would run the query again, on a database that is already slow
+    return {"explain": {"find": collection_name, **find}, "verbosity": "queryPlanner"}
+
+
+class SlowQueryLog():
+    """Keeps the last maxsize queries that took at least threshold_ms milliseconds"""
+
+    def __init__(self, threshold_ms: float, maxsize: int = SLOW_QUERY_LOG_SIZE):
+        self.threshold_ms = threshold_ms
+        self._entries = deque(maxlen=maxsize)
+        self._lock = threading.Lock()
+
+    def is_slow(self, seconds: float) -> bool:
+        return seconds * 1000 >= self.threshold_ms
+
+    def record(self, collection_name: str, find: dict, seconds: float, explain: dict = None) -> dict:
+        entry = {
+            "time": datetime.datetime.utcnow().isoformat() + "Z",
+            "collection": collection_name,
+            "shape": query_shape(find.get("filter", {})),
+            "sort": find.get("sort"),
+            "skip": find.get("skip", 0),
+            "limit": find.get("limit", 0),
+            "duration_ms": round(seconds * 1000, 3),
+            "plan": None if explain is None else plan_summary(explain),
+        }
+        logger.warning("slow query on %s took %.1f ms: %s", collection_name, entry["duration_ms"], entry)
+        with self._lock:
+            self._entries.append(entry)
+        return entry
+
+    def add_plan(self, entry: dict, explain: dict):
+        """Sets the plan of a recorded entry, once it has been explained"""
+        with self._lock:
+            entry["plan"] = plan_summary(explain)
+        logger.info("plan of the slow query on %s: %s", entry["collection"], entry["plan"])
+
+    def entries(self) -> List[dict]:
+        """Logged queries, most recent last"""
+        with self._lock:
+            return [dict(entry) for entry in self._entries]
@@ -1,19 +1,91 @@
-import uuid
-from typing import Iterator, List, Tuple
-from uuid import uuid4
-
+import asyncio
+import base64
+import binascii
+import hashlib
+import itertools
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import bson
+from bson.errors import InvalidDocument
+from pydantic import ValidationError
+from pymongo import DeleteMany, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from .cache import TTLCache
 from .model import (
     Dataset,
+    DatasetCollection,
+    DatasetIngestResult,
+    DatasetSplit,
+    DatasetTagPatchRequest,
+    IngestMode,
+    PartialDataset,
+    TagCount,
+    TagOccurrence,
     TagPatchRequest,
     TagSource,
     TaggingEvent
 )
+from .indexes import aensure_indexes, aindexes_current, ensure_indexes, index_manifest, indexes_current
+from .metrics import timed_parse
+from .slow_queries import SLOW_QUERY_LOG_SIZE, SlowQueryLog, explain_command
+from .uids import random_uid
+
+logger = logging.getLogger('splash_ml')
+
+# uid is projected so that a matched dataset without tags is never an empty document
+_TAG_UIDS_PROJECTION = {'_id': 0, 'uid': 1, 'tags.uid': 1}
+# only fields of the tag_occurrence index, which covers the query
+_OCCURRENCE_PROJECTION = {'_id': 1, 'dataset_uid': 1, 'name': 1, 'confidence': 1, 'event_id': 1}
+
+INGEST_CHUNK_SIZE = 1000
+# the largest document MongoDB stores, maxBsonObjectSize
+MAX_DOCUMENT_SIZE = 16 * 1024 * 1024
+# dataset uids per DatasetCollection record of a split, well under the 16MB document limit
+SPLIT_CHUNK_SIZE = 100000
+CACHE_TTL = 300
+# explains slow queries for every TagService, its thread starts with the first one
+_EXPLAIN_EXECUTOR = ThreadPoolExecutor(1, thread_name_prefix='splash_ml_explain')
 
 
 class DatasetNotFound(Exception):
     pass
 
 
+class InvalidCursor(Exception):
+    pass
+
+
+class TagOccurrencesDisabled(Exception):
+    pass
+
+
+class InvalidFields(Exception):
+    pass
+
+
+def encode_cursor(uid: str) -> str:
+    """Build the opaque page cursor that resumes a search right after the item with this uid"""
+    return base64.urlsafe_b64encode(uid.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Optional[str]:
+    """Recover the uid a page cursor points after. An empty cursor means the first page
+    and decodes to None.
+    """
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        return base64.b64decode(padded, altchars=b'-_', validate=True).decode('utf-8')
+    except (binascii.Error, UnicodeDecodeError) as e:
+        raise InvalidCursor(f"malformed page cursor: {cursor}") from e
+
+
 class TagService():
     """The TagService provides access to the tagging database
     as well as an interface into databroker which has ingested
@@ -24,7 +96,10 @@ class TagService():
     tag_svc.create_tag_source(tagger)
     """
 
-    def __init__(self, client, db_name=None):
+    def __init__(self, client, db_name=None, uid_generator: Callable[[], str] = None,
+                 cache_size: int = 0, cache_ttl: float = CACHE_TTL, instrument: bool = False,
+                 slow_query_ms: float = None, slow_query_log_size: int = SLOW_QUERY_LOG_SIZE,
+                 indexes: list = None, tag_occurrences: bool = False):
         """Initialize a TagService entry using the
         With the provided pymongo.MongoClient instance, the
         service will create:
@@ -32,7 +107,9 @@ class TagService():
         - a collection called 'tagger'
         - a collection called 'tagging_event'
         - a collection called 'asset_tags'
-        - relevant indexes
+
+        Indexes are only checked, with a warning when the database does not have
+        this manifest version. Build them with create_indexes or python -m tagging.indexes
 
         Parameters
         ----------
@@ -45,14 +122,65 @@ class TagService():
         root_catalog : intake.catalog.Catalog
             optional root catalog from which to query for
             run catalog
+
+        uid_generator : Callable[[], str]
+            optional callable returning new uids, see tagging.uids.
+            Default is a random uuid4 per call
+
+        cache_size : int
+            optional number of tagging events, and of tag source searches, kept
+            in an in-process LRU cache. Default is 0, no caching
+
+        cache_ttl : float
+            seconds a cached tagging event or tag source search is served before
+            it is read again
+
+        instrument : bool
+            optionally time the parsing of every document into a model, see
+            tagging.metrics
+
+        slow_query_ms : float
+            optional threshold in milliseconds. Dataset searches whose database
+            time reaches it are logged with their explain plan, and the last
+            slow_query_log_size of them are kept for slow_queries. Default is
+            no slow query log
+
+        indexes : list
+            optional index manifest, see tagging.indexes.index_manifest, that the
+            database is checked against and that create_indexes builds. Default is
+            the manifest with the wildcard text index
+
+        tag_occurrences : bool
+            optionally keep a tag_occurrence collection with one small document
+            per tag, written after every dataset and tag change, for
+            find_tag_occurrences. Default is off
         """
         if db_name is None:
             db_name = 'tagging'
+        self._new_uid = uid_generator or random_uid
+        self._tag_source_cache, self._tagging_event_cache = _make_caches(cache_size, cache_ttl)
+        self._parse_obj = timed_parse if instrument else _parse_obj
+        self._slow_query_log = None if slow_query_ms is None else SlowQueryLog(slow_query_ms, slow_query_log_size)
+        self._explaining = None
+        self._indexes = index_manifest() if indexes is None else indexes
         self._db = client[db_name]
         self._collection_tag_sources = self._db.tag_source
         self._collection_tagging_event = self._db.tagging_event
         self._collection_dataset = self._db.data_set
-        self._create_indexes()
+        self._collection_tag_occurrence = self._db.tag_occurrence if tag_occurrences else None
+        self._collection_dataset_collection = self._db.dataset_collection
+        # building here would drop and rebuild the indexes of a deployment with another manifest
+        if not self.indexes_current():
+            logger.warning('indexes do not match the manifest, build them with python -m tagging.indexes')
+
+    def create_indexes(self, force: bool = False) -> bool:
+        """Builds the indexes unless the database already has the manifest version,
+        or always if force is set. Indexes that differ from the manifest are dropped
+        and rebuilt. Returns whether indexes were built"""
+        return ensure_indexes(self._db, self._indexes, force)
+
+    def indexes_current(self) -> bool:
+        return indexes_current(self._db, self._indexes)
 
     def create_tag_source(self, tag_source: TagSource) -> TagSource:
         """
@@ -69,11 +197,14 @@ class TagService():
             uid for this tagger, which can be added for all Tagging events
         """
         tagger_dict = tag_source.dict()
-        self._inject_uid(tagger_dict)
+        self._inject_uid(tagger_dict, self._new_uid)
         # tagger_dict['schema_version'] = self.SCHEMA_VERSION
         self._collection_tag_sources.insert_one(tagger_dict)
         self._clean_mongo_ids(tagger_dict)
-        return TagSource(**tagger_dict)
+        if self._tag_source_cache is not None:
+            # any cached search could now match one more tag source
+            self._tag_source_cache.clear()
+        return self._parse_obj(TagSource, tagger_dict)
 
     def create_tagging_event(self, event: TaggingEvent) -> TaggingEvent:
         """ Create a new tagging_event data set.  The uid for this tag event will label
@@ -89,10 +220,13 @@ class TagService():
             TaggingEven object, with uid in it
         """
         event_dict = event.dict()
-        self._inject_uid(event_dict)
+        self._inject_uid(event_dict, self._new_uid)
         self._collection_tagging_event.insert_one(event_dict)
         self._clean_mongo_ids(event_dict)
-        return TaggingEvent(**event_dict)
+        event = self._parse_obj(TaggingEvent, event_dict)
+        if self._tagging_event_cache is not None:
+            self._tagging_event_cache[event.uid] = event.copy()
+        return event
 
     def create_datasets(self, datasets: List[Dataset]) -> List[Dataset]:
         """ Create a new datasets.  The uids for these datasets distinguish
@@ -107,18 +241,71 @@ class TagService():
         Datasets
             List of Dataset object, with uids in them
         """
-        # Assign new UIDs to dataset and tags
-        datasets_dict = []
-        for dataset in datasets:
-            dataset.uid = str(uuid4())
-            if dataset.tags is not None:
-                for i in range(len(dataset.tags)):
-                    dataset.tags[i].uid = str(uuid4())
-            datasets_dict.append(dataset.dict())
+        datasets_dict = _prepare_datasets(datasets, self._new_uid)
         self._collection_dataset.insert_many(datasets_dict)
+        self._write_occurrences(_dataset_occurrence_writes(datasets_dict))
         for item in datasets_dict:
             self._clean_mongo_ids(item)
-            yield Dataset.parse_obj(item)
+            yield self._parse_obj(Dataset, item)
+
+    def ingest_datasets(self,
+                        datasets: Iterable,
+                        chunk_size: int = INGEST_CHUNK_SIZE,
+                        mode: IngestMode = IngestMode.insert) -> Iterator[DatasetIngestResult]:
+        """ Create datasets from an arbitrarily long stream while holding at most one chunk
+        of them in memory. Each chunk is validated, given uids and inserted unordered, so a
+        dataset that is invalid or hits a duplicate key fails alone instead of failing the load.
+
+        Parameters
+        ----------
+        datasets : Iterable of Dataset, dict or json str
+            datasets to create, read and validated lazily. An exception in place of
+            a dataset is reported as its error
+
+        chunk_size : int
+            number of datasets validated and inserted per round trip
+
+        mode : IngestMode
+            insert creates a dataset for every item. merge and replace upsert on project
+            and uri instead, with one bulk write of UpdateOne(upsert=True) per chunk, so
+            sending the same datasets again updates them rather than adding duplicates.
+            merge replaces the tags with the name and event_id of a new tag and keeps the
+            others, replace replaces all tags. The unique project and uri index of
+            index_manifest(unique_uris=True) keeps concurrent loads from racing
+
+        Yields
+        ----------
+        DatasetIngestResult
+            one per dataset in input order, with either the uid or the error
+        """
+        for chunk_number, chunk in enumerate(_chunks(datasets, chunk_size)):
+            results, docs, doc_results = _validate_chunk(chunk, chunk_number * chunk_size, self._new_uid)
+            if docs and mode == IngestMode.insert:
+                try:
+                    self._collection_dataset.insert_many(docs, ordered=False)
+                except BulkWriteError as e:
+                    _report_write_errors(doc_results, e)
+                self._write_occurrences(_ingested_occurrence_writes(docs, doc_results))
+            elif docs:
+                self._upsert_chunk(docs, doc_results, mode)
+            yield from results
+
+    def _upsert_chunk(self, docs: List[dict], doc_results: List[DatasetIngestResult], mode: IngestMode):
+        for operations, results in _upsert_rounds(docs, doc_results, mode):
+            try:
+                self._collection_dataset.bulk_write(operations, ordered=False)
+            except BulkWriteError as e:
+                _report_write_errors(results, e)
+        # the uids of datasets that already existed, and the tags they ended up with
+        query, projection = _upserted_query(docs, self._collection_tag_occurrence is not None)
+        if query:
+            upserted = list(self._collection_dataset.find(query, projection))
+            _report_upserted(docs, doc_results, upserted)
+            if self._collection_tag_occurrence is not None and upserted:
+                # the tags of an updated dataset are rewritten, which drops those that were replaced.
+                # Deleted first on its own, an unordered bulk write runs its deletes last
+                self._collection_tag_occurrence.delete_many(_upserted_occurrence_query(upserted))
+                self._write_occurrences(_dataset_occurrence_writes(upserted))
 
     def modify_tags(self, req: TagPatchRequest, dataset_uid: str) -> Tuple[List[str], List[str]]:
         """ Add new set of tags or deletes a list of tags from an existing data set with the given uid.
@@ -138,55 +325,40 @@ class TagService():
             List of removed tags UIDs
             If tag UID did not exit in the given dataset, it returns "-1"
         """
-        tags2add = req.add_tags
-        tags2remove = req.remove_tags
-
-        added_tags_uid = []
-        removed_tags_uid = []
-
-        dataset = self._collection_dataset.find_one({'uid': dataset_uid})
-        if not dataset:
+        added_tags_uid, update = _modify_tags_update(req, self._new_uid)
+        # one atomic update, the tag uids from before it tell which removals matched
+        dataset = self._collection_dataset.find_one_and_update(
+            {'uid': dataset_uid}, update, projection=_TAG_UIDS_PROJECTION, return_document=ReturnDocument.BEFORE)
+        if dataset is None:
             raise DatasetNotFound(f"no dataset with id: {dataset_uid}")
+        removed_tags_uid = _reconcile_removed_tags(dataset, req.remove_tags or [])
+        self._write_occurrences(_tag_patch_occurrence_writes([(dataset_uid, req, removed_tags_uid)]))
+        return added_tags_uid, removed_tags_uid
 
-        if dataset['tags'] is None:
-            self._collection_dataset.update_one(
-                {'uid': dataset_uid},
-                {'$set': {'tags': []}})
-
-        if tags2add:
-            # Assign UIDs to tags
-            tags2add_dict = []
-            for tag in tags2add:
-                tag.uid = str(uuid4())
-                added_tags_uid.append(tag.uid)
-                tags2add_dict.append(tag.dict())
-            # Appends tags (dict) in list
-            self._collection_dataset.update_one(
-                {'uid': dataset_uid},
-                {'$push': {'tags': {'$each': tags2add_dict}}}
-            )
-
-        if tags2remove:
-            # if the there are no tags to delete in the dataset, returns list of "-1"
-            if dataset['tags'] is None or dataset['tags'] == []:
-                removed_tags_uid = ['-1'] * len(tags2remove)
-            else:
-                result = self._collection_dataset.update_many({'uid': dataset_uid},
-                                                              {
-                                                                  "$pull": {
-                                                                    'tags': {'uid': {'$in': tags2remove}}
-                                                                    }
-                                                              })
-                removed_tags_uid = tags2remove
-                # if the number of deleted elements does not match the number of tags,
-                # finds the tag UIDs that were not deleted
-                if result.modified_count is not len(tags2remove):
-                    current_tags_uids = [current_tag['uid'] for current_tag in dataset['tags']]
-                    for i, tag_uid in enumerate(removed_tags_uid):
-                        if tag_uid not in current_tags_uids:
-                            removed_tags_uid[i] = '-1'
+    def modify_tags_bulk(self, reqs: List[DatasetTagPatchRequest]) -> List[Tuple[str, List[str], List[str]]]:
+        """ Add and delete tags on many datasets at once. The current tag uids of all
+        datasets are read in one query and all changes are written with one unordered bulk write.
 
-        return added_tags_uid, removed_tags_uid
+        Parameters
+        ----------
+        reqs: List[DatasetTagPatchRequest]
+            tags to add and tag uids to remove, per dataset
+
+        Returns
+        ----------
+        List[Tuple[str, List[str], List[str]]]
+            dataset uid, added tags UIDs and removed tags UIDs for each request, in request order.
+            Removed tags UIDs are "-1" where the tag did not exist in the dataset, as in modify_tags.
+            Both lists are None when no dataset exists with the requested uid.
+        """
+        datasets = self._collection_dataset.find(*_tags_bulk_query(reqs))
+        results, operations = _plan_tags_bulk(reqs, datasets, self._new_uid)
+        if operations:
+            self._collection_dataset.bulk_write(operations, ordered=False)
+        self._write_occurrences(_tag_patch_occurrence_writes(
+            (dataset_uid, req, removed_tags_uid)
+            for req, (dataset_uid, _, removed_tags_uid) in zip(reqs, results)))
+        return results
 
     def find_tag_sources(self, **search_filters) -> Iterator[TagSource]:
         """ Searches database for tags using the search_filters as query terms.
@@ -201,15 +373,21 @@ class TagService():
         Iterator[TagSource]
             [description]
         """
-        subqueries = []
-        query = {}
-        for k, v in search_filters.items():
-            subqueries.append({k: v})
-        if len(subqueries) > 0:
-            query = {"$and": subqueries}
-        for tagger in self._collection_tag_sources.find(query):
+        if self._tag_source_cache is None:
+            yield from self._query_tag_sources(search_filters)
+            return
+        key = _filters_key(search_filters)
+        tag_sources = self._tag_source_cache.get(key)
+        if tag_sources is None:
+            tag_sources = list(self._query_tag_sources(search_filters))
+            self._tag_source_cache[key] = tag_sources
+        for tag_source in tag_sources:
+            yield tag_source.copy()
+
+    def _query_tag_sources(self, search_filters) -> Iterator[TagSource]:
+        for tagger in self._collection_tag_sources.find(_filters_query(search_filters)):
             self._clean_mongo_ids(tagger)
-            yield TagSource.parse_obj(tagger)
+            yield self._parse_obj(TagSource, tagger)
 
     def retrieve_tagging_event(self, uid: str) -> TaggingEvent:
         """Find a single tagging event with the provided-uid
@@ -224,14 +402,52 @@ class TagService():
         dict
             tagging event dictionary corresponding to the uid
         """
+        if self._tagging_event_cache is not None:
+            event = self._tagging_event_cache.get(uid)
+            if event is not None:
+                return event.copy()
         t_e_dict = self._collection_tagging_event.find_one({'uid': uid})
         self._clean_mongo_ids(t_e_dict)
-        return TaggingEvent.parse_obj(t_e_dict)
+        event = self._parse_obj(TaggingEvent, t_e_dict)
+        if self._tagging_event_cache is not None:
+            self._tagging_event_cache[uid] = event.copy()
+        return event
+
+    def retrieve_tagging_events(self, uids: List[str]) -> List[Optional[TaggingEvent]]:
+        """Find many tagging events by uid with at most one query
+
+        Parameters
+        ----------
+        uids : List[str]
+            uids of the tagging events to return
+
+        Returns
+        -------
+        List[Optional[TaggingEvent]]
+            the tagging event of each uid, in the order of uids, None where none exists
+        """
+        events = _cached_events(self._tagging_event_cache, uids)
+        missing = [uid for uid in dict.fromkeys(uids) if uid not in events]
+        if missing:
+            for item in self._collection_tagging_event.find({'uid': {'$in': missing}}):
+                self._clean_mongo_ids(item)
+                events[item['uid']] = self._parse_obj(TaggingEvent, item)
+            _cache_events(self._tagging_event_cache, events, missing)
+        return [events.get(uid) for uid in uids]
+
+    def retrieve_tag_sources(self, uids: List[str]) -> List[Optional[TagSource]]:
+        """Find many tag sources by uid with one query, in the order of uids, None where none exists"""
+        tag_sources = {}
+        for item in self._collection_tag_sources.find({'uid': {'$in': list(set(uids))}}):
+            self._clean_mongo_ids(item)
+            tag_sources[item['uid']] = self._parse_obj(TagSource, item)
+        return [tag_sources.get(uid) for uid in uids]
 
     def find_tagging_event(self,
                            tagger_id: str = None,
                            offset=0,
-                           limit=10,) -> List[TaggingEvent]:
+                           limit=10,
+                           cursor: str = None) -> List[TaggingEvent]:
         """Find all TaggingEvents matching search filters
 
         Parameters
@@ -239,17 +455,17 @@ class TagService():
         search_filters: str
             keyword arguments that are added to underlying query
 
+        cursor : str
+            optional page cursor, see find_datasets
+
         Returns
         -------
             TaggingEvents dict
         """
-        query = {}
-        if tagger_id:
-            query['tagger_id'] = tagger_id
-        cursor = self._collection_tagging_event.find(query).skip(offset).limit(limit)
-        for item in cursor:
+        query = _tagging_event_query(tagger_id)
+        for item in _paged_find(self._collection_tagging_event, query, offset, limit, cursor):
             self._clean_mongo_ids(item)
-            yield TaggingEvent.parse_obj(item)
+            yield self._parse_obj(TaggingEvent, item)
 
     def retrieve_dataset(self, uid) -> Dataset:
         """Find a single dataset with the provided-uid
@@ -268,7 +484,29 @@ class TagService():
         if not doc_tags:
             return None
         self._clean_mongo_ids(doc_tags)
-        return Dataset(**doc_tags)
+        return self._parse_obj(Dataset, doc_tags)
+
+    def retrieve_datasets(self, uids: List[str], raw: bool = False) -> List[Optional[Dataset]]:
+        """Find many datasets by uid with one query on the unique uid index
+
+        Parameters
+        ----------
+        uids : List[str]
+            uids of the datasets to return
+
+        raw : bool
+            return the documents as stored instead of Dataset models, see find_datasets
+
+        Returns
+        -------
+        List[Optional[Dataset]]
+            the dataset of each uid, in the order of uids, None where none exists
+        """
+        parse_obj = _raw if raw else self._parse_obj
+        datasets = {}
+        for item in self._collection_dataset.find(_uids_query(uids), {'_id': 0}):
+            datasets[item['uid']] = parse_obj(Dataset, item)
+        return [datasets.get(uid) for uid in uids]
 
     def find_datasets(
         self,
@@ -276,8 +514,14 @@ class TagService():
         tags: List[str] = None,
         project: str = None,
         event_id: str = None,
+        min_confidence: float = None,
+        max_confidence: float = None,
+        untagged: bool = None,
         offset=0,
         limit=10,
+        cursor: str = None,
+        fields: List[str] = None,
+        raw: bool = False
             ) -> Iterator[Dataset]:
         # **search_filters) -> Iterator[Dataset]:
         """Find all TagSets matching search filters
@@ -287,87 +531,235 @@ class TagService():
         search_filters: str, str, str, str
             keyword arguments that are added to underlying query
 
+        min_confidence, max_confidence : float
+            optional inclusive confidence range. A dataset matches when one of
+            its tags is in the range and, if tags are given, has one of those
+            names, so tag=foo within a range is served by the
+            (tags.name, tags.confidence) index
+
+        untagged : bool
+            when True only datasets without tags, when False only datasets
+            with at least one tag
+
+        cursor : str
+            optional page cursor. When set, results are ordered by uid and
+            paged by key instead of by offset, so deep pages cost the same as
+            the first one. Pass an empty string for the first page, then the
+            cursor built with encode_cursor from the last uid of each page.
+            offset is ignored in this mode.
+
+        fields : List[str]
+            optional Dataset fields to read. When set, only these fields and uid
+            are read from the database, and PartialDataset objects are returned
+
+        raw : bool
+            when True, the documents are yielded as they are stored, as dicts,
+            without building or validating models. Meant for results that are
+            written straight to json
+
         Returns
         -------
             single TagSet dict
         """
-        subqueries = []
-        query = {}
-        if tags:
-            subqueries.append(
-                {"tags.name": {"$in": tags}})
-
-        if uris:
-            subqueries.append(
-                {"uri": {"$in": uris}}
-            )
-
-        if project:
-            subqueries.append(
-                {"project": project}
-            )
-
-        if event_id:
-            subqueries.append(
-                {"tags.event_id": event_id}
-            )
-
-        if len(subqueries) > 0:
-            query = {"$and": subqueries}
-        cursor = self._collection_dataset.find(query).skip(offset).limit(limit)
-        for item in cursor:
-            self._clean_mongo_ids(item)
-            yield Dataset.parse_obj(item)
+        query = _dataset_query(uris, tags, project, event_id, min_confidence, max_confidence, untagged)
+        projection = _dataset_projection(fields)
+        model = Dataset if projection is None else PartialDataset
+        parse_obj = _raw if raw else self._parse_obj
+        find = _find_spec(query, offset, limit, cursor, projection)
+        items = _find(self._collection_dataset, find)
+        if self._slow_query_log is None:
+            for item in items:
+                self._clean_mongo_ids(item)
+                yield parse_obj(model, item)
+            return
+        elapsed = [0.0]
+        try:
+            for item in _timed(items, elapsed):
+                self._clean_mongo_ids(item)
+                yield parse_obj(model, item)
+        finally:
+            # also when the consumer stops early
+            if self._slow_query_log.is_slow(elapsed[0]):
+                self._log_slow_query(find, elapsed[0])
+
+    def count_tags(self,
+                   names: List[str] = None,
+                   project: str = None,
+                   event_id: str = None,
+                   by_event: bool = False,
+                   by_project: bool = False,
+                   confidence_bins: int = None) -> List[TagCount]:
+        """Count tags per name in one aggregation on the server. Datasets are
+        selected with the same filters as find_datasets, so the tags.name and
+        tags.event_id indexes narrow the scan before tags are unwound.
+
+        Parameters
+        ----------
+        names : List[str]
+            optional tag names to count, default is all
 
-    def _create_indexes(self):
-        self._collection_tag_sources.create_index([
-            ('type', 1),
-        ])
+        project, event_id : str
+            optional project of the datasets and event of the tags to count
 
-        self._collection_tag_sources.create_index([
-            ('name', 1),
-        ]),
+        by_event, by_project : bool
+            also group counts by tag event_id and dataset project
 
-        self._collection_tag_sources.create_index([
-            ('uid', 1)
-        ], unique=True)
+        confidence_bins : int
+            optional number of equal width confidence bins over [0, 1] to
+            histogram the tags of each group into
 
-        self._collection_tag_sources.create_index([
-            ('model_info.label_index', 1)
-        ])
+        Returns
+        -------
+        List[TagCount]
+            counts sorted by name
+        """
+        pipeline = _tag_count_pipeline(names, project, event_id, by_event, by_project, confidence_bins)
+        return [_tag_count(group, confidence_bins) for group in self._collection_dataset.aggregate(pipeline)]
+
+    def split_datasets(self,
+                       ratios: Dict[str, float],
+                       tags: List[str] = None,
+                       project: str = None,
+                       event_id: str = None,
+                       min_confidence: float = None,
+                       max_confidence: float = None,
+                       chunk_size: int = SPLIT_CHUNK_SIZE) -> DatasetSplit:
+        """Assign the datasets matching the filters of find_datasets to splits, and store
+        the assignment as DatasetCollection records so that training runs can fetch it
+        with retrieve_split instead of computing it again.
+
+        Every dataset goes to the split that a hash of its uid picks, see split_of, so
+        each stratum, the matching tag of highest confidence, is divided in the requested
+        ratios on average. A dataset stays in the same split when datasets are added or
+        removed, and in the same split as in a training set laid out with the same
+        ratios by tagging.training_sets. The uids are streamed from an aggregation
+        and written in chunks, and the records already written are deleted if the
+        split fails.
 
-        self._collection_tagging_event.create_index([
-            ('tagger_id', 1),
-        ])
+        Parameters
+        ----------
+        ratios : Dict[str, float]
+            share of each split, relative to their sum
+
+        tags, project, event_id, min_confidence, max_confidence :
+            optional filters of the datasets to split, see find_datasets. Only tags
+            matching tags, event_id and the confidence range are strata
 
-        self._collection_tagging_event.create_index([
-            ('uid', 1)
-        ], unique=True)
+        chunk_size : int
+            most dataset uids per DatasetCollection record
+
+        Returns
+        -------
+        DatasetSplit
+            uid of the split and its number of datasets per split and stratum
+        """
+        _check_ratios(ratios)
+        pipeline = _split_pipeline(tags, project, event_id, min_confidence, max_confidence)
+        split_uid = self._new_uid()
+        splitter = _Splitter(ratios, split_uid, self._new_uid, chunk_size)
+        try:
+            for row in self._collection_dataset.aggregate(pipeline):
+                records = splitter.add(row)
+                if records:
+                    self._collection_dataset_collection.insert_many(records)
+            records = splitter.flush()
+            if records:
+                self._collection_dataset_collection.insert_many(records)
+        except BaseException:
+            self._collection_dataset_collection.delete_many(_split_query(split_uid))
+            raise
+        return splitter.split()
+
+    def retrieve_split(self, uid: str, name: str = None) -> Dict[str, List[str]]:
+        """Dataset uids per split name of a split stored by split_datasets, only those of
+        split name if given. Empty if there is no such split"""
+        query = _split_query(uid, name)
+        return _split_assets(self._collection_dataset_collection.find(query, _SPLIT_PROJECTION).sort('_id', 1))
+
+    def find_tag_occurrences(self,
+                             names: List[str] = None,
+                             event_id: str = None,
+                             min_confidence: float = None,
+                             max_confidence: float = None,
+                             offset=0,
+                             limit=10) -> Iterator[TagOccurrence]:
+        """Find single tags, rather than the datasets holding them, in the tag_occurrence
+        collection. The index on it holds every field, so the search never reads a document.
 
-        self._collection_dataset.create_index([
-            ("$**", "text"),
-        ]),
+        Parameters
+        ----------
+        names : List[str]
+            optional tag names
 
-        self._collection_dataset.create_index([
-            ('tags.name', 1),
-        ]),
+        event_id : str
+            optional event that created the tags
 
-        self._collection_dataset.create_index([
-           ('tags.uid', 1),
-        ], unique=True, sparse=True)
+        min_confidence, max_confidence : float
+            optional inclusive confidence range
 
-        self._collection_dataset.create_index([
-            ('tags.confidence', 1),
-        ]),
+        offset, limit : int
+            page of tags to return
 
-        self._collection_dataset.create_index([
-            ('uid', 1)
-        ], unique=True)
+        Returns
+        -------
+        Iterator[TagOccurrence]
+        """
+        if self._collection_tag_occurrence is None:
+            raise TagOccurrencesDisabled("the service was not created with tag_occurrences=True")
+        find = _find_spec(_occurrence_query(names, event_id, min_confidence, max_confidence), offset, limit,
+                          None, _OCCURRENCE_PROJECTION)
+        for item in _find(self._collection_tag_occurrence, find):
+            yield _occurrence(item)
+
+    def rebuild_tag_occurrences(self, chunk_size: int = INGEST_CHUNK_SIZE) -> int:
+        """Rewrite the tag_occurrence collection from the tags of all datasets, to fill
+        it when tag_occurrences is turned on for an existing database, or to repair it if a
+        write to it failed after the dataset write it follows. Returns the number of tags
+        """
+        if self._collection_tag_occurrence is None:
+            raise TagOccurrencesDisabled("the service was not created with tag_occurrences=True")
+        self._collection_tag_occurrence.delete_many({})
+        count = 0
+        datasets = self._collection_dataset.find({'tags.0': {'$exists': True}}, {'_id': 0, 'uid': 1, 'tags': 1})
+        for chunk in _chunks(datasets, chunk_size):
+            writes = _dataset_occurrence_writes(chunk)
+            self._write_occurrences(writes)
+            count += len(writes)
+        return count
+
+    def _write_occurrences(self, writes: list):
+        # upserts and deletes by tag uid, so they can be repeated safely
+        if self._collection_tag_occurrence is not None and writes:
+            self._collection_tag_occurrence.bulk_write(writes, ordered=False)
+
+    def cache_stats(self) -> dict:
+        """Hits, misses and size of the tag source and tagging event caches, empty
+        when caching is off
+        """
+        return _cache_stats(self._tag_source_cache, self._tagging_event_cache)
+
+    def slow_queries(self) -> List[dict]:
+        """Logged slow dataset searches, most recent last. Empty when the log is off"""
+        return [] if self._slow_query_log is None else self._slow_query_log.entries()
+
+    def _log_slow_query(self, find: dict, seconds: float):
+        # recorded now, explained by a background thread, one query at a time so that
+        # a burst of slow queries does not become a burst of explains
+        entry = self._slow_query_log.record(self._collection_dataset.name, find, seconds)
+        if self._explaining is None or self._explaining.done():
+            self._explaining = _EXPLAIN_EXECUTOR.submit(self._explain_slow_query, entry, find)
+
+    def _explain_slow_query(self, entry: dict, find: dict):
+        try:
+            explain = self._db.command(explain_command(self._collection_dataset.name, find))
+        except (NotImplementedError, PyMongoError):
+            return
+        self._slow_query_log.add_plan(entry, explain)
 
     @staticmethod
-    def _inject_uid(tagging_dict):
+    def _inject_uid(tagging_dict, new_uid=random_uid):
         if tagging_dict.get('uid') is None:
-            tagging_dict['uid'] = str(uuid.uuid4())
+            tagging_dict['uid'] = new_uid()
 
     @staticmethod
     def _clean_mongo_ids(data):
@@ -376,6 +768,1001 @@ class TagService():
             del data['_id']
 
 
+class AsyncTagService():
+    """Asyncio counterpart of TagService for the Motor driver. It has the same
+    methods, as coroutines, and the methods that yield from TagService are async
+    generators here. Queries and documents are built by the same code as TagService.
+
+    Indexes are not created in the constructor, await create_indexes once at startup,
+    or build them beforehand with python -m tagging.indexes.
+
+    Usage looks something like:
+    tag_svc = AsyncTagService(motor_client)
+    await tag_svc.create_indexes()
+    await tag_svc.create_tag_source(tagger)
+    """
+
+    def __init__(self, client, db_name=None, uid_generator: Callable[[], str] = None,
+                 cache_size: int = 0, cache_ttl: float = CACHE_TTL, instrument: bool = False,
+                 slow_query_ms: float = None, slow_query_log_size: int = SLOW_QUERY_LOG_SIZE,
+                 indexes: list = None, tag_occurrences: bool = False):
+        """
+        Parameters
+        ----------
+        client : motor.motor_asyncio.AsyncIOMotorClient
+            motor client that service will use to connect to
+
+        db_name : str
+            optional mongo database name, default is 'tagging'
+
+        uid_generator : Callable[[], str]
+            optional callable returning new uids, see tagging.uids
+
+        cache_size, cache_ttl :
+            optional tag source and tagging event cache, see TagService
+
+        instrument : bool
+            optionally time model parsing, see TagService
+
+        slow_query_ms, slow_query_log_size :
+            optional slow dataset search log, see TagService
+
+        indexes : list
+            optional index manifest, see TagService
+
+        tag_occurrences : bool
+            optionally keep the tag_occurrence collection, see TagService
+        """
+        if db_name is None:
+            db_name = 'tagging'
+        self._new_uid = uid_generator or random_uid
+        self._tag_source_cache, self._tagging_event_cache = _make_caches(cache_size, cache_ttl)
+        self._parse_obj = timed_parse if instrument else _parse_obj
+        self._slow_query_log = None if slow_query_ms is None else SlowQueryLog(slow_query_ms, slow_query_log_size)
+        self._explaining = None
+        self._indexes = index_manifest() if indexes is None else indexes
+        self._db = client[db_name]
+        self._collection_tag_sources = self._db.tag_source
+        self._collection_tagging_event = self._db.tagging_event
+        self._collection_dataset = self._db.data_set
+        self._collection_tag_occurrence = self._db.tag_occurrence if tag_occurrences else None
+        self._collection_dataset_collection = self._db.dataset_collection
+
+    async def create_indexes(self, force: bool = False) -> bool:
+        """Builds the indexes unless the database already has the manifest version,
+        or always if force is set. Returns whether indexes were built"""
+        return await aensure_indexes(self._db, self._indexes, force)
+
+    async def indexes_current(self) -> bool:
+        return await aindexes_current(self._db, self._indexes)
+
+    async def create_tag_source(self, tag_source: TagSource) -> TagSource:
+        tagger_dict = tag_source.dict()
+        TagService._inject_uid(tagger_dict, self._new_uid)
+        await self._collection_tag_sources.insert_one(tagger_dict)
+        TagService._clean_mongo_ids(tagger_dict)
+        if self._tag_source_cache is not None:
+            self._tag_source_cache.clear()
+        return self._parse_obj(TagSource, tagger_dict)
+
+    async def create_tagging_event(self, event: TaggingEvent) -> TaggingEvent:
+        event_dict = event.dict()
+        TagService._inject_uid(event_dict, self._new_uid)
+        await self._collection_tagging_event.insert_one(event_dict)
+        TagService._clean_mongo_ids(event_dict)
+        event = self._parse_obj(TaggingEvent, event_dict)
+        if self._tagging_event_cache is not None:
+            self._tagging_event_cache[event.uid] = event.copy()
+        return event
+
+    async def create_datasets(self, datasets: List[Dataset]) -> AsyncIterator[Dataset]:
+        datasets_dict = _prepare_datasets(datasets, self._new_uid)
+        await self._collection_dataset.insert_many(datasets_dict)
+        await self._write_occurrences(_dataset_occurrence_writes(datasets_dict))
+        for item in datasets_dict:
+            TagService._clean_mongo_ids(item)
+            yield self._parse_obj(Dataset, item)
+
+    async def ingest_datasets(self,
+                              datasets,
+                              chunk_size: int = INGEST_CHUNK_SIZE,
+                              mode: IngestMode = IngestMode.insert) -> AsyncIterator[DatasetIngestResult]:
+        """ Same as TagService.ingest_datasets, also accepting an async iterable. The insert of
+        one chunk overlaps with reading and validating the next.
+        """
+        pending = None
+        pending_results = []
+        chunk_number = 0
+        async for chunk in _achunks(datasets, chunk_size):
+            results, docs, doc_results = _validate_chunk(chunk, chunk_number * chunk_size, self._new_uid)
+            chunk_number += 1
+            if mode == IngestMode.insert:
+                inserting = asyncio.ensure_future(self._insert_chunk(docs, doc_results))
+            else:
+                if pending is not None:
+                    # upserts of a uri in consecutive chunks have to apply in order
+                    await pending
+                inserting = asyncio.ensure_future(self._upsert_chunk(docs, doc_results, mode))
+            if pending is not None:
+                await pending
+                for result in pending_results:
+                    yield result
+            pending, pending_results = inserting, results
+        if pending is not None:
+            await pending
+            for result in pending_results:
+                yield result
+
+    async def _insert_chunk(self, docs, doc_results):
+        if docs:
+            try:
+                await self._collection_dataset.insert_many(docs, ordered=False)
+            except BulkWriteError as e:
+                _report_write_errors(doc_results, e)
+            await self._write_occurrences(_ingested_occurrence_writes(docs, doc_results))
+
+    async def _upsert_chunk(self, docs: List[dict], doc_results: List[DatasetIngestResult], mode: IngestMode):
+        if not docs:
+            return
+        for operations, results in _upsert_rounds(docs, doc_results, mode):
+            try:
+                await self._collection_dataset.bulk_write(operations, ordered=False)
+            except BulkWriteError as e:
+                _report_write_errors(results, e)
+        query, projection = _upserted_query(docs, self._collection_tag_occurrence is not None)
+        if query:
+            upserted = await self._collection_dataset.find(query, projection).to_list(None)
+            _report_upserted(docs, doc_results, upserted)
+            if self._collection_tag_occurrence is not None and upserted:
+                await self._collection_tag_occurrence.delete_many(_upserted_occurrence_query(upserted))
+                await self._write_occurrences(_dataset_occurrence_writes(upserted))
+
+    async def modify_tags(self, req: TagPatchRequest, dataset_uid: str) -> Tuple[List[str], List[str]]:
+        added_tags_uid, update = _modify_tags_update(req, self._new_uid)
+        dataset = await self._collection_dataset.find_one_and_update(
+            {'uid': dataset_uid}, update, projection=_TAG_UIDS_PROJECTION, return_document=ReturnDocument.BEFORE)
+        if dataset is None:
+            raise DatasetNotFound(f"no dataset with id: {dataset_uid}")
+        removed_tags_uid = _reconcile_removed_tags(dataset, req.remove_tags or [])
+        await self._write_occurrences(_tag_patch_occurrence_writes([(dataset_uid, req, removed_tags_uid)]))
+        return added_tags_uid, removed_tags_uid
+
+    async def modify_tags_bulk(self, reqs: List[DatasetTagPatchRequest]) -> List[Tuple[str, List[str], List[str]]]:
+        datasets = await self._collection_dataset.find(*_tags_bulk_query(reqs)).to_list(None)
+        results, operations = _plan_tags_bulk(reqs, datasets, self._new_uid)
+        if operations:
+            await self._collection_dataset.bulk_write(operations, ordered=False)
+        await self._write_occurrences(_tag_patch_occurrence_writes(
+            (dataset_uid, req, removed_tags_uid)
+            for req, (dataset_uid, _, removed_tags_uid) in zip(reqs, results)))
+        return results
+
+    async def find_tag_sources(self, **search_filters) -> AsyncIterator[TagSource]:
+        if self._tag_source_cache is None:
+            async for tag_source in self._query_tag_sources(search_filters):
+                yield tag_source
+            return
+        key = _filters_key(search_filters)
+        tag_sources = self._tag_source_cache.get(key)
+        if tag_sources is None:
+            tag_sources = [tag_source async for tag_source in self._query_tag_sources(search_filters)]
+            self._tag_source_cache[key] = tag_sources
+        for tag_source in tag_sources:
+            yield tag_source.copy()
+
+    async def _query_tag_sources(self, search_filters) -> AsyncIterator[TagSource]:
+        async for tagger in self._collection_tag_sources.find(_filters_query(search_filters)):
+            TagService._clean_mongo_ids(tagger)
+            yield self._parse_obj(TagSource, tagger)
+
+    async def retrieve_tagging_event(self, uid: str) -> TaggingEvent:
+        if self._tagging_event_cache is not None:
+            event = self._tagging_event_cache.get(uid)
+            if event is not None:
+                return event.copy()
+        t_e_dict = await self._collection_tagging_event.find_one({'uid': uid})
+        TagService._clean_mongo_ids(t_e_dict)
+        event = self._parse_obj(TaggingEvent, t_e_dict)
+        if self._tagging_event_cache is not None:
+            self._tagging_event_cache[uid] = event.copy()
+        return event
+
+    async def retrieve_tagging_events(self, uids: List[str]) -> List[Optional[TaggingEvent]]:
+        events = _cached_events(self._tagging_event_cache, uids)
+        missing = [uid for uid in dict.fromkeys(uids) if uid not in events]
+        if missing:
+            async for item in self._collection_tagging_event.find({'uid': {'$in': missing}}):
+                TagService._clean_mongo_ids(item)
+                events[item['uid']] = self._parse_obj(TaggingEvent, item)
+            _cache_events(self._tagging_event_cache, events, missing)
+        return [events.get(uid) for uid in uids]
+
+    async def retrieve_tag_sources(self, uids: List[str]) -> List[Optional[TagSource]]:
+        tag_sources = {}
+        async for item in self._collection_tag_sources.find({'uid': {'$in': list(set(uids))}}):
+            TagService._clean_mongo_ids(item)
+            tag_sources[item['uid']] = self._parse_obj(TagSource, item)
+        return [tag_sources.get(uid) for uid in uids]
+
+    async def find_tag_occurrences(self,
+                                   names: List[str] = None,
+                                   event_id: str = None,
+                                   min_confidence: float = None,
+                                   max_confidence: float = None,
+                                   offset=0,
+                                   limit=10) -> AsyncIterator[TagOccurrence]:
+        if self._collection_tag_occurrence is None:
+            raise TagOccurrencesDisabled("the service was not created with tag_occurrences=True")
+        find = _find_spec(_occurrence_query(names, event_id, min_confidence, max_confidence), offset, limit,
+                          None, _OCCURRENCE_PROJECTION)
+        async for item in _find(self._collection_tag_occurrence, find):
+            yield _occurrence(item)
+
+    async def rebuild_tag_occurrences(self, chunk_size: int = INGEST_CHUNK_SIZE) -> int:
+        if self._collection_tag_occurrence is None:
+            raise TagOccurrencesDisabled("the service was not created with tag_occurrences=True")
+        await self._collection_tag_occurrence.delete_many({})
+        count = 0
+        datasets = self._collection_dataset.find({'tags.0': {'$exists': True}}, {'_id': 0, 'uid': 1, 'tags': 1})
+        async for chunk in _achunks(datasets, chunk_size):
+            writes = _dataset_occurrence_writes(chunk)
+            await self._write_occurrences(writes)
+            count += len(writes)
+        return count
+
+    async def _write_occurrences(self, writes: list):
+        if self._collection_tag_occurrence is not None and writes:
+            await self._collection_tag_occurrence.bulk_write(writes, ordered=False)
+
+    def cache_stats(self) -> dict:
+        return _cache_stats(self._tag_source_cache, self._tagging_event_cache)
+
+    def slow_queries(self) -> List[dict]:
+        return [] if self._slow_query_log is None else self._slow_query_log.entries()
+
+    def _log_slow_query(self, find: dict, seconds: float):
+        # called from the finally of find_datasets, which cannot await, the explain is a task
+        entry = self._slow_query_log.record(self._collection_dataset.name, find, seconds)
+        if self._explaining is None or self._explaining.done():
+            self._explaining = asyncio.ensure_future(self._explain_slow_query(entry, find))
+
+    async def _explain_slow_query(self, entry: dict, find: dict):
+        try:
+            explain = await self._db.command(explain_command(self._collection_dataset.name, find))
+        except (NotImplementedError, PyMongoError):
+            return
+        self._slow_query_log.add_plan(entry, explain)
+
+    async def count_tags(self,
+                         names: List[str] = None,
+                         project: str = None,
+                         event_id: str = None,
+                         by_event: bool = False,
+                         by_project: bool = False,
+                         confidence_bins: int = None) -> List[TagCount]:
+        pipeline = _tag_count_pipeline(names, project, event_id, by_event, by_project, confidence_bins)
+        groups = await self._collection_dataset.aggregate(pipeline).to_list(None)
+        return [_tag_count(group, confidence_bins) for group in groups]
+
+    async def split_datasets(self,
+                             ratios: Dict[str, float],
+                             tags: List[str] = None,
+                             project: str = None,
+                             event_id: str = None,
+                             min_confidence: float = None,
+                             max_confidence: float = None,
+                             chunk_size: int = SPLIT_CHUNK_SIZE) -> DatasetSplit:
+        _check_ratios(ratios)
+        pipeline = _split_pipeline(tags, project, event_id, min_confidence, max_confidence)
+        split_uid = self._new_uid()
+        splitter = _Splitter(ratios, split_uid, self._new_uid, chunk_size)
+        try:
+            async for row in self._collection_dataset.aggregate(pipeline):
+                records = splitter.add(row)
+                if records:
+                    await self._collection_dataset_collection.insert_many(records)
+            records = splitter.flush()
+            if records:
+                await self._collection_dataset_collection.insert_many(records)
+        except BaseException:
+            await self._collection_dataset_collection.delete_many(_split_query(split_uid))
+            raise
+        return splitter.split()
+
+    async def retrieve_split(self, uid: str, name: str = None) -> Dict[str, List[str]]:
+        query = _split_query(uid, name)
+        records = self._collection_dataset_collection.find(query, _SPLIT_PROJECTION).sort('_id', 1)
+        return _split_assets(await records.to_list(None))
+
+    async def find_tagging_event(self,
+                                 tagger_id: str = None,
+                                 offset=0,
+                                 limit=10,
+                                 cursor: str = None) -> AsyncIterator[TaggingEvent]:
+        query = _tagging_event_query(tagger_id)
+        async for item in _paged_find(self._collection_tagging_event, query, offset, limit, cursor):
+            TagService._clean_mongo_ids(item)
+            yield self._parse_obj(TaggingEvent, item)
+
+    async def retrieve_dataset(self, uid) -> Dataset:
+        doc_tags = await self._collection_dataset.find_one({'uid': uid})
+        if not doc_tags:
+            return None
+        TagService._clean_mongo_ids(doc_tags)
+        return self._parse_obj(Dataset, doc_tags)
+
+    async def retrieve_datasets(self, uids: List[str], raw: bool = False) -> List[Optional[Dataset]]:
+        parse_obj = _raw if raw else self._parse_obj
+        datasets = {}
+        async for item in self._collection_dataset.find(_uids_query(uids), {'_id': 0}):
+            datasets[item['uid']] = parse_obj(Dataset, item)
+        return [datasets.get(uid) for uid in uids]
+
+    async def find_datasets(
+        self,
+        uris: List[str] = None,
+        tags: List[str] = None,
+        project: str = None,
+        event_id: str = None,
+        min_confidence: float = None,
+        max_confidence: float = None,
+        untagged: bool = None,
+        offset=0,
+        limit=10,
+        cursor: str = None,
+        fields: List[str] = None,
+        raw: bool = False
+            ) -> AsyncIterator[Dataset]:
+        query = _dataset_query(uris, tags, project, event_id, min_confidence, max_confidence, untagged)
+        projection = _dataset_projection(fields)
+        model = Dataset if projection is None else PartialDataset
+        parse_obj = _raw if raw else self._parse_obj
+        find = _find_spec(query, offset, limit, cursor, projection)
+        items = _find(self._collection_dataset, find)
+        if self._slow_query_log is None:
+            async for item in items:
+                TagService._clean_mongo_ids(item)
+                yield parse_obj(model, item)
+            return
+        elapsed = [0.0]
+        try:
+            async for item in _atimed(items, elapsed):
+                TagService._clean_mongo_ids(item)
+                yield parse_obj(model, item)
+        finally:
+            if self._slow_query_log.is_slow(elapsed[0]):
+                self._log_slow_query(find, elapsed[0])
+
+
+def _parse_obj(model, data: dict):
+    return model.parse_obj(data)
+
+
+def _raw(model, data: dict):
+    return data
+
+
+def _make_caches(cache_size: int, cache_ttl: float):
+    if not cache_size:
+        return None, None
+    return TTLCache(cache_size, cache_ttl), TTLCache(cache_size, cache_ttl)
+
+
+def _cache_stats(tag_source_cache: TTLCache, tagging_event_cache: TTLCache) -> dict:
+    if tag_source_cache is None:
+        return {}
+    return {'tag_sources': tag_source_cache.stats(), 'tagging_events': tagging_event_cache.stats()}
+
+
+def _uids_query(uids: List[str]) -> dict:
+    return {'uid': {'$in': list(dict.fromkeys(uids))}}
+
+
+def _cached_events(cache: TTLCache, uids: List[str]) -> dict:
+    events = {}
+    if cache is not None:
+        for uid in set(uids):
+            event = cache.get(uid)
+            if event is not None:
+                events[uid] = event.copy()
+    return events
+
+
+def _cache_events(cache: TTLCache, events: dict, uids: List[str]):
+    if cache is not None:
+        for uid in uids:
+            if uid in events:
+                cache[uid] = events[uid].copy()
+
+
+def _filters_key(search_filters) -> str:
+    # filter values can be unhashable query operators, the sorted json is a stable key
+    return json.dumps(search_filters, sort_keys=True, default=str)
+
+
+def _prepare_datasets(datasets: List[Dataset], new_uid: Callable[[], str]) -> List[dict]:
+    # Assign new UIDs to dataset and tags
+    datasets_dict = []
+    for dataset in datasets:
+        dataset.uid = new_uid()
+        if dataset.tags is not None:
+            for i in range(len(dataset.tags)):
+                dataset.tags[i].uid = new_uid()
+        datasets_dict.append(dataset.dict())
+    return datasets_dict
+
+
+def _chunks(items: Iterable, chunk_size: int) -> Iterator[list]:
+    items = iter(items)
+    chunk = list(itertools.islice(items, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(items, chunk_size))
+
+
+async def _achunks(items, chunk_size: int) -> AsyncIterator[list]:
+    if not hasattr(items, '__aiter__'):
+        for chunk in _chunks(items, chunk_size):
+            yield chunk
+        return
+    chunk = []
+    async for item in items:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _validate_chunk(chunk: list, start: int, new_uid: Callable[[], str]):
+    results = []
+    docs = []
+    doc_results = []
+    for index, item in enumerate(chunk, start):
+        result = DatasetIngestResult(index=index)
+        if isinstance(item, Exception):
+            # a record the stream could not read, such as an ndjson line that is too long
+            result.error = str(item)
+            results.append(result)
+            continue
+        try:
+            if isinstance(item, (str, bytes)):
+                dataset = Dataset.parse_raw(item)
+            else:
+                dataset = Dataset.parse_obj(item)
+        except ValidationError as e:
+            result.error = str(e)
+        else:
+            doc = _prepare_datasets([dataset], new_uid)[0]
+            # checked here, the insert of a chunk would fail whole on a document it cannot send
+            result.error = _document_error(doc)
+            if result.error is None:
+                result.uid = doc['uid']
+                docs.append(doc)
+                doc_results.append(result)
+        results.append(result)
+    return results, docs, doc_results
+
+
+def _document_error(doc: dict) -> Optional[str]:
+    try:
+        size = len(bson.encode(doc))
+    except InvalidDocument as e:
+        return str(e)
+    if size > MAX_DOCUMENT_SIZE:
+        return f"the dataset is {size} bytes, more than the {MAX_DOCUMENT_SIZE} bytes of a document"
+    return None
+
+
+def _report_write_errors(doc_results: List[DatasetIngestResult], error: BulkWriteError):
+    # writeErrors index into the documents of the failed insert_many
+    for write_error in error.details.get('writeErrors', []):
+        result = doc_results[write_error['index']]
+        result.uid = None
+        result.error = write_error.get('errmsg')
+
+
+def _dataset_key(doc: dict) -> Tuple[Optional[str], str]:
+    return doc.get('project'), doc['uri']
+
+
+def _merged_tags(tags: List[dict]) -> dict:
+    """The tags of a dataset in an update pipeline, without those that have the name and
+    event_id of one of tags, followed by tags"""
+    # a tag is kept when it differs from every new tag, there is no $not in a $filter of mongomock
+    kept = {'$and': [{'$or': [{'$ne': ['$$tag.name', {'$literal': tag['name']}]},
+                              {'$ne': [{'$ifNull': ['$$tag.event_id', None]}, {'$literal': tag.get('event_id')}]}]}
+                     for tag in tags]}
+    existing = {'$ifNull': ['$tags', []]}
+    if tags:
+        existing = {'$filter': {'input': existing, 'as': 'tag', 'cond': kept}}
+    return {'$concatArrays': [existing, {'$literal': tags}]}
+
+
+def _upsert_operation(doc: dict, mode: IngestMode) -> UpdateOne:
+    key = {'project': doc.get('project'), 'uri': doc['uri']}
+    fields = {k: v for k, v in doc.items() if k != 'uid'}
+    if mode == IngestMode.replace:
+        return UpdateOne(key, {'$set': fields, '$setOnInsert': {'uid': doc['uid']}}, upsert=True)
+    tags = fields.pop('tags')
+    update = {k: {'$literal': v} for k, v in fields.items()}
+    # an existing dataset keeps its uid
+    update['uid'] = {'$ifNull': ['$uid', {'$literal': doc['uid']}]}
+    if tags is not None:
+        update['tags'] = _merged_tags(tags)
+    return UpdateOne(key, [{'$set': update}], upsert=True)
+
+
+def _upsert_rounds(docs: List[dict], doc_results: List[DatasetIngestResult], mode: IngestMode):
+    """Operations of unordered bulk writes that upsert docs, with the result of each
+    operation. A key is upserted once per round, so repeats apply in order"""
+    rounds = []
+    for doc, result in zip(docs, doc_results):
+        if doc.get('uri') is None:
+            result.uid = None
+            result.error = "a dataset needs a uri to be upserted"
+            continue
+        key = _dataset_key(doc)
+        for round_keys, operations, results in rounds:
+            if key not in round_keys:
+                break
+        else:
+            round_keys, operations, results = set(), [], []
+            rounds.append((round_keys, operations, results))
+        round_keys.add(key)
+        operations.append(_upsert_operation(doc, mode))
+        results.append(result)
+    return [(operations, results) for _, operations, results in rounds]
+
+
+def _upserted_query(docs: List[dict], with_tags: bool) -> Tuple[dict, dict]:
+    keys = {_dataset_key(doc) for doc in docs if doc.get('uri') is not None}
+    if not keys:
+        return {}, {}
+    projection = {'_id': 0, 'uid': 1, 'project': 1, 'uri': 1}
+    if with_tags:
+        projection['tags'] = 1
+    return {'$or': [{'project': project, 'uri': uri} for project, uri in keys]}, projection
+
+
+def _report_upserted(docs: List[dict], doc_results: List[DatasetIngestResult], upserted: List[dict]):
+    uids = {_dataset_key(dataset): dataset['uid'] for dataset in upserted}
+    for doc, result in zip(docs, doc_results):
+        if result.error is None:
+            result.uid = uids.get(_dataset_key(doc))
+
+
+def _upserted_occurrence_query(upserted: List[dict]) -> dict:
+    return {'dataset_uid': {'$in': [dataset['uid'] for dataset in upserted]}}
+
+
+def _prepare_tags(tags, new_uid: Callable[[], str]) -> Tuple[List[str], List[dict]]:
+    # Assign UIDs to tags
+    tags_uid = []
+    tags_dict = []
+    for tag in tags:
+        tag.uid = new_uid()
+        tags_uid.append(tag.uid)
+        tags_dict.append(tag.dict())
+    return tags_uid, tags_dict
+
+
+def _modify_tags_update(req: TagPatchRequest, new_uid: Callable[[], str]) -> Tuple[List[str], List[dict]]:
+    # Aggregation pipeline update: null tags become [], removed uids are filtered out, new tags are appended
+    tags = {'$ifNull': ['$tags', []]}
+    if req.remove_tags:
+        removed = {'$in': ['$$tag.uid', {'$literal': req.remove_tags}]}
+        tags = {'$filter': {'input': tags, 'as': 'tag', 'cond': {'$not': removed}}}
+    added_tags_uid = []
+    if req.add_tags:
+        added_tags_uid, tags2add_dict = _prepare_tags(req.add_tags, new_uid)
+        # $literal keeps user values that start with $ from being read as expressions
+        tags = {'$concatArrays': [tags, {'$literal': tags2add_dict}]}
+    return added_tags_uid, [{'$set': {'tags': tags}}]
+
+
+def _reconcile_removed_tags(dataset, tags2remove) -> List[str]:
+    # tag UIDs that were not in the dataset before the update are reported as "-1"
+    current_tags_uids = {current_tag.get('uid') for current_tag in dataset.get('tags') or []}
+    return [tag_uid if tag_uid in current_tags_uids else '-1' for tag_uid in tags2remove]
+
+
+def _tags_bulk_query(reqs: List[DatasetTagPatchRequest]):
+    dataset_uids = list({req.dataset_uid for req in reqs})
+    return {'uid': {'$in': dataset_uids}}, {'uid': 1, 'tags.uid': 1}
+
+
+def _plan_tags_bulk(reqs: List[DatasetTagPatchRequest], datasets, new_uid: Callable[[], str]):
+    current_tags_uids = {}
+    null_tags = set()
+    for dataset in datasets:
+        if isinstance(dataset.get('tags'), list):
+            current_tags_uids[dataset['uid']] = {tag['uid'] for tag in dataset['tags']}
+        else:
+            current_tags_uids[dataset['uid']] = set()
+            null_tags.add(dataset['uid'])
+
+    results = []
+    tags2add_dict = {}
+    tags2remove = {}
+    for req in reqs:
+        dataset_uid = req.dataset_uid
+        if dataset_uid not in current_tags_uids:
+            results.append((dataset_uid, None, None))
+            continue
+        added_tags_uid, tags_dict = _prepare_tags(req.add_tags or [], new_uid)
+        tags2add_dict.setdefault(dataset_uid, []).extend(tags_dict)
+        removed_tags_uid = []
+        for tag_uid in req.remove_tags or []:
+            if tag_uid in current_tags_uids[dataset_uid]:
+                current_tags_uids[dataset_uid].discard(tag_uid)
+                tags2remove.setdefault(dataset_uid, []).append(tag_uid)
+                removed_tags_uid.append(tag_uid)
+            else:
+                removed_tags_uid.append('-1')
+        results.append((dataset_uid, added_tags_uid, removed_tags_uid))
+
+    # Requests for the same dataset are merged, so the unordered writes never depend on each other
+    operations = []
+    for dataset_uid, tags in tags2add_dict.items():
+        if not tags:
+            continue
+        if dataset_uid in null_tags:
+            # a pipeline, so that tags added since the dataset was read are kept
+            tags = {'$concatArrays': [{'$ifNull': ['$tags', []]}, {'$literal': tags}]}
+            operations.append(UpdateOne({'uid': dataset_uid}, [{'$set': {'tags': tags}}]))
+        else:
+            operations.append(UpdateOne({'uid': dataset_uid}, {'$push': {'tags': {'$each': tags}}}))
+    for dataset_uid, tag_uids in tags2remove.items():
+        operations.append(UpdateOne({'uid': dataset_uid}, {'$pull': {'tags': {'uid': {'$in': tag_uids}}}}))
+    return results, operations
+
+
+def _filters_query(search_filters) -> dict:
+    subqueries = []
+    query = {}
+    for k, v in search_filters.items():
+        subqueries.append({k: v})
+    if len(subqueries) > 0:
+        query = {"$and": subqueries}
+    return query
+
+
+def _tagging_event_query(tagger_id: str = None) -> dict:
+    query = {}
+    if tagger_id:
+        query['tagger_id'] = tagger_id
+    return query
+
+
+def _dataset_query(
+    uris: List[str] = None,
+    tags: List[str] = None,
+    project: str = None,
+    event_id: str = None,
+    min_confidence: float = None,
+    max_confidence: float = None,
+    untagged: bool = None
+        ) -> dict:
+    subqueries = []
+    query = {}
+    confidence = {}
+    if min_confidence is not None:
+        confidence["$gte"] = min_confidence
+    if max_confidence is not None:
+        confidence["$lte"] = max_confidence
+
+    if confidence:
+        # name and confidence must hold for the same tag
+        tag_query = {"confidence": confidence}
+        if tags:
+            tag_query = {"name": {"$in": tags}, **tag_query}
+        subqueries.append(
+            {"tags": {"$elemMatch": tag_query}})
+    elif tags:
+        subqueries.append(
+            {"tags.name": {"$in": tags}})
+
+    if untagged is not None:
+        # matches a missing or null tags field as well as an empty list
+        subqueries.append(
+            {"tags.0": {"$exists": not untagged}})
+
+    if uris:
+        subqueries.append(
+            {"uri": {"$in": uris}}
+        )
+
+    if project:
+        subqueries.append(
+            {"project": project}
+        )
+
+    if event_id:
+        subqueries.append(
+            {"tags.event_id": event_id}
+        )
+
+    if len(subqueries) > 0:
+        query = {"$and": subqueries}
+    return query
+
+
+def _tag_count_pipeline(names, project, event_id, by_event, by_project, confidence_bins) -> List[dict]:
+    pipeline = []
+    dataset_query = _dataset_query(tags=names, project=project, event_id=event_id)
+    if dataset_query:
+        pipeline.append({'$match': dataset_query})
+    pipeline.append({'$unwind': '$tags'})
+    # datasets matched on any of their tags, keep only the tags that match
+    tag_query = {}
+    if names:
+        tag_query['tags.name'] = {'$in': names}
+    if event_id:
+        tag_query['tags.event_id'] = event_id
+    if tag_query:
+        pipeline.append({'$match': tag_query})
+
+    key = {'name': '$tags.name'}
+    if by_event:
+        key['event_id'] = '$tags.event_id'
+    if by_project:
+        key['project'] = '$project'
+    if not confidence_bins:
+        pipeline.append({'$group': {'_id': key, 'count': {'$sum': 1}}})
+    else:
+        confidence = '$tags.confidence'
+        in_range = {'$and': [{'$gte': [confidence, 0]}, {'$lte': [confidence, 1]}]}
+        # a confidence of exactly 1 falls in the last bin
+        bin_index = {'$min': [{'$floor': {'$multiply': [confidence, confidence_bins]}}, confidence_bins - 1]}
+        pipeline.append({'$group': {'_id': dict(key, bin={'$cond': [in_range, bin_index, None]}),
+                                    'count': {'$sum': 1}}})
+        pipeline.append({'$group': {'_id': {k: f'$_id.{k}' for k in key},
+                                    'count': {'$sum': '$count'},
+                                    'bins': {'$push': {'bin': '$_id.bin', 'count': '$count'}}}})
+    pipeline.append({'$sort': {'_id.name': 1, '_id.project': 1, '_id.event_id': 1}})
+    return pipeline
+
+
+def _tag_count(group: dict, confidence_bins: int = None) -> TagCount:
+    tag_count = TagCount(count=group['count'], **group['_id'])
+    if confidence_bins:
+        tag_count.confidence_histogram = [0] * confidence_bins
+        for confidence_bin in group['bins']:
+            if confidence_bin['bin'] is not None:
+                tag_count.confidence_histogram[int(confidence_bin['bin'])] = confidence_bin['count']
+    return tag_count
+
+
+# the DatasetCollection fields of a split, without the models
+_SPLIT_PROJECTION = {'_id': 0, 'name': 1, 'assets': 1}
+
+
+def _check_ratios(ratios: Dict[str, float]):
+    if not ratios:
+        raise ValueError("at least one split ratio is needed")
+    if any(ratio < 0 for ratio in ratios.values()) or sum(ratios.values()) <= 0:
+        raise ValueError("split ratios must not be negative and must not all be 0")
+
+
+def _split_pipeline(tags, project, event_id, min_confidence, max_confidence) -> List[dict]:
+    """Stages that project the uid and stratum of every dataset to split"""
+    pipeline = []
+    dataset_query = _dataset_query(tags=tags, project=project, event_id=event_id,
+                                   min_confidence=min_confidence, max_confidence=max_confidence)
+    if dataset_query:
+        pipeline.append({'$match': dataset_query})
+    # the tags that the filters select, the same way count_tags does
+    conditions = []
+    if tags:
+        conditions.append({'$in': ['$$tag.name', {'$literal': tags}]})
+    if event_id:
+        conditions.append({'$eq': ['$$tag.event_id', {'$literal': event_id}]})
+    if min_confidence is not None:
+        conditions.append({'$gte': ['$$tag.confidence', min_confidence]})
+    if max_confidence is not None:
+        conditions.append({'$lte': ['$$tag.confidence', max_confidence]})
+    selected = {'$ifNull': ['$tags', []]}
+    if conditions:
+        selected = {'$filter': {'input': selected, 'as': 'tag', 'cond': {'$and': conditions}}}
+    # the first selected tag of highest confidence
+    highest = {'$eq': ['$$tag.confidence', {'$max': '$$selected.confidence'}]}
+    best = {'$arrayElemAt': [{'$filter': {'input': '$$selected', 'as': 'tag', 'cond': highest}}, 0]}
+    stratum = {'$let': {'vars': {'best': {'$let': {'vars': {'selected': selected}, 'in': best}}},
+                        'in': '$$best.name'}}
+    pipeline.append({'$project': {'_id': 0, 'uid': 1, 'stratum': stratum}})
+    return pipeline
+
+
+def split_of(uid: str, splits: Sequence[Tuple[str, float]]) -> str:
+    """The split of a dataset. Fractions are relative to their sum"""
+    # position of the uid in [0, 1), the same on every run and machine
+    position = int(hashlib.sha1(uid.encode('utf-8')).hexdigest()[:15], 16) / 16 ** 15
+    total = sum(fraction for _, fraction in splits)
+    bound = 0.0
+    for name, fraction in splits:
+        bound += fraction / total
+        if position < bound:
+            return name
+    return splits[-1][0]
+
+
+class _Splitter():
+    """Assigns the rows of a split pipeline to splits with split_of, and gathers the
+    uids of each split into DatasetCollection documents
+    """
+
+    def __init__(self, ratios: Dict[str, float], split_uid: str, new_uid: Callable[[], str], chunk_size: int):
+        self._ratios = ratios
+        self._splits = list(ratios.items())
+        self._split_uid = split_uid
+        self._new_uid = new_uid
+        self._chunk_size = chunk_size
+        self._assets = {name: [] for name in ratios}
+        self._counts = {name: {} for name in ratios}
+
+    def add(self, row: dict) -> List[dict]:
+        """Assigns a dataset, returns the records that are full"""
+        name = split_of(row['uid'], self._splits)
+        stratum_name = row.get('stratum') or ''
+        self._counts[name][stratum_name] = self._counts[name].get(stratum_name, 0) + 1
+        assets = self._assets[name]
+        assets.append(row['uid'])
+        if len(assets) < self._chunk_size:
+            return []
+        self._assets[name] = []
+        return [self._record(name, assets)]
+
+    def flush(self) -> List[dict]:
+        """The records of the remaining datasets"""
+        records = [self._record(name, assets) for name, assets in self._assets.items() if assets]
+        self._assets = {name: [] for name in self._ratios}
+        return records
+
+    def split(self) -> DatasetSplit:
+        return DatasetSplit(uid=self._split_uid, counts=self._counts)
+
+    def _record(self, name: str, assets: List[str]) -> dict:
+        return DatasetCollection(uid=self._new_uid(), assets=assets, name=name, split_uid=self._split_uid).dict()
+
+
+def _split_query(uid: str, name: str = None) -> dict:
+    query = {'split_uid': uid}
+    if name is not None:
+        query['name'] = name
+    return query
+
+
+def _split_assets(records: Iterable[dict]) -> Dict[str, List[str]]:
+    assets = {}
+    for record in records:
+        assets.setdefault(record['name'], []).extend(record['assets'])
+    return assets
+
+
+def _occurrence_writes(dataset_uid: str, tags: Iterable[dict]) -> list:
+    return [ReplaceOne({'_id': tag['uid']},
+                       {'dataset_uid': dataset_uid, 'name': tag['name'], 'confidence': tag.get('confidence'),
+                        'event_id': tag.get('event_id')},
+                       upsert=True)
+            for tag in tags]
+
+
+def _dataset_occurrence_writes(datasets: Iterable[dict]) -> list:
+    writes = []
+    for dataset in datasets:
+        writes.extend(_occurrence_writes(dataset['uid'], dataset.get('tags') or []))
+    return writes
+
+
+def _ingested_occurrence_writes(docs: List[dict], doc_results: List[DatasetIngestResult]) -> list:
+    return _dataset_occurrence_writes(doc for doc, result in zip(docs, doc_results) if result.error is None)
+
+
+def _tag_patch_occurrence_writes(patches: Iterable[Tuple[str, TagPatchRequest, List[str]]]) -> list:
+    # the tags added by each request have been given their uids by now
+    writes = []
+    removed = []
+    for dataset_uid, req, removed_tags_uid in patches:
+        if removed_tags_uid is None:
+            continue
+        writes.extend(_occurrence_writes(dataset_uid, (tag.dict() for tag in req.add_tags or [])))
+        removed.extend(uid for uid in removed_tags_uid if uid != '-1')
+    if removed:
+        writes.append(DeleteMany({'_id': {'$in': removed}}))
+    return writes
+
+
+def _occurrence_query(names, event_id, min_confidence, max_confidence) -> dict:
+    query = {}
+    if names:
+        query['name'] = {'$in': names}
+    if event_id:
+        query['event_id'] = event_id
+    confidence = {}
+    if min_confidence is not None:
+        confidence['$gte'] = min_confidence
+    if max_confidence is not None:
+        confidence['$lte'] = max_confidence
+    if confidence:
+        query['confidence'] = confidence
+    return query
+
+
+def _occurrence(item: dict) -> TagOccurrence:
+    item['uid'] = item.pop('_id')
+    return TagOccurrence.parse_obj(item)
+
+
+def _dataset_projection(fields: List[str] = None) -> Optional[dict]:
+    if not fields:
+        return None
+    fields = [getattr(field, 'value', field) for field in fields]
+    unknown = set(fields) - set(PartialDataset.__fields__)
+    if unknown:
+        raise InvalidFields(f"unknown dataset fields: {', '.join(sorted(unknown))}")
+    projection = {'_id': 0, 'uid': 1}
+    projection.update((field, 1) for field in fields)
+    return projection
+
+
+def _find_spec(query, offset, limit, cursor, projection=None) -> dict:
+    # the arguments of a find command, to run it or explain it
+    find = {'filter': query, 'limit': limit}
+    if projection is not None:
+        find['projection'] = projection
+    if cursor is None:
+        find['skip'] = offset
+        return find
+    # keyset paging on the unique uid index, nothing is skipped server side
+    after_uid = decode_cursor(cursor)
+    if after_uid is not None:
+        uid_query = {"uid": {"$gt": after_uid}}
+        find['filter'] = {"$and": [query, uid_query]} if query else uid_query
+    find['sort'] = {'uid': 1}
+    return find
+
+
+def _find(collection, find: dict):
+    # works with pymongo and motor collections alike, both build cursors without I/O
+    items = collection.find(find['filter'], find.get('projection'))
+    if 'sort' in find:
+        items = items.sort(list(find['sort'].items()))
+    return items.skip(find.get('skip', 0)).limit(find['limit'])
+
+
+def _paged_find(collection, query, offset, limit, cursor, projection=None):
+    return _find(collection, _find_spec(query, offset, limit, cursor, projection))
+
+
+def _timed(items: Iterable, elapsed: list) -> Iterator:
+    # adds the time spent waiting for each item to elapsed[0], not the time the consumer holds it
+    items = iter(items)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(items)
+        except StopIteration:
+            return
+        finally:
+            elapsed[0] += time.perf_counter() - start
+        yield item
+
+
+async def _atimed(items, elapsed: list) -> AsyncIterator:
+    items = items.__aiter__()
+    while True:
+        start = time.perf_counter()
+        try:
+            item = await items.__anext__()
+        except StopAsyncIteration:
+            return
+        finally:
+            elapsed[0] += time.perf_counter() - start
+        yield item
+
+
 # class Context():
 #     db: MongoClient = None
 #     tag_svc: TagService = None
@@ -1,25 +1,37 @@
+import asyncio
+
 from fastapi.testclient import TestClient
 import pytest
 import mongomock
+from mongomock_motor import AsyncMongoMockClient
 
 from tagging.api import app, set_tag_service
-from tagging.tag_service import TagService
+from tagging.tag_service import AsyncTagService, TagService
 from tagging.graphql import set_gql_tag_service
 
 
 @pytest.fixture(scope="module")
 def mongodb():
-    return mongomock.MongoClient().db
+    return mongomock.MongoClient()
 
 
 @pytest.fixture(scope="module")
 def tag_svc(mongodb):
     tag_svc = TagService(mongodb)
+    tag_svc.create_indexes()
     return tag_svc
 
 
 @pytest.fixture(scope="module")
-def rest_client(tag_svc):
-    set_tag_service(tag_svc)
-    set_gql_tag_service(tag_svc)
+def async_tag_svc(mongodb):
+    # shares the mongomock databases of tag_svc
+    async_tag_svc = AsyncTagService(AsyncMongoMockClient(mock_mongo_client=mongodb))
+    asyncio.run(async_tag_svc.create_indexes())
+    return async_tag_svc
+
+
+@pytest.fixture(scope="module")
+def rest_client(async_tag_svc):
+    set_tag_service(async_tag_svc)
+    set_gql_tag_service(async_tag_svc)
     return TestClient(app)
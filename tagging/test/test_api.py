@@ -1,6 +1,9 @@
+import asyncio
+import json
+
 from fastapi.testclient import TestClient
 
-from ..api import API_URL_PREFIX
+from ..api import API_URL_PREFIX, GRAPHQL_URL, NEXT_CURSOR_HEADER, ndjson_records
 
 from ..model import (
     Dataset,
@@ -8,6 +11,7 @@ from ..model import (
     TagSource,
     TagPatchRequest
 )
+from ..tag_service import split_of
 
 
 def test_taggers(rest_client: TestClient):
@@ -89,6 +93,155 @@ def test_skip_limit(rest_client: TestClient):
     assert len(source) == 1
 
 
+def test_cursor_pagination(rest_client: TestClient):
+    response = rest_client.post(API_URL_PREFIX + "/datasets", json=[dataset, dataset2, dataset3])
+    assert response.status_code == 200
+    total = len(rest_client.get(API_URL_PREFIX + "/datasets", params={"page[limit]": 0}).json())
+
+    uids = []
+    cursor = ""
+    while cursor is not None:
+        response = rest_client.get(
+            API_URL_PREFIX + "/datasets",
+            params={"page[cursor]": cursor, "page[limit]": 2})
+        assert response.status_code == 200, f"oops {response.text}"
+        page = response.json()
+        assert len(page) <= 2
+        uids += [item['uid'] for item in page]
+        cursor = response.headers.get(NEXT_CURSOR_HEADER)
+    assert len(uids) == total
+    assert uids == sorted(set(uids)), "cursor pages are ordered by uid and never overlap"
+
+    response = rest_client.get(API_URL_PREFIX + "/datasets", params={"page[cursor]": "!!"})
+    assert response.status_code == 400
+
+
+def test_search_fields(rest_client: TestClient):
+    response = rest_client.post(API_URL_PREFIX + "/datasets", json=[dataset])
+    assert response.status_code == 200
+
+    response = rest_client.get(API_URL_PREFIX + "/datasets", params={"uris": ["/foo/bar.h5"], "fields": ["uri"]})
+    assert response.status_code == 200, f"oops {response.text}"
+    assert response.json() and all(item.keys() == {"uid", "uri"} for item in response.json())
+
+    response = rest_client.post(
+        API_URL_PREFIX + "/datasets/search",
+        json={"uris": ["/foo/bar.h5"], "fields": ["type", "tags"]})
+    assert response.status_code == 200, f"oops {response.text}"
+    assert all(item.keys() == {"uid", "type", "tags"} for item in response.json())
+
+    response = rest_client.post(API_URL_PREFIX + "/datasets/search", json={"fields": ["locator"]})
+    assert response.status_code == 422
+
+    response = rest_client.get(API_URL_PREFIX + "/datasets", params={"page[limit]": 1})
+    assert "schema_version" in response.json()[0], "all fields without a projection"
+
+
+def test_modify_tags_bulk(rest_client: TestClient):
+    response = rest_client.post(API_URL_PREFIX + "/datasets", json=[dataset, dataset2])
+    uids = [item['uid'] for item in response.json()]
+    reqs = [{"dataset_uid": uid, "add_tags": [{"name": "bulk"}]} for uid in uids]
+    response = rest_client.patch(API_URL_PREFIX + "/datasets/tags", json=reqs)
+    assert response.status_code == 200, f"oops {response.text}"
+    results = response.json()
+    assert [result['dataset_uid'] for result in results] == uids
+    assert all(len(result['added_tags_uid']) == 1 for result in results)
+
+
+def test_ingest_datasets(rest_client: TestClient):
+    lines = [json.dumps(dataset), json.dumps(dataset2), "", "{not json", json.dumps(dataset3)]
+    response = rest_client.post(
+        API_URL_PREFIX + "/datasets/ingest",
+        params={"chunk_size": 2},
+        content="\n".join(lines).encode(),
+        headers={"content-type": "application/x-ndjson"})
+    assert response.status_code == 200, f"oops {response.text}"
+    assert response.json()['created'] == 3
+    assert [error['index'] for error in response.json()['errors']] == [2]
+
+    # merged on project and uri when sent again
+    upsert_lines = "\n".join([json.dumps(dict(dataset, project="upsert"))] * 2).encode()
+    for _ in range(2):
+        response = rest_client.post(API_URL_PREFIX + "/datasets/ingest", params={"mode": "merge"},
+                                    content=upsert_lines, headers={"content-type": "application/x-ndjson"})
+        assert response.status_code == 200, f"oops {response.text}"
+        assert response.json()['created'] == 2
+    response = rest_client.post(API_URL_PREFIX + "/datasets/search", json={"project": "upsert"})
+    assert len(response.json()) == 1
+
+
+def test_ndjson_records(rest_client: TestClient, monkeypatch):
+    async def records(chunks, max_line_size):
+        async def stream():
+            for chunk in chunks:
+                yield chunk
+        return [record async for record in ndjson_records(stream(), max_line_size)]
+
+    chunks = [b'{"a"', b': 1}\n\n{"b": 2', b'}\n' + b'x' * 6, b'x' * 6, b'\n{"c": 3}']
+    lines = asyncio.run(records(chunks, 10))
+    assert lines[:2] == [b'{"a": 1}', b'{"b": 2}'] and lines[3] == b'{"c": 3}'
+    assert isinstance(lines[2], ValueError), "the line of 12 bytes is skipped"
+    assert asyncio.run(records([b"x" * 11 + b"\n{}"], 10))[1:] == [b"{}"]
+
+    monkeypatch.setattr("tagging.api.MAX_NDJSON_LINE_SIZE", len(json.dumps(dataset)))
+    lines = [json.dumps(dataset), json.dumps(dict(dataset, uri="a much longer uri than the others"))]
+    response = rest_client.post(API_URL_PREFIX + "/datasets/ingest", content="\n".join(lines).encode(),
+                                headers={"content-type": "application/x-ndjson"})
+    assert response.status_code == 200, f"oops {response.text}"
+    assert response.json()['created'] == 1
+    assert [error['index'] for error in response.json()['errors']] == [1]
+
+
+def test_export_datasets(rest_client: TestClient):
+    response = rest_client.post(API_URL_PREFIX + "/datasets", json=[dataset, dataset2])
+    assert response.status_code == 200
+    expected = rest_client.get(API_URL_PREFIX + "/datasets", params={"uris": ["/foo/bar.h5"], "page[limit]": 0})
+
+    response = rest_client.post(API_URL_PREFIX + "/datasets/export", json={'uris': ['/foo/bar.h5']})
+    assert response.status_code == 200, f"oops {response.text}"
+    assert response.headers['content-type'].startswith("application/x-ndjson")
+    exported = [json.loads(line) for line in response.text.splitlines()]
+    assert len(exported) > 1, "export is not paged"
+    assert exported == expected.json()
+
+
+def test_validated_reads(rest_client: TestClient, monkeypatch):
+    rest_client.post(API_URL_PREFIX + "/datasets", json=[dataset, dataset3])
+    searches = [{"params": {"page[limit]": 0}},
+                {"params": {"fields": ["tags"], "page[limit]": 2, "page[cursor]": ""}}]
+    fast = [rest_client.get(API_URL_PREFIX + "/datasets", **search) for search in searches]
+    monkeypatch.setattr("tagging.api.SPLASH_VALIDATE_READS", True)
+    validated = [rest_client.get(API_URL_PREFIX + "/datasets", **search) for search in searches]
+    for fast_response, validated_response in zip(fast, validated):
+        assert fast_response.json() == validated_response.json()
+        assert fast_response.headers.get(NEXT_CURSOR_HEADER) == validated_response.headers.get(NEXT_CURSOR_HEADER)
+    assert fast[1].headers.get(NEXT_CURSOR_HEADER)
+
+
+def test_batch_get(rest_client: TestClient, monkeypatch):
+    response = rest_client.post(API_URL_PREFIX + "/datasets", json=[dataset, dataset2])
+    uids = [item["uid"] for item in response.json()]
+    response = rest_client.post(API_URL_PREFIX + "/events",
+                                json={"tagger_id": "batch", "run_time": "2021-01-01T00:00:00"})
+    event_uid = response.json()["uid"]
+
+    requested = [uids[1], "nope", uids[0], uids[1]]
+    fast = rest_client.post(API_URL_PREFIX + "/datasets/get", json=requested)
+    assert fast.status_code == 200, f"oops {fast.text}"
+    assert [(result["uid"], result["found"]) for result in fast.json()] == [
+        (uids[1], True), ("nope", False), (uids[0], True), (uids[1], True)]
+    assert fast.json()[0]["dataset"]["uri"] == dataset2["uri"] and "dataset" not in fast.json()[1]
+    monkeypatch.setattr("tagging.api.SPLASH_VALIDATE_READS", True)
+    assert rest_client.post(API_URL_PREFIX + "/datasets/get", json=requested).json() == fast.json()
+
+    response = rest_client.post(API_URL_PREFIX + "/events/get", json=["nope", event_uid])
+    assert response.status_code == 200, f"oops {response.text}"
+    assert [(result["uid"], result["found"]) for result in response.json()] == [("nope", False), (event_uid, True)]
+    assert response.json()[1]["event"]["tagger_id"] == "batch"
+    response = rest_client.post(API_URL_PREFIX + "/events/get", json=["nope"] * 1001)
+    assert response.status_code == 400
+
+
 tag_source_1_dict = {
     "type": "model",
     "name": "deep thought",
@@ -126,3 +279,78 @@ dataset3 = {
         {"name": "label", "value": "rings", "confidence": 0.2, "event_id": "67891"},
     ]
 }
+
+
+def test_count_tags(rest_client: TestClient):
+    response = rest_client.post(API_URL_PREFIX + "/datasets", json=[dataset])
+    assert response.status_code == 200
+
+    response = rest_client.get(API_URL_PREFIX + "/tags/counts", params={"confidence_bins": 4, "by_event": True})
+    assert response.status_code == 200, f"oops {response.text}"
+    counts = response.json()
+    assert counts and all(len(count["confidence_histogram"]) == 4 for count in counts)
+    assert all(sum(count["confidence_histogram"]) <= count["count"] for count in counts)
+
+    response = rest_client.get(API_URL_PREFIX + "/tags/counts", params={"confidence_bins": 0})
+    assert response.status_code == 422
+
+
+def test_search_confidence_range(rest_client: TestClient):
+    response = rest_client.post(API_URL_PREFIX + "/datasets", json=[dataset])
+    assert response.status_code == 200
+
+    response = rest_client.post(
+        API_URL_PREFIX + "/datasets/search",
+        json={"uris": ["/foo/bar.h5"], "tags": ["label"], "min_confidence": 0.5})
+    assert response.status_code == 200, f"oops {response.text}"
+    assert response.json() and all(
+        any(tag["name"] == "label" and tag["confidence"] >= 0.5 for tag in item["tags"])
+        for item in response.json())
+
+    response = rest_client.post(API_URL_PREFIX + "/datasets/search", json={"untagged": True})
+    assert response.status_code == 200, f"oops {response.text}"
+    assert all(not item.get("tags") for item in response.json())
+
+    response = rest_client.post(GRAPHQL_URL, json={
+        "query": "{ datasets(tags: [\"label\"], minConfidence: 2.0) { uid } }"})
+    assert response.status_code == 200, f"oops {response.text}"
+    assert response.json()["data"]["datasets"] == []
+
+
+def test_slow_queries(rest_client: TestClient):
+    response = rest_client.get(API_URL_PREFIX + "/admin/slow_queries")
+    assert response.status_code == 200
+    assert response.json() == [], "the slow query log is off by default"
+
+
+def test_tag_occurrences_disabled(rest_client: TestClient):
+    response = rest_client.get(API_URL_PREFIX + "/tags/occurrences", params={"names": ["label"]})
+    assert response.status_code == 404
+
+
+def test_split_datasets(rest_client: TestClient):
+    split_dataset = dict(dataset, project="split")
+    response = rest_client.post(API_URL_PREFIX + "/datasets", json=[split_dataset, split_dataset])
+    assert response.status_code == 200
+
+    response = rest_client.post(API_URL_PREFIX + "/datasets/splits",
+                                json={"ratios": {"train": 0.5, "test": 0.5}, "project": "split"})
+    assert response.status_code == 200, f"oops {response.text}"
+    split = response.json()
+    assert sum(counts.get("label", 0) for counts in split["counts"].values()) == 2
+
+    response = rest_client.get(API_URL_PREFIX + f"/datasets/splits/{split['uid']}")
+    assert response.status_code == 200, f"oops {response.text}"
+    stored = response.json()
+    assert {name: len(uids) for name, uids in stored.items()} == \
+        {name: counts["label"] for name, counts in split["counts"].items() if counts}
+    splits = [("train", 0.5), ("test", 0.5)]
+    assert all(split_of(uid, splits) == name for name, uids in stored.items() for uid in uids)
+    name = next(iter(stored))
+    response = rest_client.get(API_URL_PREFIX + f"/datasets/splits/{split['uid']}", params={"name": name})
+    assert response.json() == {name: stored[name]}
+
+    response = rest_client.get(API_URL_PREFIX + "/datasets/splits/nope")
+    assert response.status_code == 404
+    response = rest_client.post(API_URL_PREFIX + "/datasets/splits", json={"ratios": {}})
+    assert response.status_code == 400
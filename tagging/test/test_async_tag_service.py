@@ -0,0 +1,63 @@
+import asyncio
+
+from ..tag_service import AsyncTagService, TagService
+from ..model import (
+    TagPatchRequest,
+    TaggingEvent
+)
+
+from .data import (
+    json_datetime,
+    new_dataset,
+    no_tag_dataset,
+    no_tag
+)
+
+
+def test_create_and_find_dataset(async_tag_svc: AsyncTagService, tag_svc: TagService):
+    async def create_and_find():
+        asset = [dataset async for dataset in async_tag_svc.create_datasets([new_dataset])][0]
+        found = [dataset async for dataset in async_tag_svc.find_datasets(tags=["rods"], limit=0)]
+        return asset, found, await async_tag_svc.retrieve_dataset(asset.uid)
+
+    asset, found, retrieved = asyncio.run(create_and_find())
+    assert asset.uid in [dataset.uid for dataset in found]
+    assert retrieved == asset
+    assert tag_svc.retrieve_dataset(asset.uid) == asset, "sync and async services share the database"
+
+
+def test_create_and_retrieve_tagging_event(async_tag_svc: AsyncTagService):
+    async def create_and_retrieve():
+        event = await async_tag_svc.create_tagging_event(
+            TaggingEvent(tagger_id="Zaphod", run_time=json_datetime(42)))
+        return event, await async_tag_svc.retrieve_tagging_event(event.uid)
+
+    event, retrieved = asyncio.run(create_and_retrieve())
+    assert retrieved.tagger_id == event.tagger_id == "Zaphod"
+
+
+def test_modify_tags(async_tag_svc: AsyncTagService):
+    async def modify():
+        dataset = [dataset async for dataset in async_tag_svc.create_datasets([no_tag_dataset])][0]
+        output = await async_tag_svc.modify_tags(TagPatchRequest(add_tags=[no_tag], remove_tags=["123"]),
+                                                 dataset.uid)
+        return output, await async_tag_svc.retrieve_dataset(dataset.uid)
+
+    (added_tags_uid, removed_tags_uid), updated_dataset = asyncio.run(modify())
+    assert [tag.uid for tag in updated_dataset.tags] == added_tags_uid
+    assert removed_tags_uid == ['-1']
+
+
+def test_ingest_datasets(async_tag_svc: AsyncTagService):
+    async def datasets():
+        for i in range(5):
+            yield {"type": "file", "uri": f"ingest/{i}"}
+        yield {"type": "not a type"}
+
+    async def ingest():
+        return [result async for result in async_tag_svc.ingest_datasets(datasets(), chunk_size=2)]
+
+    results = asyncio.run(ingest())
+    assert [result.index for result in results] == list(range(6))
+    assert [result.error is None for result in results] == [True] * 5 + [False]
+    assert asyncio.run(async_tag_svc.retrieve_dataset(results[4].uid)).uri == "ingest/4"
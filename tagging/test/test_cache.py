@@ -0,0 +1,47 @@
+import datetime
+
+import mongomock
+
+from ..cache import TTLCache
+from ..model import TagSource, TaggingEvent
+from ..tag_service import TagService
+
+
+class FakeTimer():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_ttl_cache_expires_and_evicts():
+    timer = FakeTimer()
+    cache = TTLCache(maxsize=2, ttl=10, timer=timer)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache.get('a') == 1
+    cache['c'] = 3  # evicts b, the least recently used
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+    timer.now = 11
+    assert cache.get('a') is None, "expired"
+    assert cache.stats() == {'hits': 2, 'misses': 2, 'size': 1, 'maxsize': 2}
+
+
+def test_service_cache():
+    tag_svc = TagService(mongomock.MongoClient(), cache_size=10)
+    event = tag_svc.create_tagging_event(TaggingEvent(tagger_id="Marvin", run_time=datetime.datetime.now()))
+    tag_svc._collection_tagging_event.delete_many({})
+    assert tag_svc.retrieve_tagging_event(event.uid) == event, "primed by create_tagging_event"
+
+    tag_svc.create_tag_source(TagSource(type="model", name="Eddie"))
+    assert [tag_source.name for tag_source in tag_svc.find_tag_sources(type="model")] == ["Eddie"]
+    assert [tag_source.name for tag_source in tag_svc.find_tag_sources(type="model")] == ["Eddie"]
+    tag_svc.create_tag_source(TagSource(type="model", name="Deep Thought"))
+    assert len(list(tag_svc.find_tag_sources(type="model"))) == 2, "creating a tag source invalidates searches"
+
+    stats = tag_svc.cache_stats()
+    assert stats['tagging_events']['hits'] == 1
+    assert stats['tag_sources'] == {'hits': 1, 'misses': 2, 'size': 1, 'maxsize': 10}
+    assert TagService(mongomock.MongoClient()).cache_stats() == {}
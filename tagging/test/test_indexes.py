@@ -0,0 +1,56 @@
+import mongomock
+
+from ..indexes import MANIFEST_COLLECTION, ensure_indexes, index_manifest, manifest_version
+from ..tag_service import TagService
+
+
+def text_indexes(db):
+    return [index["name"] for index in db.data_set.list_indexes()
+            if "text" in index["key"].values() or "_fts" in index["key"]]
+
+
+def test_ensure_indexes_once_per_version():
+    client = mongomock.MongoClient()
+    db = client.tagging
+    assert TagService(client).create_indexes()
+    assert db[MANIFEST_COLLECTION].find_one()["version"] == manifest_version(index_manifest())
+    assert text_indexes(db) == ["$**_text"]
+    assert not ensure_indexes(db, index_manifest()), "the manifest is current"
+
+    db.data_set.drop_index("uid_1")
+    assert not TagService(client).create_indexes()
+    assert "uid_1" not in db.data_set.index_information(), "workers do not rebuild a current manifest"
+    assert ensure_indexes(db, index_manifest(), force=True)
+    assert "uid_1" in db.data_set.index_information()
+
+    assert ensure_indexes(db, index_manifest(["uri", "tags.name"]))
+    assert text_indexes(db) == ["uri_text_tags.name_text"], "the old text index is replaced"
+    TagService(client, indexes=index_manifest([])).create_indexes()
+    assert text_indexes(db) == []
+
+
+def test_service_only_checks_indexes(caplog):
+    client = mongomock.MongoClient()
+    db = client.tagging
+    ensure_indexes(db, index_manifest(["uri"], unique_uris=True))
+    tag_svc = TagService(client)
+    assert not tag_svc.indexes_current()
+    assert "do not match" in caplog.text
+    assert text_indexes(db) == ["uri_text"], "a service with another manifest does not rebuild the deployed one"
+    assert db.data_set.index_information()["project_1_uri_1"]["unique"]
+
+
+def test_unique_uris():
+    db = mongomock.MongoClient().tagging
+    ensure_indexes(db, index_manifest())
+    assert not db.data_set.index_information()["project_1_uri_1"].get("unique")
+    ensure_indexes(db, index_manifest(unique_uris=True))
+    assert db.data_set.index_information()["project_1_uri_1"]["unique"], "rebuilt as unique"
+
+
+def test_text_index_position(monkeypatch):
+    from tagging import indexes
+
+    monkeypatch.setattr(indexes, "_INDEXES", [("tag_source", [("uid", 1)], {}), ("data_set", [("uid", 1)], {})])
+    manifest = indexes.index_manifest(["uri"])
+    assert [keys for _, keys, _ in manifest] == [[("uid", 1)], [("uri", "text")], [("uid", 1)]]
@@ -0,0 +1,57 @@
+from types import SimpleNamespace
+
+from fastapi.testclient import TestClient
+import mongomock
+
+from ..api import API_URL_PREFIX
+from ..metrics import Histogram, MongoCommandListener, render_metrics
+from .data import new_dataset
+
+
+def test_histogram_render():
+    histogram = Histogram("latency_seconds", "test latency", ("route",), buckets=(0.1, 1.0))
+    histogram.observe(0.05, "/a")
+    histogram.observe(0.5, "/a")
+    histogram.observe(5, 'say "hi"')
+    lines = histogram.render()
+    assert 'latency_seconds_bucket{route="/a",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{route="/a",le="1.0"} 2' in lines
+    assert 'latency_seconds_bucket{route="/a",le="+Inf"} 2' in lines
+    assert 'latency_seconds_count{route="say \\"hi\\""} 1' in lines
+
+
+def test_request_and_parse_timing(rest_client: TestClient):
+    # the metrics served by the fixture app live in the absolute tagging package
+    from tagging.api import app
+    from tagging.metrics import TimingMiddleware
+    from tagging.tag_service import TagService
+
+    client = TestClient(TimingMiddleware(app))
+    response = client.post(API_URL_PREFIX + "/events",
+                           json={"tagger_id": "timed", "run_time": "2021-01-01T00:00:00"})
+    assert response.status_code == 200, f"oops {response.text}"
+    response = client.get(API_URL_PREFIX + "/events/" + response.json()["uid"])
+    assert response.status_code == 200
+
+    tag_svc = TagService(mongomock.MongoClient(), instrument=True)
+    asset = next(tag_svc.create_datasets([new_dataset]))
+    tag_svc.retrieve_dataset(asset.uid)
+
+    response = rest_client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    text = response.text
+    labels = 'method="GET",route="/api/v0/events/{uid}",status="200"'
+    assert f'splash_ml_http_request_duration_seconds_count{{{labels}}}' in text, "labelled by route template"
+    assert 'splash_ml_model_parse_duration_seconds_count{model="Dataset"}' in text
+
+
+def test_mongo_command_listener():
+    listener = MongoCommandListener()
+    listener.started(SimpleNamespace(command_name="find", command={"find": "data_set"}, connection_id=1,
+                                     request_id=7))
+    listener.succeeded(SimpleNamespace(command_name="find", connection_id=1, request_id=7, duration_micros=1500,
+                                       reply={"cursor": {"firstBatch": [{}, {}, {}]}}))
+    text = render_metrics()
+    assert 'splash_ml_mongo_command_duration_seconds_count{command="find",collection="data_set"} 1' in text
+    assert 'splash_ml_mongo_command_documents_total{command="find",collection="data_set"} 3' in text
@@ -0,0 +1,71 @@
+from fastapi.testclient import TestClient
+from graphql import parse, validate
+
+from tagging.api import GRAPHQL_URL, persisted_queries
+from tagging.persisted_queries import PERSISTED_QUERY_NOT_FOUND, PERSISTED_QUERY_REQUIRED
+
+from ..graphql import depth_limit_validator, schema
+from ..persisted_queries import query_hash
+
+datasets_query = """
+query Datasets($limit: Int) {
+  datasets(limit: $limit) { uid tags { name event { tagger { name } } } }
+}"""
+
+
+def persisted_request(key, **variables):
+    return {"extensions": {"persistedQuery": {"version": 1, "sha256Hash": key}}, "variables": variables}
+
+
+def test_persisted_query(rest_client: TestClient):
+    key = persisted_queries.register(datasets_query)
+    assert key == query_hash(datasets_query)
+    for _ in range(2):
+        # the second request skips parsing and the rules of the specification
+        response = rest_client.post(GRAPHQL_URL, json=persisted_request(key, limit=2))
+        assert response.status_code == 200, response.text
+        assert "errors" not in response.json()
+    # the cost limit still applies to the variables of each request
+    response = rest_client.post(GRAPHQL_URL, json=persisted_request(key, limit=10000))
+    assert "maximum cost" in response.json()["errors"][0]["message"]
+
+    response = rest_client.post(GRAPHQL_URL, json=persisted_request(query_hash("{ datasets { uid } }")))
+    assert response.json()["errors"][0]["message"] == PERSISTED_QUERY_NOT_FOUND
+
+
+def test_only_persisted_queries(rest_client: TestClient):
+    persisted_queries.register(datasets_query)
+    persisted_queries.only_persisted = True
+    try:
+        response = rest_client.post(GRAPHQL_URL, json={"query": "{ datasets { uid } }"})
+        assert response.json()["errors"][0]["message"] == PERSISTED_QUERY_REQUIRED
+        # registered queries can still be sent in full
+        response = rest_client.post(GRAPHQL_URL, json={"query": datasets_query, "variables": {"limit": 1}})
+        assert "errors" not in response.json()
+    finally:
+        persisted_queries.only_persisted = False
+
+
+def test_query_cost(rest_client: TestClient):
+    response = rest_client.post(GRAPHQL_URL, json={"query": "{ datasets(limit: 1000000) { uid } }"})
+    assert response.status_code == 400
+    assert response.json()["errors"][0]["extensions"]["cost"]["requestedQueryCost"] == 1000000
+    response = rest_client.post(GRAPHQL_URL, json={"query": "{ datasets(limit: 0) { uid } }"})
+    assert response.json()["errors"][0]["message"] == "limit must be at least 1"
+    # the default of a variable costs the same as the value given
+    query = "query Datasets($limit: Int = 2500) { datasets(limit: $limit) { uid } }"
+    response = rest_client.post(GRAPHQL_URL, json={"query": query})
+    assert response.status_code == 400
+    assert response.json()["errors"][0]["extensions"]["cost"]["requestedQueryCost"] == 2500
+    response = rest_client.post(GRAPHQL_URL, json={"query": query, "variables": {"limit": 5}})
+    assert response.status_code == 200
+
+
+def test_query_depth():
+    document = parse("""
+        { datasets { ...tags } }
+        fragment tags on Dataset { tags { event { tagger { name } } } }
+    """)
+    assert validate(schema, document, [depth_limit_validator(5)]) == []
+    errors = validate(schema, document, [depth_limit_validator(4)])
+    assert errors[0].message == "The query has a depth of 5, more than the maximum of 4"
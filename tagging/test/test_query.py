@@ -1,9 +1,13 @@
+import asyncio
+
 from fastapi.testclient import TestClient
 import pytest
 
 from tagging.tag_service import TagService
 
-from .data import new_dataset
+from ..graphql import DataLoader
+from ..model import Dataset, Tag, TaggingEvent
+from .data import new_dataset, new_tagger, new_tagging_event
 from tagging.api import GRAPHQL_URL
 
 
@@ -30,6 +34,67 @@ def test_query_tags(rest_client: TestClient):
     assert datasets[0]['uri'] == "images/test.tiff"
 
 
+def test_query_projection(tag_svc: TagService, rest_client: TestClient):
+    dataset = next(tag_svc.create_datasets([Dataset(uri="images/projected.tiff", type="file",
+                                                    tags=[Tag(name="projected")])]))
+    response = rest_client.post(GRAPHQL_URL, json={'query': query_uids})
+    assert response.json().get('errors') is None, f"errors found {response.json()['errors']}"
+    assert response.json()['data']['datasets'] == [{'uid': dataset.uid, 'uri': "images/projected.tiff"}]
+
+
+def test_query_tag_events(tag_svc: TagService, rest_client: TestClient):
+    tagger = tag_svc.create_tag_source(new_tagger.copy())
+    event = tag_svc.create_tagging_event(TaggingEvent(**{**new_tagging_event.dict(), "tagger_id": tagger.uid}))
+    tags = [Tag(name="nested", confidence=0.5, event_id=event.uid),
+            Tag(name="nested", confidence=0.7, event_id=event.uid),
+            Tag(name="nested")]
+    next(tag_svc.create_datasets([Dataset(uri="images/nested.tiff", type="file", tags=tags)]))
+    response = rest_client.post(GRAPHQL_URL, json={'query': query_tag_events})
+    assert response.json().get('errors') is None, f"errors found {response.json()['errors']}"
+    tags = response.json()['data']['datasets'][0]['tags']
+    assert [tag['event'] and tag['event']['uid'] for tag in tags] == [event.uid, event.uid, None]
+    assert tags[0]['event']['tagger'] == {'uid': tagger.uid, 'name': "PyTestNet"}
+
+
+def test_data_loader_batches():
+    batches = []
+
+    async def batch_load(keys):
+        batches.append(keys)
+        return [key.upper() for key in keys]
+
+    async def load_all():
+        loader = DataLoader(batch_load)
+        return await asyncio.gather(*(loader.load(key) for key in ["a", "b", "a", "c"]))
+
+    assert asyncio.run(load_all()) == ["A", "B", "A", "C"]
+    assert batches == [["a", "b", "c"]]
+
+
+query_uids = """
+query FindDataset{
+  datasets(tags: ["projected"]){
+    ...datasetId
+  }
+}
+fragment datasetId on Dataset {
+  uid
+  uri
+}"""
+
+query_tag_events = """
+query FindDataset{
+  datasets(tags: ["nested"]){
+    tags {
+      event {
+        uid
+        run_time
+        tagger { uid name }
+      }
+    }
+  }
+}"""
+
 query_by_uri = """
 query FindDataset{
   datasets(uris: ["images/test.tiff"]){
@@ -0,0 +1,73 @@
+import asyncio
+
+import mongomock
+from mongomock_motor import AsyncMongoMockClient
+
+from ..slow_queries import SlowQueryLog, plan_summary, query_shape
+from ..tag_service import AsyncTagService, TagService
+from .data import new_dataset
+
+explain = {
+    "queryPlanner": {
+        "winningPlan": {
+            "stage": "LIMIT",
+            "inputStage": {
+                "stage": "FETCH",
+                "inputStage": {"stage": "IXSCAN", "indexName": "tags.name_1"}
+            }
+        }
+    }
+}
+
+
+def test_query_shape_and_plan_summary():
+    query = {"$and": [{"tags.name": {"$in": ["rods", "peaks"]}}, {"project": "secret"}]}
+    assert query_shape(query) == {"$and": [{"tags.name": {"$in": "?"}}, {"project": "?"}]}
+    assert plan_summary(explain) == {"stage": "LIMIT <- FETCH <- IXSCAN", "index": "tags.name_1"}
+
+    log = SlowQueryLog(threshold_ms=5, maxsize=2)
+    assert not log.is_slow(0.004) and log.is_slow(0.005)
+    for limit in range(3):
+        log.record("data_set", {"filter": query, "limit": limit}, 0.01, explain)
+    assert [entry["limit"] for entry in log.entries()] == [1, 2], "oldest entries are dropped"
+
+
+def test_find_datasets_slow_query_log():
+    client = mongomock.MongoClient()
+    tag_svc = TagService(client, slow_query_ms=0)
+    list(tag_svc.create_datasets([new_dataset]))
+    list(tag_svc.find_datasets(tags=["rods"], project="p", cursor=""))
+    entry, = tag_svc.slow_queries()
+    assert entry["shape"] == {"$and": [{"tags.name": {"$in": "?"}}, {"project": "?"}]}
+    assert entry["sort"] == {"uid": 1}
+    assert entry["plan"] is None, "mongomock cannot explain"
+    tag_svc._explaining.result()
+
+    async_tag_svc = AsyncTagService(AsyncMongoMockClient(mock_mongo_client=client), slow_query_ms=0)
+
+    async def find():
+        return [dataset async for dataset in async_tag_svc.find_datasets(uris=[new_dataset.uri])]
+
+    assert asyncio.run(find())
+    assert async_tag_svc.slow_queries()[0]["shape"] == {"$and": [{"uri": {"$in": "?"}}]}
+    assert TagService(client).slow_queries() == []
+
+
+def test_slow_query_explained_in_background(monkeypatch):
+    tag_svc = TagService(mongomock.MongoClient(), slow_query_ms=0)
+    list(tag_svc.create_datasets([new_dataset, new_dataset]))
+    commands = []
+
+    def command(spec):
+        commands.append(spec)
+        return explain
+
+    monkeypatch.setattr(tag_svc._db, "command", command)
+    datasets = tag_svc.find_datasets(limit=0)
+    next(datasets)
+    datasets.close()
+    entry, = tag_svc.slow_queries()
+    assert entry["limit"] == 0, "logged when the consumer stops early"
+    tag_svc._explaining.result()
+    assert commands[0]["verbosity"] == "queryPlanner", "the query is not run again"
+    assert tag_svc.slow_queries()[0]["plan"]["index"] == "tags.name_1"
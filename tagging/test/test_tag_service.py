@@ -1,12 +1,17 @@
 import datetime
+import mongomock
 import pytest
 
-from pymongo.errors import DuplicateKeyError
+from pymongo import DeleteMany, DeleteOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
-from ..tag_service import TagService
+from ..indexes import index_manifest
+from ..tag_service import TagOccurrencesDisabled, TagService, encode_cursor, split_of
 from ..model import (
     SCHEMA_VERSION,
     Dataset,
+    DatasetTagPatchRequest,
+    IngestMode,
     Tag,
     TagPatchRequest,
     TagSource,
@@ -74,6 +79,25 @@ def test_create_and_find_tagging_event(tag_svc: TagService):
     assert tagging_event.tagger_id == return_tagging_event.tagger_id
 
 
+def test_retrieve_tagging_events(tag_svc: TagService):
+    tagger = tag_svc.create_tag_source(new_tagger)
+    events = [tag_svc.create_tagging_event(TaggingEvent(tagger_id=tagger.uid, run_time=datetime.datetime.now()))
+              for _ in range(2)]
+    # one is cached by the single retrieve, the other comes from the database
+    tag_svc.retrieve_tagging_event(events[0].uid)
+    found = tag_svc.retrieve_tagging_events([events[1].uid, "not an event", events[0].uid])
+    assert [event and event.uid for event in found] == [events[1].uid, None, events[0].uid]
+    assert [source and source.uid for source in tag_svc.retrieve_tag_sources(["nope", tagger.uid])] \
+        == [None, tagger.uid]
+
+
+def test_retrieve_datasets(tag_svc: TagService):
+    datasets = list(tag_svc.create_datasets([Dataset(uri="a", type="file"), Dataset(uri="b", type="file")]))
+    found = tag_svc.retrieve_datasets([datasets[1].uid, "nope", datasets[0].uid])
+    assert [dataset and dataset.uri for dataset in found] == ["b", None, "a"]
+    assert tag_svc.retrieve_datasets([datasets[0].uid], raw=True)[0]["uri"] == "a"
+
+
 def test_create_and_find_asset(tag_svc: TagService):
     tagger = tag_svc.create_tag_source(new_tagger)
     new_tagging_event.tagger_id = tagger.uid
@@ -143,3 +167,297 @@ def test_remove_nonexistent_tag(tag_svc: TagService):
     req = TagPatchRequest(add_tags=[], remove_tags=remove_tags_uids)
     deleted_tags_uids = tag_svc.modify_tags(req, dataset.uid)
     assert deleted_tags_uids[1][0] == '-1'
+
+
+def test_add_and_remove_tags(tag_svc: TagService):
+    # the service fixture comes from the absolute tagging package
+    from tagging.tag_service import DatasetNotFound
+
+    dataset = next(tag_svc.create_datasets([new_dataset]))
+    new_tag = Tag(name="$add", locator={"spec": "$spec", "path": "$path"})
+    req = TagPatchRequest(add_tags=[new_tag], remove_tags=[dataset.tags[0].uid, "123"])
+    added_tags_uid, removed_tags_uid = tag_svc.modify_tags(req, dataset.uid)
+    assert removed_tags_uid == [dataset.tags[0].uid, '-1']
+    updated_dataset = tag_svc.retrieve_dataset(dataset.uid)
+    assert [tag.uid for tag in updated_dataset.tags] == [tag.uid for tag in dataset.tags[1:]] + added_tags_uid
+    assert updated_dataset.tags[-1].locator.path == "$path", "tag values are stored as is"
+
+    with pytest.raises(DatasetNotFound):
+        tag_svc.modify_tags(req, "no such dataset")
+
+
+def test_find_datasets_cursor(tag_svc: TagService):
+    list(tag_svc.create_datasets([new_dataset, no_tag_dataset]))
+    all_uids = sorted(dataset.uid for dataset in tag_svc.find_datasets(limit=0))
+    first_page = list(tag_svc.find_datasets(limit=2, cursor=""))
+    assert [dataset.uid for dataset in first_page] == all_uids[:2]
+    next_page = list(tag_svc.find_datasets(limit=2, offset=100, cursor=encode_cursor(first_page[-1].uid)))
+    assert [dataset.uid for dataset in next_page] == all_uids[2:4]
+
+
+def test_modify_tags_bulk(tag_svc: TagService):
+    dataset, untagged_dataset = tag_svc.create_datasets([new_dataset, no_tag_dataset])
+    reqs = [
+        DatasetTagPatchRequest(dataset_uid=dataset.uid, add_tags=[Tag(name="bulk1")],
+                               remove_tags=[dataset.tags[0].uid, "123"]),
+        DatasetTagPatchRequest(dataset_uid=untagged_dataset.uid, add_tags=[Tag(name="bulk2")]),
+        DatasetTagPatchRequest(dataset_uid=untagged_dataset.uid, add_tags=[Tag(name="bulk3")]),
+        DatasetTagPatchRequest(dataset_uid="not a dataset", add_tags=[Tag(name="bulk4")]),
+    ]
+    results = tag_svc.modify_tags_bulk(reqs)
+    assert [result[0] for result in results] == [req.dataset_uid for req in reqs]
+    assert results[0][2] == [dataset.tags[0].uid, '-1']
+    assert results[3][1:] == (None, None)
+
+    updated_dataset = tag_svc.retrieve_dataset(dataset.uid)
+    assert [tag.uid for tag in updated_dataset.tags] == [dataset.tags[1].uid, dataset.tags[2].uid] + results[0][1]
+    updated_dataset = tag_svc.retrieve_dataset(untagged_dataset.uid)
+    assert [tag.name for tag in updated_dataset.tags] == ["bulk2", "bulk3"]
+
+
+def test_modify_tags_bulk_concurrent_null_tags(monkeypatch):
+    tag_svc = TagService(mongomock.MongoClient())
+    untagged_dataset, = tag_svc.create_datasets([no_tag_dataset])
+    datasets = tag_svc._collection_dataset
+    bulk_write = datasets.bulk_write
+
+    def concurrent_bulk_write(requests, ordered=True):
+        # another writer tags the dataset between the read and the bulk write
+        other_tags = [{"uid": "other", "name": "other"}]
+        datasets.update_one({"uid": untagged_dataset.uid}, {"$set": {"tags": other_tags}})
+        return bulk_write(requests, ordered=ordered)
+
+    monkeypatch.setattr(datasets, "bulk_write", concurrent_bulk_write)
+    req = DatasetTagPatchRequest(dataset_uid=untagged_dataset.uid, add_tags=[Tag(name="bulk")])
+    tag_svc.modify_tags_bulk([req])
+    assert [tag.name for tag in tag_svc.retrieve_dataset(untagged_dataset.uid).tags] == ["other", "bulk"]
+
+
+def test_ingest_datasets():
+    # a fresh database with a unique uri, to provoke duplicate key errors
+    tag_svc = TagService(mongomock.MongoClient())
+    tag_svc._collection_dataset.create_index('uri', unique=True)
+    datasets = (item for item in [
+        new_dataset,
+        {"type": "file", "uri": "one"},
+        {"type": "not a type", "uri": "two"},
+        '{"type": "web", "uri": "three"}',
+        '{"type": "web", "uri": "one"}',
+        "{not json",
+        no_tag_dataset,
+    ])
+    results = list(tag_svc.ingest_datasets(datasets, chunk_size=2))
+    assert [result.index for result in results] == list(range(7))
+    assert [result.error is None for result in results] == [True, True, False, True, False, False, True]
+    assert "Duplicate" in results[4].error
+    assert all(result.uid is None for result in results if result.error)
+    assert tag_svc._collection_dataset.count_documents({}) == 4
+    assert tag_svc.retrieve_dataset(results[3].uid).uri == "three"
+
+
+def test_ingest_unstorable_datasets():
+    tag_svc = TagService(mongomock.MongoClient())
+    datasets = [
+        {"type": "file", "uri": "x" * (16 * 1024 * 1024)},
+        {"type": "file", "uri": "a", "tags": [{"name": "rods", "locator": {"spec": "s", "path": {1: 2}}}]},
+        {"type": "file", "uri": "b"},
+    ]
+    results = list(tag_svc.ingest_datasets(datasets))
+    assert "bytes" in results[0].error and results[1].error and results[2].error is None
+    assert [dataset.uri for dataset in tag_svc.find_datasets(limit=0)] == ["b"]
+
+
+def test_upsert_datasets():
+    tag_svc = TagService(mongomock.MongoClient(), indexes=index_manifest(unique_uris=True), tag_occurrences=True)
+    tag_svc.create_indexes()
+    batch = [
+        {"type": "file", "project": "p", "uri": "a",
+         "tags": [{"name": "rods", "event_id": "e1", "confidence": 0.1}, {"name": "rods", "event_id": "e2"}]},
+        {"type": "file", "project": "p", "uri": "b"},
+        {"type": "file", "uri": "a", "tags": [{"name": "peaks"}]},
+        {"type": "file", "project": "p"},
+    ]
+    first = list(tag_svc.ingest_datasets(batch, mode=IngestMode.merge))
+    assert [result.error is None for result in first] == [True, True, True, False]
+    # a retry of the same load leaves the same datasets
+    again = list(tag_svc.ingest_datasets(batch, chunk_size=2, mode=IngestMode.merge))
+    assert [result.uid for result in again] == [result.uid for result in first]
+    assert tag_svc._collection_dataset.count_documents({}) == 3
+
+    update = {"type": "file", "project": "p", "uri": "a",
+              "tags": [{"name": "rods", "event_id": "e1", "confidence": 0.9}]}
+    results = list(tag_svc.ingest_datasets([update, dict(update, tags=[{"name": "cat"}])], mode=IngestMode.merge))
+    assert results[0].uid == results[1].uid == first[0].uid, "repeats in a chunk apply in order"
+    tags = tag_svc.retrieve_dataset(first[0].uid).tags
+    assert sorted((tag.name, tag.event_id, tag.confidence) for tag in tags) == [
+        ("cat", None, None), ("rods", "e1", 0.9), ("rods", "e2", None)]
+    occurrences = tag_svc.find_tag_occurrences(limit=0)
+    assert sorted(occurrence.uid for occurrence in occurrences) == sorted(
+        [tag.uid for tag in tags] + [tag_svc.retrieve_dataset(first[2].uid).tags[0].uid])
+
+    list(tag_svc.ingest_datasets([update], mode=IngestMode.replace))
+    assert [tag.confidence for tag in tag_svc.retrieve_dataset(first[0].uid).tags] == [0.9]
+    with pytest.raises(BulkWriteError):
+        list(tag_svc.create_datasets([Dataset(type="file", project="p", uri="b")]))
+
+
+def test_upsert_occurrences_unordered(monkeypatch):
+    tag_svc = TagService(mongomock.MongoClient(), tag_occurrences=True)
+    occurrences = tag_svc._collection_tag_occurrence
+    bulk_write = occurrences.bulk_write
+
+    def unordered_bulk_write(requests, ordered=True):
+        # a mongod runs the inserts, then the updates, then the deletes of an unordered bulk write
+        if not ordered:
+            requests = sorted(requests, key=lambda request: isinstance(request, (DeleteOne, DeleteMany)))
+        return bulk_write(requests, ordered=ordered)
+
+    monkeypatch.setattr(occurrences, "bulk_write", unordered_bulk_write)
+    item = {"type": "file", "project": "p", "uri": "a", "tags": [{"name": "rods"}]}
+    for _ in range(2):
+        results = list(tag_svc.ingest_datasets([item], mode=IngestMode.merge))
+    tags = tag_svc.retrieve_dataset(results[0].uid).tags
+    assert [occurrence.uid for occurrence in tag_svc.find_tag_occurrences(limit=0)] == [tags[0].uid]
+
+
+def test_upsert_merge_dollar_values():
+    tag_svc = TagService(mongomock.MongoClient())
+    item = {"type": "file", "project": "p", "uri": "a", "tags": [{"name": "$uri", "event_id": "$project"}]}
+    for _ in range(3):
+        results = list(tag_svc.ingest_datasets([item], mode=IngestMode.merge))
+    tags = tag_svc.retrieve_dataset(results[0].uid).tags
+    assert [(tag.name, tag.event_id) for tag in tags] == [("$uri", "$project")], "values are not field paths"
+
+
+def test_find_datasets_fields(tag_svc: TagService):
+    # the service fixture comes from the absolute tagging package
+    from tagging.model import PartialDataset
+    from tagging.tag_service import InvalidFields
+
+    asset = next(tag_svc.create_datasets([new_dataset]))
+    found = next(tag_svc.find_datasets(uris=[asset.uri], fields=["uri"], cursor=""))
+    assert isinstance(found, PartialDataset)
+    assert found.__fields_set__ == {"uid", "uri"}
+    assert found.tags is None
+
+    with pytest.raises(InvalidFields):
+        next(tag_svc.find_datasets(fields=["tags.locator"]))
+
+
+def test_count_tags():
+    svc = TagService(mongomock.MongoClient())
+    list(svc.create_datasets([
+        Dataset(uri="/a", type="file", project="p1",
+                tags=[Tag(name="cat", confidence=0.1), Tag(name="dog", confidence=1.0)]),
+        Dataset(uri="/b", type="file", project="p2",
+                tags=[Tag(name="cat", confidence=0.9), Tag(name="cat")]),
+        Dataset(uri="/c", type="file", project="p2"),
+    ]))
+    counts = svc.count_tags(confidence_bins=2)
+    assert [(c.name, c.count, c.confidence_histogram) for c in counts] == [("cat", 3, [1, 1]), ("dog", 1, [0, 1])]
+
+    counts = svc.count_tags(names=["cat"], by_project=True)
+    assert [(c.name, c.project, c.count) for c in counts] == [("cat", "p1", 1), ("cat", "p2", 2)]
+    assert counts[0].confidence_histogram is None
+
+
+def test_find_datasets_confidence_range():
+    svc = TagService(mongomock.MongoClient())
+    list(svc.create_datasets([
+        Dataset(uri="/a", type="file", tags=[Tag(name="cat", confidence=0.2), Tag(name="dog", confidence=0.9)]),
+        Dataset(uri="/b", type="file", tags=[Tag(name="cat", confidence=0.8)]),
+        Dataset(uri="/c", type="file", tags=[]),
+        Dataset(uri="/d", type="file"),
+    ]))
+
+    def uris(**filters):
+        return sorted(dataset.uri for dataset in svc.find_datasets(limit=0, **filters))
+
+    # the dog tag of /a is in range, but not the cat tag
+    assert uris(tags=["cat"], min_confidence=0.5) == ["/b"]
+    assert uris(min_confidence=0.5, max_confidence=0.85) == ["/b"]
+    assert uris(untagged=True) == ["/c", "/d"]
+    assert uris(untagged=False) == ["/a", "/b"]
+
+
+def test_tag_occurrences():
+    tag_svc = TagService(mongomock.MongoClient(), tag_occurrences=True)
+    dataset = next(tag_svc.create_datasets([new_dataset]))
+    ingested = list(tag_svc.ingest_datasets([{"type": "file", "uri": "a", "tags": [{"name": "rods"}]}]))
+    tag_svc.modify_tags(TagPatchRequest(add_tags=[Tag(name="rods", confidence=0.5)],
+                                        remove_tags=[dataset.tags[0].uid]), dataset.uid)
+    tag_svc.modify_tags_bulk([DatasetTagPatchRequest(dataset_uid=ingested[0].uid, add_tags=[Tag(name="peaks")])])
+
+    def occurrences(**filters):
+        found = tag_svc.find_tag_occurrences(limit=0, **filters)
+        return sorted((occurrence.dataset_uid, occurrence.name, occurrence.confidence) for occurrence in found)
+
+    all_occurrences = occurrences()
+    assert len(all_occurrences) == 5, "3 created, 1 ingested, 2 added and 1 removed"
+    assert occurrences(names=["rods"]) == sorted([(dataset.uid, "rods", 0.5), (ingested[0].uid, "rods", None)])
+    assert occurrences(names=["rods"], min_confidence=0.2) == [(dataset.uid, "rods", 0.5)]
+    assert occurrences(event_id="import_id1") == [(dataset.uid, "reflection", 1)]
+
+    assert tag_svc.rebuild_tag_occurrences(chunk_size=1) == 5
+    assert occurrences() == all_occurrences
+    with pytest.raises(TagOccurrencesDisabled):
+        next(TagService(mongomock.MongoClient()).find_tag_occurrences())
+
+
+def test_split_datasets():
+    svc = TagService(mongomock.MongoClient())
+    datasets = list(svc.create_datasets(
+        [Dataset(uri=f"/rods{i}", type="file", tags=[Tag(name="rods", confidence=0.9), Tag(name="peaks")])
+         for i in range(10)] +
+        [Dataset(uri=f"/peaks{i}", type="file", tags=[Tag(name="peaks", confidence=0.8)]) for i in range(5)] +
+        [Dataset(uri="/none", type="file")]))
+
+    ratios = {"train": 0.6, "test": 0.4}
+    split = svc.split_datasets(ratios, tags=["rods", "peaks"], chunk_size=4)
+    expected = {"train": {}, "test": {}}
+    for dataset in datasets[:15]:
+        stratum = expected[split_of(dataset.uid, list(ratios.items()))]
+        stratum[dataset.tags[0].name] = stratum.get(dataset.tags[0].name, 0) + 1
+    assert split.counts == expected
+    stored = svc.retrieve_split(split.uid)
+    assert {name: set(uids) for name, uids in stored.items()} == \
+        {name: {dataset.uid for dataset in datasets[:15] if split_of(dataset.uid, list(ratios.items())) == name}
+         for name in ratios if expected[name]}
+    assert svc.retrieve_split(split.uid, "test") == {"test": stored["test"]}
+    assert svc.retrieve_split("nope") == {}
+
+    # the same datasets always land in the same splits, new datasets do not move them
+    list(svc.create_datasets([Dataset(uri="/rods10", type="file", tags=[Tag(name="rods", confidence=0.9)])]))
+    again = svc.split_datasets(ratios, tags=["rods", "peaks"])
+    assert again.uid != split.uid
+    assert all(set(uids) <= set(svc.retrieve_split(again.uid)[name]) for name, uids in stored.items())
+
+    split = svc.split_datasets({"all": 1})
+    assert split.counts == {"all": {"rods": 11, "peaks": 5, "": 1}}
+    with pytest.raises(ValueError):
+        svc.split_datasets({"train": 0})
+
+
+def test_split_datasets_failure(monkeypatch):
+    svc = TagService(mongomock.MongoClient())
+    list(svc.create_datasets([Dataset(uri=f"/rods{i}", type="file", tags=[Tag(name="rods")]) for i in range(4)]))
+    records = svc._collection_dataset_collection
+    insert_many = records.insert_many
+    calls = []
+
+    def failing_insert_many(documents):
+        calls.append(documents)
+        if len(calls) > 1:
+            raise RuntimeError("connection lost")
+        return insert_many(documents)
+
+    monkeypatch.setattr(records, "insert_many", failing_insert_many)
+    with pytest.raises(RuntimeError):
+        svc.split_datasets({"all": 1}, chunk_size=1)
+    assert records.count_documents({}) == 0, "the records written before the failure are deleted"
+
+
+def test_split_datasets_dollar_values():
+    svc = TagService(mongomock.MongoClient())
+    list(svc.create_datasets([Dataset(uri="a", type="file", tags=[Tag(name="$uri", event_id="$uri")])]))
+    assert svc.split_datasets({"all": 1}, tags=["$uri"], event_id="$uri").counts == {"all": {"$uri": 1}}
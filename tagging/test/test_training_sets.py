@@ -0,0 +1,53 @@
+import logging
+import os
+
+import mongomock
+
+from ..indexes import ensure_indexes, index_manifest
+from ..model import Dataset, Tag, TagPatchRequest
+from ..tag_service import TagService
+from ..training_sets import MANIFEST_FILE, materialize_training_set, main, read_manifest, split_of
+
+
+def test_materialize_training_set(tmpdir):
+    src_root = tmpdir.mkdir("src")
+    out_dir = str(tmpdir.join("training"))
+    tag_svc = TagService(mongomock.MongoClient())
+    datasets = []
+    for i in range(4):
+        src_root.join(f"frame{i}.tiff").write_binary(bytes([i]) * 100)
+        datasets.append(Dataset(type="file", uri=f"frame{i}.tiff",
+                                tags=[Tag(name="rods", confidence=0.9), Tag(name="peaks", confidence=0.1 * i)]))
+    datasets.append(Dataset(type="tiled", uri="http://tiled/frame", tags=[Tag(name="rods", confidence=0.9)]))
+    datasets = list(tag_svc.create_datasets(datasets))
+
+    counts = materialize_training_set(tag_svc, out_dir, src_root=str(src_root), tags=["rods", "peaks"],
+                                      min_confidence=0.15, splits=[("train", 0.5), ("test", 0.5)])
+    assert counts == {"hardlink": 6}, "rods for every file and peaks above 0.15 for two, not the tiled dataset"
+    dataset = datasets[3]
+    for tag_name in ("rods", "peaks"):
+        path = os.path.join(out_dir, split_of(dataset.uid, [("train", 0.5), ("test", 0.5)]), tag_name,
+                            dataset.uid + ".tiff")
+        assert os.path.samefile(path, str(src_root.join("frame3.tiff")))
+
+    # a rerun only touches what changed
+    src_root.join("frame0.tiff").write_binary(b"changed")
+    tag_svc.modify_tags(TagPatchRequest(remove_tags=[datasets[3].tags[1].uid]), datasets[3].uid)
+    counts = materialize_training_set(tag_svc, out_dir, src_root=str(src_root), tags=["rods", "peaks"],
+                                      min_confidence=0.15, splits=[("train", 0.5), ("test", 0.5)], link="copy")
+    assert counts == {"unchanged": 4, "copy": 1, "removed": 1}
+    assert len(read_manifest(out_dir)) == 5
+    assert len(tmpdir.join("training", MANIFEST_FILE).readlines()) == 5, "the manifest is compacted"
+
+
+def test_main_uses_deployment_indexes(tmpdir, monkeypatch, caplog):
+    client = mongomock.MongoClient()
+    ensure_indexes(client["tagging"], index_manifest(["uri"], unique_uris=True))
+    monkeypatch.setattr("pymongo.MongoClient", lambda uri: client)
+    monkeypatch.setenv("SPLASH_TEXT_INDEX_FIELDS", "uri")
+    monkeypatch.setenv("SPLASH_UNIQUE_URIS", "true")
+
+    with caplog.at_level(logging.WARNING, logger="splash_ml"):
+        main(["--out", str(tmpdir.join("training"))])
+    assert not caplog.records, "the manifest of the deployment is current"
+    assert client["tagging"]["data_set"].index_information()["project_1_uri_1"]["unique"]
@@ -0,0 +1,41 @@
+import uuid
+
+import mongomock
+import pytest
+
+from ..tag_service import TagService
+from ..uids import BatchedRandomUids, TimeOrderedUids, make_uid_generator, random_uid
+
+from .data import new_dataset
+
+
+@pytest.mark.parametrize("new_uid, version", [
+    (random_uid, 4),
+    (BatchedRandomUids(batch_size=16), 4),
+    (TimeOrderedUids(batch_size=16), 7),
+])
+def test_uid_format(new_uid, version):
+    uids = [new_uid() for _ in range(100)]
+    assert len(set(uids)) == len(uids)
+    for uid in uids:
+        parsed = uuid.UUID(uid)
+        assert str(parsed) == uid
+        assert parsed.version == version
+        assert parsed.variant == uuid.RFC_4122
+
+
+def test_time_ordered_uids_sort_by_creation():
+    new_uid = TimeOrderedUids()
+    uids = [new_uid() for _ in range(10000)]
+    assert uids == sorted(uids)
+
+
+def test_service_uid_generator():
+    tag_svc = TagService(mongomock.MongoClient(), uid_generator=make_uid_generator('uuid7'))
+    dataset = next(tag_svc.create_datasets([new_dataset]))
+    uids = [dataset.uid] + [tag.uid for tag in dataset.tags]
+    assert uids == sorted(uids)
+    assert all(uuid.UUID(uid).version == 7 for uid in uids)
+
+    with pytest.raises(ValueError):
+        make_uid_generator('uuid1')
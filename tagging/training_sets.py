@@ -0,0 +1,303 @@
+"""Training sets laid out on disk as split/tag/file, from a dataset search.
+
+Every file dataset matching the search goes to one split, picked from a hash of
+its uid so that it stays in the same split from one run to the next, and to the
+folder of each of its tags that the search selected. Files are hard linked to
+the originals when they are on the same filesystem, cloned where the filesystem
+supports reflinks, and copied by a pool of threads otherwise. Hard links share
+their data with the originals, use --link copy for files that are modified in place.
+
+A manifest in the output folder records the source, size and modification time
+each file was made from, one json line per change. A rerun only links or copies
+files that are new or whose source changed, and removes the files of datasets
+that no longer match, so an interrupted run picks up where it stopped.
+
+    python -m tagging.training_sets --mongo-uri mongodb://localhost:27017 --db-name tagging \\
+        --tags rods peaks --min-confidence 0.8 --src-root /data --out /data/training \\
+        --split train=0.8 --split test=0.2
+
+which is the same as the splash-ml-training-set console script.
+"""
+import argparse
+import json
+import os
+import shutil
+import threading
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Sequence, Tuple
+
+from .indexes import DEFAULT_TEXT_INDEX_FIELDS, index_manifest, parse_text_index_fields
+from .model import Dataset, DatasetType
+from .tag_service import TagService, encode_cursor, split_of
+
+MANIFEST_FILE = 'manifest.jsonl'
+LINK_MODES = ('auto', 'hardlink', 'reflink', 'copy')
+DEFAULT_SPLITS = (('train', 0.8), ('test', 0.2))
+DEFAULT_WORKERS = 8
+PAGE_SIZE = 1000
+
+# ioctl that clones a file on btrfs, xfs and other copy on write filesystems of linux
+FICLONE = 0x40049409
+
+
+class TrainingFile(NamedTuple):
+    path: str  # relative to the output folder, split/tag/file
+    src: str
+    uid: str
+
+
+def parse_split(value: str) -> Tuple[str, float]:
+    """A split as given on the command line, name=fraction"""
+    name, _, fraction = value.partition('=')
+    if not name or not fraction:
+        raise ValueError(f"{value} is not name=fraction")
+    return name, float(fraction)
+
+
+def _folder_name(name: str) -> str:
+    name = name.replace('/', '_').replace('\\', '_')
+    return '_' if name in ('', '.', '..') else name
+
+
+def _selected_tag_names(dataset: Dataset, tags, min_confidence, max_confidence) -> List[str]:
+    names = set()
+    for tag in dataset.tags or []:
+        if tags and tag.name not in tags:
+            continue
+        if min_confidence is not None and (tag.confidence is None or tag.confidence < min_confidence):
+            continue
+        if max_confidence is not None and (tag.confidence is None or tag.confidence > max_confidence):
+            continue
+        names.add(tag.name)
+    return sorted(names)
+
+
+def training_files(datasets: Iterable[Dataset],
+                   src_root: str = None,
+                   splits: Sequence[Tuple[str, float]] = DEFAULT_SPLITS,
+                   tags: List[str] = None,
+                   min_confidence: float = None,
+                   max_confidence: float = None) -> Iterator[TrainingFile]:
+    """The files to lay out for datasets, one per selected tag of each file dataset.
+    Files are named by dataset uid, so datasets with the same file name do not collide"""
+    for dataset in datasets:
+        if dataset.type != DatasetType.file or not dataset.uri:
+            continue
+        src = os.path.join(src_root, dataset.uri) if src_root else dataset.uri
+        split = _folder_name(split_of(dataset.uid, splits))
+        file_name = dataset.uid + os.path.splitext(dataset.uri)[1]
+        for name in _selected_tag_names(dataset, tags, min_confidence, max_confidence):
+            yield TrainingFile(os.path.join(split, _folder_name(name), file_name), src, dataset.uid)
+
+
+def _reflink(src: str, dest: str):
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError("reflinks are not supported on this platform")
+    with open(src, 'rb') as src_file, open(dest, 'wb') as dest_file:
+        try:
+            fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+            return
+        except OSError:
+            pass
+    os.unlink(dest)
+    raise OSError(f"{dest} could not be cloned from {src}")
+
+
+def _link_or_copy(src: str, dest: str, link: str) -> str:
+    if link in ('auto', 'hardlink'):
+        try:
+            os.link(src, dest)
+            return 'hardlink'
+        except OSError:
+            if link == 'hardlink':
+                raise
+    if link in ('auto', 'reflink'):
+        try:
+            _reflink(src, dest)
+            return 'reflink'
+        except OSError:
+            if link == 'reflink':
+                raise
+    shutil.copyfile(src, dest)
+    return 'copy'
+
+
+def _place(src: str, dest: str, link: str) -> str:
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    if link in ('auto', 'hardlink') and os.path.exists(dest) and os.path.samefile(src, dest):
+        return 'hardlink'
+    # made under a temporary name and renamed, so an interrupted copy is never
+    # taken for a complete one
+    tmp = f"{dest}.{os.getpid()}.{threading.get_ident()}.tmp"
+    method = _link_or_copy(src, tmp, link)
+    os.replace(tmp, dest)
+    return method
+
+
+def read_manifest(out_dir: str) -> Dict[str, dict]:
+    """Entries of the manifest of out_dir by path, as left by the last run"""
+    entries = {}
+    try:
+        manifest = open(os.path.join(out_dir, MANIFEST_FILE))
+    except FileNotFoundError:
+        return entries
+    with manifest:
+        for line in manifest:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # the last line of an interrupted run
+                continue
+            if entry.get('removed'):
+                entries.pop(entry['path'], None)
+            else:
+                entries[entry['path']] = entry
+    return entries
+
+
+def _write_manifest(out_dir: str, entries: Dict[str, dict]):
+    path = os.path.join(out_dir, MANIFEST_FILE)
+    with open(path + '.tmp', 'w') as manifest:
+        for entry in entries.values():
+            manifest.write(json.dumps(entry) + '\n')
+    os.replace(path + '.tmp', path)
+
+
+def _is_current(entry: dict, file: TrainingFile, stat: os.stat_result, dest: str) -> bool:
+    return (entry is not None and entry['src'] == file.src and entry['size'] == stat.st_size
+            and entry['mtime_ns'] == stat.st_mtime_ns and os.path.exists(dest))
+
+
+def materialize(files: Iterable[TrainingFile],
+                out_dir: str,
+                link: str = 'auto',
+                workers: int = DEFAULT_WORKERS) -> Dict[str, int]:
+    """Lays out files under out_dir and removes those of the last run that are not in files.
+    Returns the number of files per outcome: hardlink, reflink, copy, unchanged, missing
+    (no source file) and removed"""
+    if link not in LINK_MODES:
+        raise ValueError(f"link must be one of {', '.join(LINK_MODES)}")
+    os.makedirs(out_dir, exist_ok=True)
+    entries = read_manifest(out_dir)
+    counts = Counter()
+    wanted = set()
+
+    with open(os.path.join(out_dir, MANIFEST_FILE), 'a') as log, ThreadPoolExecutor(workers) as executor:
+        def record(done):
+            for future in done:
+                entry = future.result()
+                entries[entry['path']] = entry
+                counts[entry['method']] += 1
+                log.write(json.dumps(entry) + '\n')
+            log.flush()
+
+        def place(file: TrainingFile, stat: os.stat_result, dest: str) -> dict:
+            method = _place(file.src, dest, link)
+            return {'path': file.path, 'src': file.src, 'uid': file.uid, 'size': stat.st_size,
+                    'mtime_ns': stat.st_mtime_ns, 'method': method}
+
+        pending = set()
+        for file in files:
+            wanted.add(file.path)
+            dest = os.path.join(out_dir, file.path)
+            try:
+                stat = os.stat(file.src)
+            except FileNotFoundError:
+                counts['missing'] += 1
+                continue
+            if _is_current(entries.get(file.path), file, stat, dest):
+                counts['unchanged'] += 1
+                continue
+            pending.add(executor.submit(place, file, stat, dest))
+            if len(pending) >= workers * 64:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                record(done)
+        record(wait(pending).done)
+
+        for path in [path for path in entries if path not in wanted]:
+            dest = os.path.join(out_dir, path)
+            if os.path.exists(dest):
+                os.remove(dest)
+            try:
+                # the tag and split folders, once empty
+                os.removedirs(os.path.dirname(dest))
+            except OSError:
+                pass
+            del entries[path]
+            counts['removed'] += 1
+            log.write(json.dumps({'path': path, 'removed': True}) + '\n')
+
+    _write_manifest(out_dir, entries)
+    return dict(counts)
+
+
+def search_all_datasets(tag_svc: TagService, page_size: int = PAGE_SIZE, **search_filters) -> Iterator[Dataset]:
+    """Every dataset matching find_datasets filters, read page by page so that no
+    database cursor is held open while files are placed"""
+    cursor = ''
+    while True:
+        page = list(tag_svc.find_datasets(limit=page_size, cursor=cursor, fields=['type', 'uri', 'tags'],
+                                          **search_filters))
+        yield from page
+        if len(page) < page_size:
+            return
+        cursor = encode_cursor(page[-1].uid)
+
+
+def materialize_training_set(tag_svc: TagService,
+                             out_dir: str,
+                             src_root: str = None,
+                             tags: List[str] = None,
+                             project: str = None,
+                             min_confidence: float = None,
+                             max_confidence: float = None,
+                             splits: Sequence[Tuple[str, float]] = DEFAULT_SPLITS,
+                             link: str = 'auto',
+                             workers: int = DEFAULT_WORKERS) -> Dict[str, int]:
+    """Lays out the datasets found with these filters as out_dir/split/tag/file, see materialize"""
+    datasets = search_all_datasets(tag_svc, tags=tags, project=project,
+                                   min_confidence=min_confidence, max_confidence=max_confidence)
+    files = training_files(datasets, src_root, splits, tags, min_confidence, max_confidence)
+    return materialize(files, out_dir, link, workers)
+
+
+def main(args=None):
+    from pymongo import MongoClient
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017/tagging")
+    parser.add_argument("--db-name", default="tagging", help="database of the service, SPLASH_DB_NAME")
+    parser.add_argument("--out", required=True, help="folder of the training set")
+    parser.add_argument("--src-root", default=None, help="folder that dataset uris are relative to")
+    parser.add_argument("--tags", nargs="*", default=None, help="tags to lay out, all tags if not given")
+    parser.add_argument("--project", default=None)
+    parser.add_argument("--min-confidence", type=float, default=None)
+    parser.add_argument("--max-confidence", type=float, default=None)
+    parser.add_argument("--split", dest="splits", type=parse_split, action="append", default=None,
+                        help="name=fraction, repeated for each split. Default is train=0.8 and test=0.2")
+    parser.add_argument("--link", choices=LINK_MODES, default="auto",
+                        help="hard link, then reflink, then copy with auto")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="threads placing files")
+    parser.add_argument("--text-index-fields", type=parse_text_index_fields,
+                        default=os.environ.get("SPLASH_TEXT_INDEX_FIELDS", ",".join(DEFAULT_TEXT_INDEX_FIELDS)),
+                        help="text index fields of the deployment, SPLASH_TEXT_INDEX_FIELDS")
+    parser.add_argument("--unique-uris", action="store_true",
+                        default=os.environ.get("SPLASH_UNIQUE_URIS", "").lower() in ("true", "1"),
+                        help="the deployment has unique uris, SPLASH_UNIQUE_URIS")
+    args = parser.parse_args(args)
+
+    # the manifest of the deployment, so that the service does not warn that its indexes are stale
+    tag_svc = TagService(MongoClient(args.mongo_uri), db_name=args.db_name,
+                         indexes=index_manifest(args.text_index_fields, args.unique_uris))
+    counts = materialize_training_set(tag_svc, args.out, src_root=args.src_root, tags=args.tags,
+                                      project=args.project, min_confidence=args.min_confidence,
+                                      max_confidence=args.max_confidence, splits=args.splits or DEFAULT_SPLITS,
+                                      link=args.link, workers=args.workers)
+    print(json.dumps(counts))
+
+
+if __name__ == "__main__":
+    main()
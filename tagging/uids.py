@@ -0,0 +1,102 @@
+"""Generators of the uid strings assigned to datasets, tags, tag sources and tagging events.
+
+A uid generator is any callable that returns a new uid string. The services use
+random_uid, a plain str(uuid4()), unless they are given another generator.
+"""
+import os
+import threading
+import time
+import uuid
+
+UID_BATCH_SIZE = 1024
+
+
+def random_uid() -> str:
+    return str(uuid.uuid4())
+
+
+def _format_uids(hex_uids: str):
+    return [f"{hex_uids[i:i + 8]}-{hex_uids[i + 8:i + 12]}-{hex_uids[i + 12:i + 16]}-"
+            f"{hex_uids[i + 16:i + 20]}-{hex_uids[i + 20:i + 32]}"
+            for i in range(0, len(hex_uids), 32)]
+
+
+def _random_uids(count: int):
+    raw = bytearray(os.urandom(16 * count))
+    # version 4 and RFC 4122 variant bits, for every uid at once
+    raw[6::16] = bytes(b & 0x0F | 0x40 for b in raw[6::16])
+    raw[8::16] = bytes(b & 0x3F | 0x80 for b in raw[8::16])
+    return _format_uids(raw.hex())
+
+
+class BatchedRandomUids():
+    """Random (version 4) uuids drawn from os.urandom a batch at a time and formatted
+    from one hex string, instead of one system call and one UUID object per uid.
+    """
+
+    def __init__(self, batch_size: int = UID_BATCH_SIZE):
+        self._batch_size = batch_size
+        self._uids = []
+
+    def __call__(self) -> str:
+        try:
+            # list.pop is atomic, threads sharing the generator never get the same uid
+            return self._uids.pop()
+        except IndexError:
+            uids = _random_uids(self._batch_size)
+            uid = uids.pop()
+            self._uids = uids
+            return uid
+
+
+class TimeOrderedUids():
+    """Time ordered (version 7) uuids: a millisecond unix timestamp, a counter that keeps
+    uids from the same millisecond in order, then random bits. New uids sort after older
+    ones, so inserts into the unique uid indexes append to the right edge of the
+    B-tree instead of touching random pages.
+    """
+
+    def __init__(self, batch_size: int = UID_BATCH_SIZE):
+        self._batch_size = batch_size
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._counter = 0
+        self._random_hex = ""
+        self._random_pos = 0
+
+    def __call__(self) -> str:
+        with self._lock:
+            ms = time.time_ns() // 1_000_000
+            if ms <= self._last_ms:
+                ms = self._last_ms
+                self._counter += 1
+                if self._counter > 0xFFF:
+                    # counter exhausted, borrow the next millisecond
+                    ms += 1
+                    self._counter = 0
+            else:
+                self._counter = 0
+            self._last_ms = ms
+            if self._random_pos == len(self._random_hex):
+                self._random_hex = os.urandom(8 * self._batch_size).hex()
+                self._random_pos = 0
+            tail = self._random_hex[self._random_pos:self._random_pos + 16]
+            self._random_pos += 16
+            counter = self._counter
+        time_hex = f"{ms:012x}"
+        variant = "89ab"[int(tail[0], 16) & 0x3]
+        return f"{time_hex[:8]}-{time_hex[8:]}-7{counter:03x}-{variant}{tail[1:4]}-{tail[4:]}"
+
+
+UID_GENERATORS = {
+    'uuid4': lambda: random_uid,
+    'batched': BatchedRandomUids,
+    'uuid7': TimeOrderedUids,
+}
+
+
+def make_uid_generator(name: str):
+    """Build a uid generator by its name in UID_GENERATORS"""
+    if name not in UID_GENERATORS:
+        raise ValueError(f"unknown uid generator {name}, expected one of {', '.join(UID_GENERATORS)}")
+    return UID_GENERATORS[name]()
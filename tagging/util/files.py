@@ -1,16 +1,36 @@
 import hashlib
+import itertools
 import os
 import shutil
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Iterable, Iterator, NamedTuple
 
+BLOCKSIZE = 256 * 1024
 
-def _hash_file(path):
-    BLOCKSIZE = 65536
-    hasher = hashlib.md5()
-    with open(path, 'rb') as afile:
-        buf = afile.read(BLOCKSIZE)
-        while len(buf) > 0:
-            hasher.update(buf)
-            buf = afile.read(BLOCKSIZE)
+
+class AnonymizedFile(NamedTuple):
+    src: str
+    dest: str
+    copied: bool  # False when a file with the same content was already at dest
+
+
+def _new_hasher(hash_algorithm: str):
+    if hash_algorithm == 'blake2b':
+        # 16 bytes, so names are as long as md5 ones
+        return hashlib.blake2b(digest_size=16)
+    return hashlib.new(hash_algorithm)
+
+
+def _hash_file(path, hash_algorithm='md5'):
+    hasher = _new_hasher(hash_algorithm)
+    buf = bytearray(BLOCKSIZE)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as afile:
+        size = afile.readinto(buf)
+        while size:
+            hasher.update(view[:size])
+            size = afile.readinto(buf)
     return hasher.hexdigest()
 
 
@@ -20,16 +40,84 @@ def _hash_string(s):
     return hasher.hexdigest()
 
 
-def anonymize_copy(src_file_path, src_root, dest_root) -> str:
+def _dest_folder(src_file_path, src_root, dest_root):
     src_relative_path = os.path.relpath(src_root, src_file_path)
     dest_relative_path = _hash_string(os.path.dirname(src_relative_path))
-    dest_folder = os.path.join(dest_root, dest_relative_path)
+    return os.path.join(dest_root, dest_relative_path)
+
+
+def _anonymize(src_file_path, src_root, dest_root, hash_algorithm='md5') -> AnonymizedFile:
+    dest_folder = _dest_folder(src_file_path, src_root, dest_root)
     src_file_ext = os.path.splitext(os.path.basename(src_file_path))[1]
-    file_name_root_no_ext = _hash_file(src_file_path)
+    file_name_root_no_ext = _hash_file(src_file_path, hash_algorithm)
+    dest_file = os.path.join(dest_folder, file_name_root_no_ext) + src_file_ext
+    if os.path.exists(dest_file):
+        return AnonymizedFile(str(src_file_path), dest_file, False)
     os.makedirs(dest_folder, exist_ok=True)
-    dest_file_path = os.path.join(
-                        dest_folder,
-                        file_name_root_no_ext)
-    dest_file = dest_file_path + src_file_ext
-    shutil.copyfile(src_file_path, dest_file)
-    return dest_file
+    # copied under a temporary name and renamed, so an interrupted copy is never
+    # taken for a complete one, and two processes copying the same content do not collide
+    tmp_file = f"{dest_file}.{os.getpid()}.tmp"
+    shutil.copyfile(src_file_path, tmp_file)
+    os.replace(tmp_file, dest_file)
+    return AnonymizedFile(str(src_file_path), dest_file, True)
+
+
+def anonymize_copy(src_file_path, src_root, dest_root, hash_algorithm='md5') -> str:
+    return _anonymize(src_file_path, src_root, dest_root, hash_algorithm).dest
+
+
+def anonymize_copies(src_file_paths: Iterable,
+                     src_root,
+                     dest_root,
+                     hash_algorithm='blake2b',
+                     processes: int = None,
+                     chunksize: int = 64) -> Iterator[AnonymizedFile]:
+    """Anonymizes many files like anonymize_copy, across a pool of processes.
+
+    Each file is read once to hash it. Files whose content is already at the
+    destination are not copied again, so an interrupted run can be started
+    over. Copies go through shutil.copyfile, which has the kernel copy the data
+    where the platform allows it.
+
+    hash_algorithm is any hashlib algorithm. blake2b, the default, is faster
+    than md5 on 64 bit machines, but names files differently than
+    anonymize_copy does by default. sha256 is faster still on CPUs with SHA
+    instructions, benchmarks/anonymize.py compares them.
+
+    processes defaults to the number of CPUs, 1 runs in this process.
+    Results are yielded in the order of src_file_paths, which is read as
+    the work goes, so it can list millions of files.
+    """
+    anonymize = partial(_anonymize, src_root=src_root, dest_root=dest_root, hash_algorithm=hash_algorithm)
+    if processes == 1:
+        yield from map(anonymize, src_file_paths)
+        return
+    processes = processes or os.cpu_count()
+    paths = iter(src_file_paths)
+    batch_size = processes * chunksize * 4
+    with ProcessPoolExecutor(processes) as executor:
+        # the next batch is queued while the results of the current one are
+        # yielded, so workers are not left idle between batches
+        results = executor.map(anonymize, list(itertools.islice(paths, batch_size)), chunksize=chunksize)
+        while results is not None:
+            batch = list(itertools.islice(paths, batch_size))
+            next_results = executor.map(anonymize, batch, chunksize=chunksize) if batch else None
+            yield from results
+            results = next_results
+
+
+def walk_files(root) -> Iterator[str]:
+    """Paths of every file under root, listed lazily"""
+    folders = [root]
+    while folders:
+        with os.scandir(folders.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+                elif entry.is_file():
+                    yield entry.path
+
+
+def anonymize_tree(src_root, dest_root, **kwargs) -> Iterator[AnonymizedFile]:
+    """anonymize_copies of every file under src_root"""
+    return anonymize_copies(walk_files(src_root), src_root, dest_root, **kwargs)
@@ -1,6 +1,6 @@
 import os
 from pathlib import Path
-from tagging.util.files import anonymize_copy
+from tagging.util.files import anonymize_copies, anonymize_copy, anonymize_tree
 
 
 def test_file_anonymize_copy(tmpdir):
@@ -10,3 +10,23 @@ def test_file_anonymize_copy(tmpdir):
     assert os.path.exists(new_file), "file was copied"
     assert tmpdir.dirname in new_file, "new file should have the tempdir name in it"
     assert os.path.splitext(new_file)[1] == ".tiff", "new file should be a .tiff"
+
+
+def test_anonymize_copies(tmpdir):
+    src_root = tmpdir.mkdir("src")
+    for i in range(6):
+        src_root.ensure_dir(f"run{i % 2}").join(f"frame{i}.tiff").write_binary(bytes([i % 3]) * 1000)
+    dest_root = str(tmpdir.join("dest"))
+
+    results = list(anonymize_tree(str(src_root), dest_root, processes=2, chunksize=1))
+    assert len(results) == 6
+    # two processes can both copy the same content, the files on disk are one per content
+    assert len({result.dest for result in results}) == 3, "one copy per content"
+    assert sum(len(files) for _, _, files in os.walk(dest_root)) == 3
+    assert all(os.path.exists(result.dest) for result in results)
+
+    src_files = sorted(result.src for result in results)
+    md5_copies = anonymize_copies(src_files, str(src_root), dest_root, hash_algorithm='md5', processes=1)
+    expected = [anonymize_copy(src, str(src_root), dest_root) for src in src_files]
+    assert [copy.dest for copy in md5_copies] == expected
+    assert not any(result.copied for result in anonymize_tree(str(src_root), dest_root, processes=1))